@@ -0,0 +1,461 @@
+"""Заглушки для офлайн-бенчмарков: Bot API и хранилище вместо SQL Server.
+
+``FakeRequest`` подменяет HTTP-слой ``telegram.Bot``: настоящий Bot
+собирает запросы и разбирает ответы, а сети нет. Задержку ответа и
+``RetryAfter`` на каждом N-м вызове можно задать.
+
+``FakeDB`` — хранилище в памяти за интерфейсом pyodbc (connect → cursor →
+execute/fetch*). Запросы узнаются по характерному фрагменту текста и
+выполняются на питоновских структурах. Неизвестный запрос —
+``NotImplementedError`` с его текстом: бенчмарк падает, а не мерит
+пустоту. ``install(db)`` переключает на него общий пул ``common.db``.
+"""
+import asyncio, datetime as dt, itertools, json, threading, time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Chat, Message, Poll, PollOption, User
+from telegram.request import BaseRequest, RequestData
+
+
+# ─────────── Bot API ───────────
+class FakeBotApi:
+    """Правдоподобные ответы методов Bot API (общие для FakeRequest и loadgen).
+
+    Ответы собираются из объектов самой библиотеки (``Message(...).to_dict()``):
+    набор обязательных полей всегда совпадает с установленной версией PTB.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count(1)
+
+    def _message(self, params: dict, **kwargs) -> Message:
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return Message(
+            message_id=int(params.get("message_id") or next(self._seq)),
+            date=dt.datetime.now(dt.timezone.utc),
+            chat=Chat(chat_id, Chat.PRIVATE) if chat_id > 0
+            else Chat(chat_id, Chat.GROUP, title="bench"),
+            **kwargs,
+        )
+
+    def message(self, params: dict) -> dict:
+        return self._message(params, text=params.get("text", "")).to_dict()
+
+    def result(self, api: str, params: dict):
+        if api == "getMe":
+            return User(1, "Bench", is_bot=True, username="bench_bot").to_dict()
+        if api == "sendPoll":
+            opts = [o if isinstance(o, str) else o.get("text", "")
+                    for o in params.get("options", [])]
+            poll = Poll(
+                id=f"poll{next(self._seq)}",
+                question=params.get("question", ""),
+                options=[PollOption(o, 0) for o in opts],
+                total_voter_count=0,
+                is_closed=False,
+                is_anonymous=False,
+                type=params.get("type", Poll.REGULAR),
+                allows_multiple_answers=False,
+                correct_option_id=params.get("correct_option_id"),
+            )
+            return self._message(params, poll=poll).to_dict()
+        if api in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return self.message(params)
+        return True
+
+
+class FakeRequest(BaseRequest):
+    """HTTP-слой Bot без сети: ответы даёт ``FakeBotApi``.
+
+    ``latency`` — задержка каждого ответа (с); ``retry_every`` — каждый
+    N-й вызов из ``retry_methods`` получает 429 с ``retry_after``.
+    """
+
+    def __init__(self, latency: float = 0.0, retry_every: int = 0,
+                 retry_after: float = 0.01,
+                 retry_methods: Tuple[str, ...] = ("sendMessage", "sendPoll")):
+        self.latency = latency
+        self.retry_every = retry_every
+        self.retry_after = retry_after
+        self.retry_methods = retry_methods
+        self.api = FakeBotApi()
+        self.calls: Counter = Counter()
+        self.flood = 0
+        self._retry_seq = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        # абстрактное свойство BaseRequest (PTB ≥ 20.7): таймаут по умолчанию
+        # для get_updates; сети нет — ждать нечего
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str,
+                         request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        api = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if (self.retry_every and api in self.retry_methods
+                and next(self._retry_seq) % self.retry_every == 0):
+            self.flood += 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        return 200, json.dumps({"ok": True, "result": self.api.result(api, params)}).encode()
+
+
+# ─────────── хранилище ───────────
+def _norm(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+class FakeDB:
+    """Таблицы бота в памяти.
+
+    ``latency`` — «раунд-трип» на execute (с); ``minute`` — сколько секунд
+    длится минута срока сессии (в нагрузочном тесте время сжато).
+    """
+
+    def __init__(self, latency: float = 0.0, minute: float = 60.0):
+        self.latency = latency
+        self.minute = minute
+        self.lock = threading.Lock()
+        self.statements: Counter = Counter()
+        self._ids = itertools.count(1)
+        self.files: Dict[int, Tuple[str, str]] = {}          # Id → (FileName, QuizJson)
+        self.quizzes: Dict[int, dict] = {}                   # PendingQuizzes
+        self.students: Dict[int, str] = {}                   # TelegramId → DisplayName
+        self.deliveries: Dict[Tuple[int, int], dict] = {}    # (StudentId, PendingQuizId)
+        self.polls: Dict[str, Tuple[int, int]] = {}          # PollId → (StudentId, PendingQuizId)
+        self.sessions: Dict[Tuple[int, int], dict] = {}      # (ProcessedFileId, StudentId)
+        self.results: List[tuple] = []
+        self.answered = set()
+        self.answer_times: Dict[Tuple[int, int], float] = {}   # (StudentId, PendingQuizId)
+        self.daily: Dict[dt.date, List[int]] = {}
+        self._routes = [
+            ("FROM dbo.SchemaVersion", self._schema_version),
+            ("SELECT FileName FROM dbo.ProcessedFiles WHERE Id=?", self._file_name),
+            ("SELECT DATALENGTH(QuizJson)", self._datalength),
+            ("SELECT SUBSTRING(CAST(QuizJson AS VARBINARY(MAX))", self._substring),
+            ("SELECT DisplayName FROM dbo.Students WHERE TelegramId=?", self._student_name),
+            ("SAVE TRANSACTION pf_import", self._savepoint),
+            ("SELECT XACT_STATE()", self._xact_state),
+            ("DELETE FROM dbo.PendingQuizzes WHERE ProcessedFileId", self._delete_pending),
+            ("INSERT INTO dbo.PendingQuizzes", self._insert_pending),
+            ("SELECT Id,Question,Options,Answer FROM dbo.PendingQuizzes", self._approved),
+            ("MERGE dbo.QuizSessions", self._merge_session),
+            ("UPDATE dbo.QuizSessions SET StartedAt=", self._start_session),
+            ("UPDATE TOP (?) dbo.QuizSessions", self._expire_overdue),
+            ("UPDATE dbo.QuizDeliveries SET Started=1", self._mark_started),
+            ("UPDATE qd SET PollId=v.PollId", self._save_poll_ids),
+            ("WHERE qd.PollId=?", self._lookup_poll),
+            ("INSERT INTO @a VALUES", self._record_answers),
+            ("MERGE dbo.FileStats WITH (HOLDLOCK)", self._fold),
+            ("FROM dbo.QuizStatsDaily;", self._dashboard),
+            ("FROM dbo.QuizResults qr LEFT JOIN dbo.Students st", self._results_page),
+        ]
+
+    # ─────────── наполнение ───────────
+    def add_file(self, questions: int, approved: bool = True) -> int:
+        """Файл с ``questions`` вопросами; ``approved`` — сразу в PendingQuizzes."""
+        pf = next(self._ids)
+        items = []
+        for i in range(questions):
+            opts = [f"Вариант {k} к вопросу {i}" for k in range(4)]
+            items.append({"question": f"Вопрос №{i} файла {pf}",
+                          "options": opts, "answer": opts[i % 4]})
+        self.files[pf] = (f"bench_{pf}.docx", json.dumps(items, ensure_ascii=False))
+        if approved:
+            for q in items:
+                self.quizzes[next(self._ids)] = {
+                    "pf": pf, "question": q["question"],
+                    "options": json.dumps(q["options"], ensure_ascii=False),
+                    "answer": q["answer"], "approved": True,
+                }
+        return pf
+
+    def add_students(self, ids) -> None:
+        for tg in ids:
+            self.students[tg] = f"Ученик {tg}"
+
+    # ─────────── pyodbc-интерфейс ───────────
+    def connect(self) -> "FakeConnection":
+        return FakeConnection(self)
+
+    def execute(self, sql: str, params: tuple) -> list:
+        text = _norm(sql)
+        for needle, handler in self._routes:
+            if needle in text:
+                if self.latency:
+                    time.sleep(self.latency)
+                with self.lock:
+                    self.statements[handler.__name__.lstrip("_")] += 1
+                    return handler(list(params))
+        raise NotImplementedError(f"FakeDB: no handler for {text[:160]!r}")
+
+    # ─────────── обработчики запросов ───────────
+    # результат — список наборов строк ([описание колонок, строки]) либо rowcount
+    def _schema_version(self, p):
+        from common.models import SCHEMA_VERSION
+        return [(None, [(SCHEMA_VERSION,)])]
+
+    def _file_name(self, p):
+        f = self.files.get(p[0])
+        return [(None, [(f[0],)] if f else [])]
+
+    def _datalength(self, p):
+        f = self.files.get(p[0])
+        return [(None, [(len(f[1].encode("utf-16-le")) if f else None,)])]
+
+    def _substring(self, p):
+        start, length, pf = p
+        data = self.files[pf][1].encode("utf-16-le")
+        return [(None, [(data[start - 1:start - 1 + length],)])]
+
+    def _student_name(self, p):
+        name = self.students.get(p[0])
+        return [(None, [(name,)] if name is not None else [])]
+
+    def _savepoint(self, p):
+        return 0
+
+    def _xact_state(self, p):
+        return [(None, [(1,)])]
+
+    def _delete_pending(self, p):
+        pfs = set(p)
+        gone = [qid for qid, q in self.quizzes.items() if q["pf"] in pfs]
+        for qid in gone:
+            del self.quizzes[qid]
+        return len(gone)
+
+    def _insert_pending(self, p):
+        for i in range(0, len(p), 4):
+            pf, question, options, answer = p[i:i + 4]
+            self.quizzes[next(self._ids)] = {
+                "pf": pf, "question": question, "options": options,
+                "answer": answer, "approved": None,
+            }
+        return len(p) // 4
+
+    def _approved(self, p):
+        rows = [(qid, q["question"], q["options"], q["answer"])
+                for qid, q in sorted(self.quizzes.items())
+                if q["pf"] == p[0] and q["approved"]]
+        return [(None, rows)]
+
+    def _merge_session(self, p):
+        pf, st, total = p
+        s = self.sessions.get((pf, st))
+        if s is None:
+            self.sessions[(pf, st)] = {"total": total, "answered": 0, "correct": 0,
+                                       "started": None, "finished": None,
+                                       "deadline": None}
+        else:
+            s["total"] = total
+        return 1
+
+    def _start_session(self, p):
+        s = self.sessions[(p[0], p[1])]
+        s["started"] = dt.datetime.utcnow()
+        s["deadline"] = time.monotonic() + s["total"] * self.minute
+        return 1
+
+    def _expire_overdue(self, p):
+        now = time.monotonic()
+        rows = []
+        for (pf, st), s in sorted(self.sessions.items()):
+            if len(rows) >= p[0]:
+                break
+            if s["finished"] is None and s["deadline"] is not None and s["deadline"] <= now:
+                s["finished"] = dt.datetime.utcnow()
+                s["timed_out"] = now
+                rows.append((pf, st, s["total"], s["correct"], self.students.get(st)))
+        return [(None, rows)]
+
+    def _mark_started(self, p):
+        st, pf = p
+        n = 0
+        for qid, q in self.quizzes.items():
+            if q["pf"] == pf:
+                d = self.deliveries.setdefault((st, qid), {"poll_id": None})
+                d["started"] = True
+                n += 1
+        return n
+
+    def _save_poll_ids(self, p):
+        student = p[-1]
+        for i in range(0, len(p) - 1, 2):
+            pq, poll_id = p[i], p[i + 1]
+            self.deliveries.setdefault((student, pq), {})["poll_id"] = poll_id
+            self.polls[poll_id] = (student, pq)
+        return (len(p) - 1) // 2
+
+    def _lookup_poll(self, p):
+        hit = self.polls.get(p[0])
+        if hit is None:
+            return [(None, [])]
+        st, pq = hit
+        q = self.quizzes[pq]
+        return [(None, [(pq, st, q["pf"], q["options"], q["answer"])])]
+
+    def _record_answers(self, p):
+        now = dt.datetime.utcnow()
+        per_session: Dict[Tuple[int, int], List[int]] = {}
+        for i in range(0, len(p), 5):
+            pq, st, pf, chosen, ok = p[i:i + 5]
+            if (st, pq) in self.answered:
+                continue
+            self.answered.add((st, pq))
+            self.answer_times[(st, pq)] = time.monotonic()
+            self.results.append((len(self.results) + 1, pq, st, chosen, ok, now))
+            agg = per_session.setdefault((pf, st), [0, 0])
+            agg[0] += 1
+            agg[1] += ok
+        out = []
+        for (pf, st), (cnt, ok) in per_session.items():
+            s = self.sessions.get((pf, st))
+            if s is None:
+                continue
+            was_open = s["finished"] is None
+            s["answered"] += cnt
+            s["correct"] += ok
+            if was_open and s["answered"] >= s["total"]:
+                s["finished"] = now
+            out.append((pf, st, s["total"], s["correct"],
+                        int(was_open and s["finished"] is not None)))
+            # в боте день сворачивает fold_rollups; здесь — сразу
+            day = self.daily.setdefault(now.date(), [0, 0])
+            day[0] += cnt
+            day[1] += ok
+        return [(None, out)]
+
+    def _fold(self, p):
+        return [(None, [(0, 0)])]
+
+    def _dashboard(self, p):
+        answers = sum(d[0] for d in self.daily.values())
+        correct = sum(d[1] for d in self.daily.values())
+        days = sorted(self.daily.items(), reverse=True)[:p[0]]
+        return [
+            (None, [(len(self.students), len(self.quizzes), answers, correct)]),
+            (None, [(d, a, ok) for d, (a, ok) in days]),
+        ]
+
+    _RESULT_COLS = ("Id", "PendingQuizId", "ChosenOption", "IsCorrect", "AnsweredAt",
+                    "CursorTs", "DisplayName", "TelegramId")
+
+    def _results_page(self, p):
+        top, rest = p[0], p[1:]
+        rows = self.results
+        if len(rest) == 3:                       # только курсор, без фильтров
+            ts, _, last_id = rest
+            bound = dt.datetime.fromisoformat(ts)
+            rows = [r for r in rows if (r[5], r[0]) < (bound, last_id)]
+        elif rest:
+            raise NotImplementedError("FakeDB: /results filters are not modelled")
+        rows = sorted(rows, key=lambda r: (r[5], r[0]), reverse=True)[:top]
+        out = [(rid, pq, chosen, ok, at, at.isoformat(timespec="microseconds"),
+                self.students.get(st, ""), st)
+               for rid, pq, st, chosen, ok, at in rows]
+        return [(self._RESULT_COLS, out)]
+
+
+class FakeCursor:
+    def __init__(self, db: FakeDB):
+        self._db = db
+        self._sets: list = []
+        self._rows: list = []
+        self.description = None
+        self.rowcount = -1
+        self.fast_executemany = False
+
+    def execute(self, sql: str, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = tuple(params[0])
+        res = self._db.execute(sql, params)
+        if isinstance(res, int):
+            self._sets, self.rowcount = [], res
+            self._rows, self.description = [], None
+        else:
+            self._sets = list(res)
+            self.rowcount = -1
+            self.nextset()
+        return self
+
+    def executemany(self, sql: str, seq) -> None:
+        total = 0
+        for params in seq:
+            self.execute(sql, *params)
+            total += max(self.rowcount, 0)
+        self.rowcount = total
+
+    def setinputsizes(self, sizes) -> None:
+        pass
+
+    def nextset(self) -> bool:
+        if not self._sets:
+            self._rows, self.description = [], None
+            return False
+        cols, rows = self._sets.pop(0)
+        self.description = [(c,) for c in cols] if cols else None
+        self._rows = list(rows)
+        return True
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size: int = 1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    """Транзакций нет: commit/rollback ничего не делают."""
+
+    def __init__(self, db: FakeDB):
+        self._db = db
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self._db)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def install(db: FakeDB) -> None:
+    """Переключает общий пул ``common.db`` на ``db``."""
+    from common.db import pool
+    pool.close()
+    pool.connect = db.connect
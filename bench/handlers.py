@@ -0,0 +1,238 @@
+"""Офлайн-бенчмарк хендлеров бота и страниц веб-панели.
+
+Настоящие хендлеры ``bot_app`` и маршруты ``web_app`` работают с
+``bench.fakes``: Bot API и БД — в памяти, сеть и SQL Server не нужны.
+Лимит отправки Telegram (BROADCAST_RATE) по умолчанию снят —
+меряем свой код, а не паузы; ``--real-limits`` оставляет его как есть.
+
+    python -m bench.handlers --ops 300 [--tg-latency-ms 5] [--db-latency-ms 1]
+                             [--retry-every 50] [--json out.json]
+                             [--compare baseline.json]
+"""
+import argparse, asyncio, json, os, platform, subprocess, sys, time
+from typing import Callable, Dict, List
+
+SCENARIOS = ("cb_start_test", "handle_poll", "handle_poll_miss",
+             "insert_pending", "web_dashboard", "web_results")
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def summarize(timings: List[float], errors: int, elapsed: float) -> dict:
+    t = sorted(timings)
+    return {
+        "ops": len(t),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(len(t) / elapsed, 1) if elapsed else None,
+        "mean_ms": round(sum(t) * 1000 / len(t), 3) if t else 0.0,
+        "p50_ms": round(percentile(t, 50) * 1000, 3),
+        "p99_ms": round(percentile(t, 99) * 1000, 3),
+    }
+
+
+async def measure(ops, call: Callable) -> dict:
+    timings, errors = [], 0
+    started = time.perf_counter()
+    for op in ops:
+        t0 = time.perf_counter()
+        try:
+            await call(op)
+        except Exception as e:  # noqa: BLE001 — считаем и идём дальше
+            errors += 1
+            if errors == 1:
+                print(f"  first error: {type(e).__name__}: {e}", file=sys.stderr)
+            continue
+        timings.append(time.perf_counter() - t0)
+    return summarize(timings, errors, time.perf_counter() - started)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"S{uid}"}
+
+
+async def bot_benches(db, req, n: int, only) -> Dict[str, dict]:
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CallbackContext
+
+    import bot_app
+    from bench.fakes import FakeRequest
+    from common.pollindex import PollIndex
+
+    app = (ApplicationBuilder().token("1:BENCH").request(req)
+           .get_updates_request(FakeRequest()).build())
+    await app.initialize()
+    bot = app.bot
+    seq = iter(range(1, 10 ** 9))
+    out: Dict[str, dict] = {}
+
+    def ctx(update):
+        return CallbackContext.from_update(update, app)
+
+    def start_update(student: int, pf: int):
+        return Update.de_json({
+            "update_id": next(seq),
+            "callback_query": {
+                "id": str(next(seq)), "from": _user(student), "chat_instance": "b",
+                "data": f"start:{pf}",
+                "message": {"message_id": next(seq), "date": 0, "text": "Тест",
+                            "chat": {"id": student, "type": "private"}},
+            },
+        }, bot)
+
+    def answer_update(poll_id: str, student: int):
+        return Update.de_json({
+            "update_id": next(seq),
+            "poll_answer": {"poll_id": poll_id, "user": _user(student),
+                            "option_ids": [0]},
+        }, bot)
+
+    pf = db.add_file(questions=12)
+    students = list(range(100_000, 100_000 + n))
+    db.add_students(students)
+
+    async def start(st):
+        u = start_update(st, pf)
+        await bot_app.cb_start_test(u, ctx(u))
+
+    # cb_start_test заодно готовит опросы для handle_poll
+    if {"cb_start_test", "handle_poll"} & only:
+        out["cb_start_test"] = await measure(students, start)
+
+    async def answer(poll_id):
+        st, _pq = db.polls[poll_id]
+        u = answer_update(poll_id, st)
+        await bot_app.handle_poll(u, ctx(u))
+
+    if "handle_poll" in only:
+        started = set(students)
+        polls = [p for p, (st, _) in db.polls.items() if st in started][:n]
+        out["handle_poll"] = await measure(polls, answer)
+
+    if "handle_poll_miss" in only:
+        # индекс нулевой ёмкости — каждый ответ ищется в БД (lookup_poll)
+        fresh = list(range(200_000, 200_000 + max(1, n // 12 + 1)))
+        db.add_students(fresh)
+        for st in fresh:
+            await start(st)
+        polls = [p for p, (st, _) in db.polls.items() if st >= 200_000][:n]
+        saved, bot_app.poll_index = bot_app.poll_index, PollIndex(0)
+        try:
+            out["handle_poll_miss"] = await measure(polls, answer)
+        finally:
+            bot_app.poll_index = saved
+
+    if "insert_pending" in only:
+        files = [db.add_file(questions=200, approved=False) for _ in range(min(n, 50))]
+        out["insert_pending"] = await measure(
+            files, lambda f: bot_app.db_run(bot_app.insert_pending, [f])
+        )
+        out["insert_pending"]["questions_per_op"] = 200
+
+    await app.shutdown()
+    return out
+
+
+def web_benches(db, n: int, only) -> Dict[str, dict]:
+    import web_app
+
+    client = web_app.create_app().test_client()
+    out = {}
+    for name, url in (("web_dashboard", "/"), ("web_results", "/results")):
+        if name not in only:
+            continue
+
+        async def get(_, url=url):
+            resp = client.get(url)
+            if resp.status_code != 200:
+                raise RuntimeError(f"{url}: HTTP {resp.status_code}")
+            resp.get_data()
+
+        out[name] = asyncio.run(measure(range(n), get))
+    return out
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict, path: str) -> None:
+    with open(path) as f:
+        base = json.load(f)["results"]
+    print(f"\nvs {path}:")
+    for name, r in current.items():
+        b = base.get(name)
+        if not b or not b.get("ops_per_sec") or not r.get("ops_per_sec"):
+            continue
+        print(f"{name:>17}: ops/s ×{r['ops_per_sec'] / b['ops_per_sec']:.2f}, "
+              f"p99 {b['p99_ms']:.2f} → {r['p99_ms']:.2f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--ops", type=int, default=300, help="операций на сценарий")
+    ap.add_argument("--only", default=",".join(SCENARIOS))
+    ap.add_argument("--tg-latency-ms", type=float, default=0.0)
+    ap.add_argument("--db-latency-ms", type=float, default=0.0)
+    ap.add_argument("--retry-every", type=int, default=0,
+                    help="каждый N-й sendMessage/sendPoll получает RetryAfter")
+    ap.add_argument("--real-limits", action="store_true")
+    ap.add_argument("--json", help="записать результаты в файл")
+    ap.add_argument("--compare", help="сравнить с результатами прошлого прогона")
+    args = ap.parse_args()
+    only = set(args.only.split(","))
+
+    # настройки читаются при импорте модулей — задаём до него
+    os.environ.setdefault("DASH_CACHE_TTL", "0")
+    os.environ.setdefault("ANSWER_WRITE_MODE", "sync")
+    if not args.real_limits:
+        os.environ.setdefault("BROADCAST_RATE", "1000000")
+
+    from bench.fakes import FakeDB, FakeRequest, install
+
+    db = FakeDB(latency=args.db_latency_ms / 1000)
+    install(db)
+    req = FakeRequest(latency=args.tg_latency_ms / 1000, retry_every=args.retry_every)
+
+    import logging
+    logging.disable(logging.WARNING)
+
+    results = asyncio.run(bot_benches(db, req, args.ops, only))
+    results.update(web_benches(db, args.ops, only))
+
+    for name, r in results.items():
+        print(f"{name:>17}: {r['ops_per_sec'] or 0:>9,.1f} ops/s  "
+              f"p50 {r['p50_ms']:.2f} ms  p99 {r['p99_ms']:.2f} ms"
+              + (f"  errors {r['errors']}" if r["errors"] else ""))
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "telegram_calls": dict(req.calls),
+            "flood_waits": req.flood,
+            "db_statements": dict(db.statements),
+        },
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
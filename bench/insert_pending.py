@@ -0,0 +1,69 @@
+"""Скорость загрузки PendingQuizzes: row (как раньше) против fast / values.
+
+Нужен доступ к БД (AI_BOTS_CONN). Каждый прогон идёт в своей транзакции
+и откатывается — таблица не меняется.
+
+    python -m bench.insert_pending --rows 5000 --repeat 3 [--long-every 100]
+                                   [--json out.json]
+
+``--long-every N`` делает каждый N-й вопрос длиннее 4000 символов — такие
+строки режим fast отправляет через INSERT ... VALUES.
+"""
+import argparse, json, time
+
+from common.db import db_conn
+from common.ingest import BULK_MODES, load_pending, quiz_row
+
+
+def synthetic_rows(n: int, long_every: int = 0):
+    rows = []
+    for i in range(n):
+        opts = [f"Вариант {k} к вопросу {i}" for k in range(4)]
+        words = 1000 if long_every and i % long_every == 0 else 20
+        row, _ = quiz_row({
+            "question": f"Синтетический вопрос №{i}: " + "текст " * words,
+            "options": opts,
+            "answer": opts[i % 4],
+        })
+        rows.append((-1, *row))      # ProcessedFileId=-1 — в проде таких нет
+    return rows
+
+
+def run(mode: str, rows) -> float:
+    with db_conn() as c, c.cursor() as cur:
+        try:
+            started = time.perf_counter()
+            load_pending(cur, rows, mode)
+            return time.perf_counter() - started
+        finally:
+            c.rollback()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--modes", default=",".join(reversed(BULK_MODES)))
+    ap.add_argument("--long-every", type=int, default=0,
+                    help="каждый N-й вопрос длиннее 4000 символов")
+    ap.add_argument("--json", help="записать результаты в файл")
+    args = ap.parse_args()
+
+    rows = synthetic_rows(args.rows, args.long_every)
+    results = {}
+    for mode in args.modes.split(","):
+        best = min(run(mode, rows) for _ in range(args.repeat))
+        results[mode] = {"rows": args.rows, "seconds": round(best, 4),
+                         "rows_per_sec": round(args.rows / best, 1)}
+        print(f"{mode:>7}: {args.rows} rows in {best:.3f}s "
+              f"→ {args.rows / best:,.0f} rows/s")
+    if "row" in results:
+        for mode, r in results.items():
+            r["speedup"] = round(r["rows_per_sec"] / results["row"]["rows_per_sec"], 2)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""Нагрузочный стенд: класс из N учеников проходит тест целиком.
+
+Поднимается локальный сервер Bot API (getUpdates / sendMessage / sendPoll
+и прочее, что зовёт бот), настоящий ``bot_app`` ходит в него по HTTP
+(TG_BASE_URL) и работает с ``bench.fakes.FakeDB`` вместо SQL Server.
+Ученики жмут «🚀 Я готов!» и отвечают на опросы с паузой «на подумать»;
+часть бросает тест, чтобы сработал тайм-аут. Сервер и ученики крутятся в
+отдельном потоке со своим event loop — бот их очередь не видит.
+
+Отчёт: задержка ответа (poll_answer → запись в БД), задержка итога
+(последний ответ → «✅ Вы завершили»), точность тайм-аута (срок →
+«⏰ Время вышло»), потерянные ответы, пиковая память процесса.
+
+    python -m bench.loadgen --students 500 --questions 10 --think 2 \\
+        [--minute 1] [--dropout 0.1] [--json out.json]
+"""
+import argparse, asyncio, json, os, random, resource, sys, threading, time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from bench.fakes import FakeBotApi, FakeDB, install
+from bench.handlers import percentile
+
+
+def _param(value):
+    # HTTPXRequest шлёт форму, где не-строки закодированы в JSON
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class FakeTelegramServer:
+    """Локальный Bot API: отдаёт обновления учеников и запоминает ответы бота."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081):
+        self.host, self.port = host, port
+        self.api = FakeBotApi()
+        self.calls: Counter = Counter()
+        self.completed: Dict[int, float] = {}     # ученик → «✅ Вы завершили»
+        self.timed_out: Dict[int, float] = {}     # ученик → «⏰ Время вышло»
+        self._updates: List[dict] = []
+        self._next_id = 1
+        self._inboxes: Dict[int, asyncio.Queue] = {}
+        self._cond: Optional[asyncio.Condition] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self) -> None:
+        self._cond = asyncio.Condition()
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        return self._inboxes.setdefault(chat_id, asyncio.Queue())
+
+    async def push(self, update: dict) -> None:
+        async with self._cond:
+            update["update_id"] = self._next_id
+            self._next_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {k: _param(v) for k, v in (await request.post()).items()}
+        self.calls[method] += 1
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            result = self.api.result(method, params)
+            self._observe(method, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        async with self._cond:
+            # подтверждённые (id < offset) больше не отдаём
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self._updates),
+                                           timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    def _observe(self, method: str, params: dict, result) -> None:
+        now = time.monotonic()
+        chat = int(params.get("chat_id", 0) or 0)
+        if method == "sendPoll":
+            poll = result["poll"]
+            self.inbox(chat).put_nowait(
+                (poll["id"], len(poll["options"]), poll["correct_option_id"])
+            )
+        elif method == "sendMessage":
+            text = str(params.get("text", ""))
+            if text.startswith("✅ Вы завершили"):
+                self.completed.setdefault(chat, now)
+            elif text.startswith("⏰ Время вышло"):
+                self.timed_out.setdefault(chat, now)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"S{uid}"}
+
+
+async def simulate(server: FakeTelegramServer, args, pf: int, students: List[int],
+                   minute: float) -> dict:
+    """Ученики проходят тест; {(ученик, poll_id): время отправки ответа}."""
+    injected: Dict[Tuple[int, str], float] = {}
+    last_answer: Dict[int, float] = {}
+    outcome: Counter = Counter()
+    rnd = random.Random(args.seed)
+    stall = args.questions * minute + 60
+
+    async def student(st: int):
+        await asyncio.sleep(rnd.uniform(0, args.ramp))
+        await server.push({"callback_query": {
+            "id": f"cq{st}", "from": _user(st), "chat_instance": "load",
+            "data": f"start:{pf}",
+            "message": {"message_id": st, "date": int(time.time()), "text": "Тест",
+                        "chat": {"id": st, "type": "private"}},
+        }})
+        drop_at = rnd.randrange(args.questions) if rnd.random() < args.dropout else None
+        inbox = server.inbox(st)
+        for k in range(args.questions):
+            try:
+                poll_id, n_opts, correct = await asyncio.wait_for(inbox.get(), stall)
+            except asyncio.TimeoutError:
+                outcome["stalled"] += 1
+                return
+            if drop_at is not None and k >= drop_at:
+                outcome["dropped"] += 1
+                return
+            await asyncio.sleep(rnd.expovariate(1 / args.think) if args.think else 0)
+            choice = correct if rnd.random() < args.accuracy else (correct + 1) % n_opts
+            injected[(st, poll_id)] = time.monotonic()
+            await server.push({"poll_answer": {
+                "poll_id": poll_id, "user": _user(st), "option_ids": [choice],
+            }})
+        last_answer[st] = time.monotonic()
+        outcome["finished"] += 1
+
+    await asyncio.gather(*(student(st) for st in students))
+
+    # ждём итоговых сообщений: о завершении — сразу, о тайм-ауте — после срока
+    deadline = time.monotonic() + args.questions * minute + args.settle
+    while time.monotonic() < deadline:
+        done = set(server.completed) | set(server.timed_out)
+        if len(done) >= len(students):
+            break
+        await asyncio.sleep(0.2)
+    return {"injected": injected, "last_answer": last_answer, "outcome": outcome}
+
+
+def _dist(values: List[float]) -> dict:
+    v = sorted(values)
+    return {
+        "n": len(v),
+        "p50_ms": round(percentile(v, 50) * 1000, 1),
+        "p95_ms": round(percentile(v, 95) * 1000, 1),
+        "p99_ms": round(percentile(v, 99) * 1000, 1),
+        "max_ms": round(v[-1] * 1000, 1) if v else 0.0,
+    }
+
+
+def build_report(db: FakeDB, server: FakeTelegramServer, sim: dict, pf: int,
+                 students: List[int], elapsed: float) -> dict:
+    injected, last_answer = sim["injected"], sim["last_answer"]
+
+    answer_lat, lost = [], 0
+    for (st, poll_id), sent in injected.items():
+        pq = db.polls.get(poll_id, (None, None))[1]
+        written = db.answer_times.get((st, pq))
+        if written is None:
+            lost += 1
+        else:
+            answer_lat.append(written - sent)
+
+    completion = [server.completed[st] - t for st, t in last_answer.items()
+                  if st in server.completed]
+    timeout_err, sweep_lag = [], []
+    for st in students:
+        s = db.sessions.get((pf, st))
+        if not s or not s.get("timed_out"):
+            continue
+        sweep_lag.append(s["timed_out"] - s["deadline"])
+        if st in server.timed_out:
+            timeout_err.append(server.timed_out[st] - s["deadline"])
+
+    return {
+        "students": len(students),
+        "seconds": round(elapsed, 2),
+        "outcome": dict(sim["outcome"]),
+        "answers": {"sent": len(injected), "recorded": len(answer_lat), "lost": lost,
+                    "per_sec": round(len(injected) / elapsed, 1) if elapsed else None},
+        "answer_latency": _dist(answer_lat),
+        "completion_latency": _dist(completion),
+        "completion_missing": len(last_answer) - len(completion),
+        "timeout_notice_delay": _dist(timeout_err),
+        "timeout_sweep_delay": _dist(sweep_lag),
+        # Linux: ru_maxrss в КБ
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "telegram_calls": dict(server.calls),
+        "db_statements": dict(db.statements),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--students", type=int, default=200)
+    ap.add_argument("--questions", type=int, default=10)
+    ap.add_argument("--think", type=float, default=2.0, help="средняя пауза на ответ, с")
+    ap.add_argument("--ramp", type=float, default=5.0, help="разброс старта учеников, с")
+    ap.add_argument("--accuracy", type=float, default=0.7)
+    ap.add_argument("--dropout", type=float, default=0.1,
+                    help="доля учеников, бросающих тест (проверка тайм-аута)")
+    ap.add_argument("--minute", type=float, default=1.0,
+                    help="длина «минуты» срока сессии в секундах")
+    ap.add_argument("--settle", type=float, default=10.0)
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--db-latency-ms", type=float, default=0.0)
+    ap.add_argument("--write-mode", default="sync", choices=("sync", "group", "async"))
+    ap.add_argument("--no-limits", action="store_true",
+                    help="снять общий лимит отправки (BROADCAST_RATE)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="записать отчёт в файл")
+    args = ap.parse_args()
+
+    server = FakeTelegramServer(port=args.port)
+    os.environ.setdefault("TG_BASE_URL", server.base_url)
+    os.environ.setdefault("SESSION_SWEEP_SECONDS", "1")
+    os.environ.setdefault("ANSWER_WRITE_MODE", args.write_mode)
+    if args.no_limits:
+        os.environ.setdefault("BROADCAST_RATE", "1000000")
+
+    db = FakeDB(latency=args.db_latency_ms / 1000, minute=args.minute)
+    install(db)
+    pf = db.add_file(questions=args.questions)
+    students = list(range(1_000_000, 1_000_000 + args.students))
+    db.add_students(students)
+
+    import logging
+    import bot_app
+    logging.disable(logging.WARNING)
+    bot_app.BOT_TOKEN = "1:LOADGEN"
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="fake-telegram", daemon=True).start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+    async def drive() -> Tuple[dict, float]:
+        app = bot_app.build_application(jobs=True)
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.updater.start_polling(poll_interval=0.0, timeout=10)
+        await app.start()
+        started = time.monotonic()
+        try:
+            sim = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                simulate(server, args, pf, students, args.minute), loop
+            ))
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+            await app.shutdown()
+        return sim, time.monotonic() - started
+
+    sim, elapsed = asyncio.run(drive())
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+    report = build_report(db, server, sim, pf, students, elapsed)
+    json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 # bot_app.py — финальная версия с динамическим тайм-аутом
 # -------------------------------------------------------
-import json, logging, os
-from typing import List, Optional, Sequence, Tuple
+import asyncio, html, json, logging, os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
+import pyodbc
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -11,11 +13,24 @@ from telegram.ext import (
     ContextTypes,
     PollAnswerHandler,
 )
-from telegram.request import HTTPXRequest
 
 from telegram_config import BOT_TOKEN, ADMIN_CHAT_ID
-from common.db import db_conn
+from common.broadcast import Broadcaster, BroadcastReport, SharedTokenBucket, TokenBucket
+from common.config import setting
+from common.db import (
+    chunked, db_conn, db_execute, db_run, placeholders, pool,
+)
+from common.botapi import MeteredRequest
+from common.debugserver import start_debug_server
+from common.metrics import timed_handler, watch_loop_lag
 from common.models import ensure_schema
+from common.ingest import (
+    MalformedJson, iter_json_array, load_pending, quiz_json_chunks, quiz_row,
+)
+from common.pollindex import PollRecord, poll_index
+from common.rollups import APPLY_ROLLUP_SQL, ROLLUP_DELTA_SQL, fold_rollups
+from common.updates import update_processor
+from common.writebehind import WriteBehind
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +38,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# запись ответов: sync — транзакция на ответ; group — пачками, хендлер ждёт
+# коммита; async — пачками, хендлер не ждёт (быстрее всего, но ответы из
+# ещё не сброшенной пачки теряются при падении процесса)
+ANSWER_WRITE_MODE = setting("ANSWER_WRITE_MODE", "sync")
+
+# модерация: дайджест по файлу (страницы по DIGEST_PAGE_SIZE вопросов с
+# переключателями) или, при MODERATION_DIGEST=0, сообщение на каждый вопрос
+MODERATION_DIGEST = setting("MODERATION_DIGEST", True, bool)
+DIGEST_PAGE_SIZE = setting("DIGEST_PAGE_SIZE", 10, int)
+
+# импорт ProcessedFiles: размер куска QuizJson, пачка загрузки и её способ
+# (fast — fast_executemany, values — INSERT ... VALUES, row — построчно)
+SYNC_CHUNK_CHARS = setting("SYNC_CHUNK_CHARS", 32768, int)
+SYNC_BATCH_SIZE = setting("SYNC_BATCH_SIZE", 1000, int)
+BULK_IMPORT_MODE = setting("BULK_IMPORT_MODE", "fast")
+
+# тайм-ауты тестов: срок сессии — QuizSessions.DeadlineAt, просроченные
+# закрывает обход раз в SESSION_SWEEP_SECONDS пачками по SESSION_SWEEP_BATCH
+SESSION_SWEEP_SECONDS = setting("SESSION_SWEEP_SECONDS", 15.0, float)
+SESSION_SWEEP_BATCH = setting("SESSION_SWEEP_BATCH", 1000, int)
+# период свёртки FileStats и QuizStatsDaily (common.rollups.fold_rollups)
+ROLLUP_FOLD_SECONDS = setting("ROLLUP_FOLD_SECONDS", 60.0, float)
+# общий лимит бота на отправку, сообщ./с — на все процессы вместе
+BROADCAST_RATE = setting("BROADCAST_RATE", 25.0, float)
+# PollId отправленных опросов пишутся в БД пачками по столько, в фоне
+POLL_SAVE_BATCH = setting("POLL_SAVE_BATCH", 10, int)
+# неотправленное предложение разослать: повторы через 1, 2, 4… мин
+PROMPT_RETRY_SECONDS = setting("PROMPT_RETRY_SECONDS", 60.0, float)
+PROMPT_RETRY_ATTEMPTS = setting("PROMPT_RETRY_ATTEMPTS", 5, int)
+
 # ─────────── helpers ───────────
 def active_students() -> List[int]:
     with db_conn() as c, c.cursor() as cur:
@@ -30,9 +75,10 @@ def active_students() -> List[int]:
         return [r[0] for r in cur.fetchall()]
 
 
-def get_recent_processedfiles() -> Sequence[Tuple[int, str, str]]:
+def get_recent_processedfiles() -> Sequence[Tuple[int, str]]:
+    # только Id и имя: сам QuizJson читается потоково в insert_pending
     sql = """
-        SELECT Id, FileName, QuizJson
+        SELECT Id, FileName
         FROM dbo.ProcessedFiles
         WHERE QuizJson IS NOT NULL
           AND DownloadedAt >= DATEADD(day,-1,SYSUTCDATETIME())
@@ -47,11 +93,23 @@ def get_recent_processedfiles() -> Sequence[Tuple[int, str, str]]:
         return cur.fetchall()
 
 
+_titles: Dict[int, str] = {}   # имя файла по Id не меняется — кэшируем
+
+
 def file_title(pf_id: int) -> str:
+    if pf_id in _titles:
+        return _titles[pf_id]
     with db_conn() as c, c.cursor() as cur:
         cur.execute("SELECT FileName FROM dbo.ProcessedFiles WHERE Id=?", pf_id)
         row = cur.fetchone()
-    return os.path.splitext(row[0])[0] if row else f"Файл {pf_id}"
+    if not row:
+        return f"Файл {pf_id}"
+    _titles[pf_id] = os.path.splitext(row[0])[0]
+    return _titles[pf_id]
+
+
+async def title_of(pf_id: int) -> str:
+    return _titles.get(pf_id) or await db_run(file_title, pf_id)
 
 
 def student_name(tg_id: int) -> str:
@@ -62,102 +120,592 @@ def student_name(tg_id: int) -> str:
 
 
 # ─────────── FIXED: insert_pending ───────────
-def insert_pending(pf_id: int, quiz_json: str) -> int:
-    """Импортирует вопросы файла. Возвращает количество добавленных строк."""
+# точка сохранения на файл: ошибка вставки откатывает только его
+_FILE_SAVEPOINT_SQL = "IF @@TRANCOUNT = 0 BEGIN TRANSACTION; SAVE TRANSACTION pf_import;"
+
+
+def insert_pending(pf_ids: Sequence[int]) -> Dict[int, Tuple[int, List[str]]]:
+    """Импортирует вопросы файлов одной транзакцией, с заменой прежних.
+
+    QuizJson читается кусками по SYNC_CHUNK_CHARS символов, элементы
+    разбираются по одному и загружаются пачками по SYNC_BATCH_SIZE строк
+    способом BULK_IMPORT_MODE. Каждый файл — под своей точкой сохранения:
+    если вставка всё же упала, файл откатывается к прежним вопросам и
+    попадает в отчёт, остальные файлы загружаются. Возвращает
+    {pf_id: (добавлено, проблемы)}.
+    """
+    report: Dict[int, Tuple[int, List[str]]] = {}
+    with db_conn() as c, c.cursor() as cur, c.cursor() as ins:
+        for pf_id in pf_ids:
+            cur.execute(_FILE_SAVEPOINT_SQL)
+            try:
+                report[pf_id] = load_file(cur, ins, pf_id)
+            except pyodbc.Error as e:
+                cur.execute("SELECT XACT_STATE()")
+                if cur.fetchone()[0] != 1:
+                    raise           # транзакция обречена — откатится целиком
+                cur.execute("ROLLBACK TRANSACTION pf_import")
+                logger.warning("File %s: import failed, rolled back: %s", pf_id, e)
+                report[pf_id] = (0, [f"файл не загружен: {e}"])
+        c.commit()
+    return report
+
+
+def load_file(cur, ins, pf_id: int) -> Tuple[int, List[str]]:
+    """Заменяет вопросы одного файла; (добавлено, проблемы)."""
+    # очищаем возможный «хвост» от предыдущих запусков
+    cur.execute("DELETE FROM dbo.PendingQuizzes WHERE ProcessedFileId=?", pf_id)
+    imported, problems, rows = 0, [], []
     try:
-        items = json.loads(quiz_json)
-    except json.JSONDecodeError:
-        logger.warning("Skip file %s: invalid JSON", pf_id)
-        return 0
+        for i, q in iter_json_array(quiz_json_chunks(cur, pf_id, SYNC_CHUNK_CHARS)):
+            row, reason = quiz_row(q)
+            if reason:
+                problems.append(f"#{i + 1}: {reason}")
+                continue
+            rows.append((pf_id, *row))
+            if len(rows) >= SYNC_BATCH_SIZE:
+                load_pending(ins, rows, BULK_IMPORT_MODE)
+                imported += len(rows)
+                rows.clear()
+    except MalformedJson as e:
+        logger.warning("File %s: malformed JSON: %s", pf_id, e)
+        problems.append(f"JSON повреждён: {e}")
+    load_pending(ins, rows, BULK_IMPORT_MODE)
+    return imported + len(rows), problems
+
+
+def create_session(cur, pf_id: int, student: int, total: int) -> None:
+    cur.execute(
+        """
+        MERGE dbo.QuizSessions WITH (HOLDLOCK) AS T
+        USING (SELECT ? AS pf, ? AS st, ? AS tot) AS S
+          ON (T.ProcessedFileId = S.pf AND T.StudentId = S.st)
+        WHEN MATCHED AND T.Total <> S.tot THEN
+             UPDATE SET Total = S.tot
+        WHEN NOT MATCHED THEN
+             INSERT (ProcessedFileId,StudentId,Total)
+             VALUES (S.pf,S.st,S.tot);
+        """,
+        pf_id,
+        student,
+        total,
+    )
 
-    if not isinstance(items, list):
-        return 0
 
-    rows = [
-        (
+# ─────────── транзакции хендлеров (выполняются в пуле потоков БД) ───────────
+def create_deliveries(pf_id: int) -> Tuple[int, List[int]]:
+    """Заводит QuizDeliveries для всех активных учеников; (кол-во вопросов, ученики)."""
+    students = active_students()
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(
+            "SELECT Id FROM dbo.PendingQuizzes "
+            "WHERE ProcessedFileId=? AND Approved=1",
             pf_id,
-            q["question"],
-            json.dumps(q["options"], ensure_ascii=False),
-            q["answer"],
         )
-        for q in items
-        if {"question", "options", "answer"}.issubset(q)
-    ]
+        pq_ids = [r[0] for r in cur.fetchall()]
 
+        deliveries = [(pid, sid) for pid in pq_ids for sid in students]
+        if deliveries:
+            cur.executemany(
+                "INSERT INTO dbo.QuizDeliveries (PendingQuizId,StudentId) VALUES (?,?)",
+                deliveries,
+            )
+        c.commit()
+    return len(pq_ids), students
+
+
+START_SESSION_SQL = """
+SET NOCOUNT ON;
+DECLARE @pf INT = ?, @st BIGINT = ?;
+UPDATE dbo.QuizSessions SET StartedAt=SYSUTCDATETIME(), Attempts=Attempts+1,
+       DeadlineAt=DATEADD(minute, Total, SYSUTCDATETIME())
+WHERE ProcessedFileId=@pf AND StudentId=@st;
+""" + ROLLUP_DELTA_SQL + """
+INSERT INTO @d (StudentId, ProcessedFileId, Attempts) VALUES (@st, @pf, 1);
+""" + APPLY_ROLLUP_SQL
+
+
+def start_session(pf_id: int, student: int) -> List[Tuple[int, str, list, int]]:
+    """Создаёт/перезапускает сессию ученика.
+
+    Возвращает вопросы для отправки: (PendingQuizId, текст, варианты, индекс ответа).
+    Вопросы, где ответа нет среди вариантов, пропускаются и в Total не входят.
+    """
     with db_conn() as c, c.cursor() as cur:
-        # очищаем возможный «хвост» от предыдущих запусков
-        cur.execute("DELETE FROM dbo.PendingQuizzes WHERE ProcessedFileId=?", pf_id)
-
-        # если вопросов нет — просто завершаем без executemany
-        if not rows:
-            c.commit()
-            return 0
-
-        cur.executemany(
-            "INSERT INTO dbo.PendingQuizzes "
-            "(ProcessedFileId,Question,Options,Answer) VALUES (?,?,?,?)",
-            rows,
+        cur.execute(
+            "SELECT Id,Question,Options,Answer FROM dbo.PendingQuizzes "
+            "WHERE ProcessedFileId=? AND Approved=1 ORDER BY Id",
+            pf_id,
+        )
+        polls = []
+        for pid, qtext, opts_json, ans in cur.fetchall():
+            opts = json.loads(opts_json)
+            try:
+                polls.append((pid, qtext, opts, opts.index(ans)))
+            except ValueError:
+                logger.error(
+                    "File #%s, question id %s: answer not found in options", pf_id, pid
+                )
+        total = len(polls)
+        create_session(cur, pf_id, student, total)
+        # минута на вопрос; по DeadlineAt сессию закроет expire_overdue
+        cur.execute(START_SESSION_SQL, pf_id, student)
+        cur.execute(
+            "UPDATE dbo.QuizDeliveries SET Started=1 "
+            "WHERE StudentId=? AND PendingQuizId IN "
+            "(SELECT Id FROM dbo.PendingQuizzes WHERE ProcessedFileId=?)",
+            student, pf_id
         )
         c.commit()
+    return polls
+
 
-    return len(rows)
+def save_poll_ids(student: int, mapping: List[Tuple[int, str]]) -> None:
+    """Одним UPDATE на пачку записывает PollId отправленных опросов."""
+    with db_conn() as c, c.cursor() as cur:
+        for part in chunked(mapping, 500):
+            cur.execute(
+                "UPDATE qd SET PollId=v.PollId "
+                "FROM dbo.QuizDeliveries qd "
+                f"JOIN (VALUES {','.join(['(?,?)'] * len(part))}) "
+                "     AS v(PendingQuizId, PollId) "
+                "  ON v.PendingQuizId = qd.PendingQuizId "
+                "WHERE qd.StudentId=?",
+                *(x for pair in part for x in pair), student
+            )
+        c.commit()
 
 
-def create_session(pf_id: int, student: int, total: int) -> None:
+def mark_announced(pf_id: int, students: List[int]) -> None:
+    """Отмечает доставленный анонс в QuizDeliveries.Announced."""
+    with db_conn() as c, c.cursor() as cur:
+        for part in chunked(students, 1000):
+            cur.execute(
+                "UPDATE dbo.QuizDeliveries SET Announced=1 "
+                f"WHERE StudentId IN ({placeholders(len(part))}) "
+                "  AND PendingQuizId IN (SELECT Id FROM dbo.PendingQuizzes "
+                "                        WHERE ProcessedFileId=? AND Approved=1)",
+                *part, pf_id
+            )
+        c.commit()
+
+
+EXPIRE_OVERDUE_SQL = """
+SET NOCOUNT ON;
+DECLARE @x TABLE (ProcessedFileId INT, StudentId BIGINT, Total INT, Correct INT);
+UPDATE TOP (?) dbo.QuizSessions WITH (READPAST)
+SET FinishedAt = SYSUTCDATETIME(), TimedOut = 1
+OUTPUT inserted.ProcessedFileId, inserted.StudentId, inserted.Total, inserted.Correct
+INTO @x
+WHERE FinishedAt IS NULL AND DeadlineAt <= SYSUTCDATETIME();
+""" + ROLLUP_DELTA_SQL + """
+INSERT INTO @d (StudentId, ProcessedFileId, TimedOut)
+SELECT StudentId, ProcessedFileId, 1 FROM @x;
+""" + APPLY_ROLLUP_SQL + """
+SELECT x.ProcessedFileId, x.StudentId, x.Total, x.Correct, st.DisplayName
+FROM @x x
+LEFT JOIN dbo.Students st ON st.TelegramId = x.StudentId
+ORDER BY x.ProcessedFileId, x.StudentId;
+"""
+
+
+def expire_overdue(limit: int) -> List[Tuple[int, int, int, int, str]]:
+    """Закрывает до ``limit`` просроченных сессий одним UPDATE.
+
+    Возвращает (файл, ученик, total, correct, имя). Условие
+    ``FinishedAt IS NULL`` внутри UPDATE не даёт закрыть сессию дважды —
+    ни повторным обходом, ни параллельно с записью последнего ответа.
+    """
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(EXPIRE_OVERDUE_SQL, limit)
+        rows = cur.fetchall()
+        c.commit()
+    return [(pf, st, total, correct, name or str(st))
+            for pf, st, total, correct, name in rows]
+
+
+def lookup_poll(poll_id: str) -> Optional[PollRecord]:
+    """Промах индекса: ищем доставку в БД."""
     with db_conn() as c, c.cursor() as cur:
         cur.execute(
-            """
-            MERGE dbo.QuizSessions WITH (HOLDLOCK) AS T
-            USING (SELECT ? AS pf, ? AS st, ? AS tot) AS S
-              ON (T.ProcessedFileId = S.pf AND T.StudentId = S.st)
-            WHEN MATCHED AND T.Total <> S.tot THEN
-                 UPDATE SET Total = S.tot
-            WHEN NOT MATCHED THEN
-                 INSERT (ProcessedFileId,StudentId,Total)
-                 VALUES (S.pf,S.st,S.tot);
-            """,
-            pf_id,
-            student,
-            total,
+            "SELECT qd.PendingQuizId, qd.StudentId, pq.ProcessedFileId, pq.Options, pq.Answer "
+            "FROM dbo.QuizDeliveries qd "
+            "JOIN dbo.PendingQuizzes pq ON pq.Id=qd.PendingQuizId "
+            "WHERE qd.PollId=?", poll_id
         )
+        row = cur.fetchone()
+    if not row:
+        return None
+    pid, student, pf_id, opts_json, right = row
+    return PollRecord(pid, student, pf_id, tuple(json.loads(opts_json)), right)
+
+
+def load_live_polls(limit: int, index: int = 0, workers: int = 1) -> int:
+    """Заполняет индекс опросами незавершённых сессий (при старте бота).
+
+    Воркер webhook получает обновления только своих учеников
+    (id % ``workers`` == ``index``, см. webhook.route_key) — чужие опросы
+    ему не нужны.
+    """
+    loaded = 0
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(
+            "SELECT TOP (?) qd.PollId, qd.PendingQuizId, qd.StudentId, "
+            "       pq.ProcessedFileId, pq.Options, pq.Answer "
+            "FROM dbo.QuizSessions s "
+            "JOIN dbo.PendingQuizzes pq ON pq.ProcessedFileId=s.ProcessedFileId "
+            "JOIN dbo.QuizDeliveries qd "
+            "  ON qd.PendingQuizId=pq.Id AND qd.StudentId=s.StudentId "
+            "WHERE s.StartedAt IS NOT NULL AND s.FinishedAt IS NULL "
+            "  AND qd.PollId IS NOT NULL AND s.StudentId % ? = ? "
+            "ORDER BY s.StartedAt",
+            limit, workers, index,
+        )
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            poll_index.update(
+                (poll_id, PollRecord(pid, st, pf, tuple(json.loads(opts)), ans))
+                for poll_id, pid, st, pf, opts, ans in rows
+            )
+            loaded += len(rows)
+    return loaded
+
+
+AnswerRow = Tuple[int, int, int, str, int]   # PendingQuizId, StudentId, ProcessedFileId, ChosenOption, IsCorrect
+Finished = Tuple[int, int, int, int]         # ProcessedFileId, StudentId, Total, Correct
+
+
+def answer_row(rec: PollRecord, sel: int) -> AnswerRow:
+    chosen = rec.options[sel] if 0 <= sel < len(rec.options) else "(none)"
+    return rec.pending_quiz_id, rec.student, rec.pf_id, chosen, int(chosen == rec.answer)
+
+
+# Один раунд-трип на пачку: вставка ответов без дублей (повторный ответ на
+# тот же вопрос игнорируется), инкремент Answered/Correct, отметка о
+# завершении сессии — счётчик, а не COUNT(*) по всей истории ученика —
+# пополнение сводок ученика. Общие строки (файл, день) сюда не входят —
+# их сворачивает fold_stats.
+RECORD_ANSWERS_SQL = """
+SET NOCOUNT ON;
+DECLARE @a TABLE (PendingQuizId INT, StudentId BIGINT, ProcessedFileId INT,
+                  ChosenOption NVARCHAR(200), IsCorrect BIT);
+DECLARE @new TABLE (PendingQuizId INT, StudentId BIGINT, IsCorrect BIT);
+DECLARE @n TABLE (ProcessedFileId INT, StudentId BIGINT, cnt INT, ok INT);
+DECLARE @s TABLE (ProcessedFileId INT, StudentId BIGINT, Total INT, Correct INT,
+                  JustFinished BIT, Seconds INT);
+INSERT INTO @a VALUES {values};
+
+INSERT INTO dbo.QuizResults (PendingQuizId,StudentId,ChosenOption,IsCorrect)
+OUTPUT inserted.PendingQuizId, inserted.StudentId, inserted.IsCorrect INTO @new
+SELECT a.PendingQuizId, a.StudentId, a.ChosenOption, a.IsCorrect
+FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY PendingQuizId, StudentId
+                                   ORDER BY (SELECT NULL)) AS rn
+      FROM @a) a
+WHERE a.rn = 1
+  AND NOT EXISTS (SELECT 1 FROM dbo.QuizResults r WITH (UPDLOCK, HOLDLOCK)
+                  WHERE r.StudentId = a.StudentId
+                    AND r.PendingQuizId = a.PendingQuizId);
+
+INSERT INTO @n
+SELECT a.ProcessedFileId, n.StudentId, COUNT(*), SUM(CAST(n.IsCorrect AS INT))
+FROM @new n
+JOIN (SELECT DISTINCT PendingQuizId, StudentId, ProcessedFileId FROM @a) a
+  ON a.PendingQuizId = n.PendingQuizId AND a.StudentId = n.StudentId
+GROUP BY a.ProcessedFileId, n.StudentId;
+
+UPDATE s
+SET Answered   = s.Answered + n.cnt,
+    Correct    = s.Correct + n.ok,
+    FinishedAt = CASE WHEN s.FinishedAt IS NULL AND s.Answered + n.cnt >= s.Total
+                      THEN SYSUTCDATETIME() ELSE s.FinishedAt END
+OUTPUT inserted.ProcessedFileId, inserted.StudentId, inserted.Total, inserted.Correct,
+       CASE WHEN deleted.FinishedAt IS NULL AND inserted.FinishedAt IS NOT NULL
+            THEN 1 ELSE 0 END,
+       CASE WHEN deleted.FinishedAt IS NULL AND inserted.FinishedAt IS NOT NULL
+            THEN DATEDIFF(second, inserted.StartedAt, inserted.FinishedAt) END
+INTO @s
+FROM dbo.QuizSessions s
+JOIN @n n ON n.ProcessedFileId = s.ProcessedFileId AND n.StudentId = s.StudentId;
+
+""" + ROLLUP_DELTA_SQL + """
+INSERT INTO @d (StudentId, ProcessedFileId, Answers, Correct, Finished, FinishSeconds)
+SELECT n.StudentId, n.ProcessedFileId, n.cnt, n.ok,
+       ISNULL(CAST(s.JustFinished AS INT), 0), ISNULL(s.Seconds, 0)
+FROM @n n
+LEFT JOIN @s s ON s.ProcessedFileId = n.ProcessedFileId AND s.StudentId = n.StudentId;
+""" + APPLY_ROLLUP_SQL + """
+SELECT ProcessedFileId, StudentId, Total, Correct, JustFinished FROM @s;
+"""
+
+
+def record_answers(rows: List[AnswerRow]) -> List[Optional[Finished]]:
+    """Пишет пачку ответов одной транзакцией.
+
+    Возвращает по элементу на строку: данные сессии, если этот ответ её
+    завершил (только для последнего ответа сессии в пачке), иначе None.
+    """
+    finished: Dict[Tuple[int, int], Finished] = {}
+    with db_conn() as c, c.cursor() as cur:
+        for part in chunked(rows, 400):   # 5 параметров × 400 < 2100
+            cur.execute(
+                RECORD_ANSWERS_SQL.format(values=",".join(["(?,?,?,?,?)"] * len(part))),
+                *(x for r in part for x in r),
+            )
+            for pf, st, total, correct, just_finished in cur.fetchall():
+                if just_finished:
+                    finished[(pf, st)] = (pf, st, total, correct)
         c.commit()
 
+    out: List[Optional[Finished]] = [None] * len(rows)
+    for i in range(len(rows) - 1, -1, -1):
+        key = (rows[i][2], rows[i][1])
+        if key in finished:
+            out[i] = finished.pop(key)
+    return out
+
+
+# опрос не дошёл до ученика: вопрос исключается из сессии (Total и срок
+# меньше); если остальные уже отвечены — сессия завершается здесь же
+EXCLUDE_QUESTIONS_SQL = """
+SET NOCOUNT ON;
+DECLARE @pf INT = ?, @st BIGINT = ?, @n INT = ?;
+DECLARE @s TABLE (Total INT, Correct INT, JustFinished BIT, Seconds INT);
+UPDATE dbo.QuizSessions
+SET Total      = Total - @n,
+    DeadlineAt = DATEADD(minute, -@n, DeadlineAt),
+    FinishedAt = CASE WHEN Answered >= Total - @n THEN SYSUTCDATETIME() END
+OUTPUT inserted.Total, inserted.Correct,
+       CASE WHEN inserted.FinishedAt IS NOT NULL THEN 1 ELSE 0 END,
+       DATEDIFF(second, inserted.StartedAt, inserted.FinishedAt)
+INTO @s
+WHERE ProcessedFileId = @pf AND StudentId = @st AND FinishedAt IS NULL;
+""" + ROLLUP_DELTA_SQL + """
+INSERT INTO @d (StudentId, ProcessedFileId, Finished, FinishSeconds)
+SELECT @st, @pf, 1, ISNULL(Seconds, 0) FROM @s WHERE JustFinished = 1;
+""" + APPLY_ROLLUP_SQL + """
+SELECT Total, Correct, JustFinished FROM @s;
+"""
+
+
+def exclude_questions(pf_id: int, student: int, n: int) -> Optional[Finished]:
+    """Убирает ``n`` неотправленных вопросов из сессии; итог, если она завершилась."""
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(EXCLUDE_QUESTIONS_SQL, pf_id, student, n)
+        row = cur.fetchone()
+        c.commit()
+    if row and row[2]:
+        return pf_id, student, row[0], row[1]
+    return None
+
 
 # ─────────── handlers ───────────
+def import_report(fname: str, imported: int, problems: List[str]) -> str:
+    text = f"Импортировано из «{os.path.splitext(fname)[0]}»: {imported} вопросов."
+    if problems:
+        text += f"\nПропущено {len(problems)}:\n" + "\n".join(problems[:10])
+        if len(problems) > 10:
+            text += f"\n… и ещё {len(problems) - 10}"
+    return text
+
+
+@timed_handler("cmd_sync")
 async def cmd_sync(update: Optional[Update], ctx: ContextTypes.DEFAULT_TYPE):
-    rows = get_recent_processedfiles()
+    # файлы, предложение по которым так и не дошло до админа
+    await maybe_prompt_send(ctx, await db_run(unprompted_files))
+
+    rows = await db_run(get_recent_processedfiles)
     if not rows:
         await ctx.bot.send_message(ADMIN_CHAT_ID, "ℹ️ Новых викторин нет.")
         return
 
+    # все файлы — одной транзакцией; в памяти кусок JSON и пачка строк
+    report = await db_run(insert_pending, [pf_id for pf_id, _ in rows])
+
     grand_total = 0
-    for pf_id, fname, quiz_json in rows:
-        imported = insert_pending(pf_id, quiz_json)
+    for pf_id, fname in rows:
+        imported, problems = report[pf_id]
         grand_total += imported
         await ctx.bot.send_message(
-            ADMIN_CHAT_ID,
-            f"Импортировано из «{os.path.splitext(fname)[0]}»: {imported} вопросов.",
+            ADMIN_CHAT_ID, import_report(fname, imported, problems)
         )
 
     if grand_total:
         await send_pending_questions(ctx)
 
 
-async def send_pending_questions(ctx: ContextTypes.DEFAULT_TYPE):
+def pending_questions() -> List[Tuple[int, int, str, str, list, str]]:
+    """Неодобренные вопросы вместе с именем файла — одним запросом."""
     with db_conn() as c, c.cursor() as cur:
         cur.execute(
-            "SELECT Id,ProcessedFileId,Question,Options,Answer "
-            "FROM dbo.PendingQuizzes WHERE Approved IS NULL"
+            "SELECT pq.Id, pq.ProcessedFileId, pf.FileName, "
+            "       pq.Question, pq.Options, pq.Answer "
+            "FROM dbo.PendingQuizzes pq "
+            "LEFT JOIN dbo.ProcessedFiles pf ON pf.Id = pq.ProcessedFileId "
+            "WHERE pq.Approved IS NULL "
+            "ORDER BY pq.ProcessedFileId, pq.Id"
         )
         rows = cur.fetchall()
+    out = []
+    for qid, pf, fname, qtext, opts_json, ans in rows:
+        if fname:
+            _titles.setdefault(pf, os.path.splitext(fname)[0])
+        out.append((qid, pf, _titles.get(pf, f"Файл {pf}"), qtext, json.loads(opts_json), ans))
+    return out
+
+
+def digest_pages(questions) -> List[Tuple[str, List[Tuple[int, int]]]]:
+    """Режет вопросы файла на страницы: (HTML-текст, [(номер, qid)])."""
+    pages, blocks, ids, size = [], [], [], 0
+    fname = questions[0][2]
+    for n, (qid, _pf, _fn, qtext, opts, ans) in enumerate(questions, 1):
+        block = (
+            f"<b>{n}.</b> {html.escape(qtext)}\n"
+            + "\n".join(f"   {i + 1}) {html.escape(o)}" for i, o in enumerate(opts))
+            + f"\n   <b>Ответ:</b> {html.escape(ans)}"
+        )
+        if blocks and (len(blocks) >= DIGEST_PAGE_SIZE or size + len(block) > 3500):
+            pages.append((blocks, ids))
+            blocks, ids, size = [], [], 0
+        blocks.append(block)
+        ids.append((n, qid))
+        size += len(block) + 2
+    pages.append((blocks, ids))
+
+    total = len(questions)
+    return [
+        (
+            f"<i>«{html.escape(fname)}»</i> — вопросы "
+            f"{ids[0][0]}–{ids[-1][0]} из {total}\n\n" + "\n\n".join(blocks),
+            ids,
+        )
+        for blocks, ids in pages
+    ]
+
+
+def digest_keyboard(ids: List[Tuple[int, int]], states: Optional[Dict[int, bool]] = None):
+    states = states or {}
+    toggles = [
+        InlineKeyboardButton(f"{n} {'✅' if states.get(qid, True) else '❌'}",
+                             callback_data=f"dt:{qid}")
+        for n, qid in ids
+    ]
+    rows = [toggles[i:i + 5] for i in range(0, len(toggles), 5)]
+    rows.append([InlineKeyboardButton("💾 Применить", callback_data="dp"),
+                 InlineKeyboardButton("✅ Все", callback_data="dA")])
+    return InlineKeyboardMarkup(rows)
+
+
+def keyboard_states(markup) -> Tuple[List[Tuple[int, int]], Dict[int, bool]]:
+    """Состояние переключателей берём из самой клавиатуры — без хранения."""
+    ids, states = [], {}
+    for row in markup.inline_keyboard:
+        for b in row:
+            if b.callback_data and b.callback_data.startswith("dt:"):
+                qid = int(b.callback_data[3:])
+                ids.append((int(b.text.split()[0]), qid))
+                states[qid] = b.text.endswith("✅")
+    return ids, states
+
+
+def apply_approvals(states: Dict[int, bool]) -> List[int]:
+    """Одним UPDATE проставляет Approved; возвращает затронутые файлы."""
+    items = list(states.items())
+    files = set()
+    with db_conn() as c, c.cursor() as cur:
+        for part in chunked(items, 1000):
+            cur.execute(
+                "UPDATE pq SET Approved = v.a "
+                "OUTPUT inserted.ProcessedFileId "
+                "FROM dbo.PendingQuizzes pq "
+                f"JOIN (VALUES {','.join(['(?,?)'] * len(part))}) AS v(Id, a) "
+                "  ON v.Id = pq.Id "
+                "WHERE pq.Approved IS NULL",
+                *(x for qid, ok in part for x in (qid, int(ok))),
+            )
+            files.update(r[0] for r in cur.fetchall())
+        c.commit()
+    return sorted(files)
+
+
+def set_approval(qid: int, approved: bool) -> Optional[int]:
+    """Проставляет Approved одному вопросу; возвращает его файл."""
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(
+            "UPDATE dbo.PendingQuizzes SET Approved=? "
+            "OUTPUT inserted.ProcessedFileId WHERE Id=?",
+            int(approved), qid,
+        )
+        row = cur.fetchone()
+        c.commit()
+    return row[0] if row else None
+
+
+# проверка только по одному файлу (индекс IX_PendingQuizzes_File_Approved);
+# UPDLOCK+HOLDLOCK сериализует одновременные клики, и Prompted=1 ставит
+# ровно одна транзакция — предложение разослать уходит один раз
+CLAIM_PROMPT_SQL = """
+SET NOCOUNT ON;
+DECLARE @total INT, @ok INT, @pend INT, @claimed INT = 0;
+SELECT @total = COUNT(*),
+       @ok    = SUM(CASE WHEN Approved = 1 THEN 1 ELSE 0 END),
+       @pend  = SUM(CASE WHEN Approved IS NULL THEN 1 ELSE 0 END)
+FROM dbo.PendingQuizzes WITH (UPDLOCK, HOLDLOCK)
+WHERE ProcessedFileId = ?;
+IF @pend = 0 AND @ok > 0
+BEGIN
+    UPDATE dbo.PendingQuizzes SET Prompted = 1
+    WHERE ProcessedFileId = ? AND Prompted = 0;
+    SET @claimed = @@ROWCOUNT;
+END
+SELECT @claimed, @ok, @total;
+"""
+
+
+def claim_prompt(pf_id: int) -> Optional[Tuple[int, int]]:
+    """(одобрено, всего), если файл только что полностью отмодерирован."""
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(CLAIM_PROMPT_SQL, pf_id, pf_id)
+        claimed, ok, total = cur.fetchone()
+        c.commit()
+    return (ok, total) if claimed else None
+
+
+def unprompted_files() -> List[int]:
+    """Отмодерированные файлы с одобренными вопросами, по которым Prompted=0."""
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute("""
+            SELECT ProcessedFileId
+            FROM dbo.PendingQuizzes
+            GROUP BY ProcessedFileId
+            HAVING SUM(CASE WHEN Approved IS NULL THEN 1 ELSE 0 END) = 0
+               AND SUM(CASE WHEN Approved = 1 THEN 1 ELSE 0 END) > 0
+               AND MAX(CAST(Prompted AS INT)) = 0
+        """)
+        return [r[0] for r in cur.fetchall()]
+
+
+async def send_pending_questions(ctx: ContextTypes.DEFAULT_TYPE):
+    rows = await db_run(pending_questions)
 
     if not rows:
-        await maybe_prompt_send(ctx)
         return
 
-    for qid, pf, qtext, opts_json, ans in rows:
-        opts = json.loads(opts_json)
-        fname = file_title(pf)
+    bc = broadcaster(ctx)
+    if MODERATION_DIGEST:
+        by_file: Dict[int, list] = {}
+        for r in rows:
+            by_file.setdefault(r[1], []).append(r)
+        for questions in by_file.values():
+            for text, ids in digest_pages(questions):
+                await bc.send(
+                    ADMIN_CHAT_ID, text, parse_mode="HTML",
+                    reply_markup=digest_keyboard(ids),
+                )
+        return
+
+    for qid, pf, fname, qtext, opts, ans in rows:
         txt = (
             f"<i>«{fname}»</i>\n<b>Вопрос:</b> {qtext}\n\n"
             + "\n".join(f"{i+1}. {o}" for i, o in enumerate(opts))
@@ -167,292 +715,429 @@ async def send_pending_questions(ctx: ContextTypes.DEFAULT_TYPE):
             [[InlineKeyboardButton("✅", callback_data=f"a:{qid}"),
               InlineKeyboardButton("❌", callback_data=f"r:{qid}")]]
         )
-        await ctx.bot.send_message(
-            ADMIN_CHAT_ID, txt, parse_mode="HTML", reply_markup=kb
-        )
+        await bc.send(ADMIN_CHAT_ID, txt, parse_mode="HTML", reply_markup=kb)
+
+
+@timed_handler("cb_digest_toggle")
+async def cb_digest_toggle(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    qid = int(q.data.split(":")[1])
+    ids, states = keyboard_states(q.message.reply_markup)
+    states[qid] = not states.get(qid, True)
+    await q.edit_message_reply_markup(digest_keyboard(ids, states))
+
+
+@timed_handler("cb_digest_apply")
+async def cb_digest_apply(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    _ids, states = keyboard_states(q.message.reply_markup)
+    if q.data == "dA":
+        states = dict.fromkeys(states, True)
 
+    files = await db_run(apply_approvals, states)
 
+    ok = sum(states.values())
+    await q.edit_message_text(
+        q.message.text_html
+        + f"\n\n<b>Итог:</b> ✅ {ok}, ❌ {len(states) - ok}",
+        parse_mode="HTML",
+    )
+    await maybe_prompt_send(ctx, files)
+
+
+@timed_handler("cb_approve")
 async def cb_approve(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     act, qid = q.data.split(":")
 
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "UPDATE dbo.PendingQuizzes SET Approved=? WHERE Id=?",
-            1 if act == "a" else 0,
-            int(qid),
-        )
-        c.commit()
+    pf = await db_run(set_approval, int(qid), act == "a")
 
     await q.edit_message_reply_markup(None)
     await q.edit_message_text(
         q.message.text + f"\nСтатус: {'✅' if act == 'a' else '❌'}"
     )
-    await maybe_prompt_send(ctx)
+    if pf is not None:
+        await maybe_prompt_send(ctx, [pf])
 
 
-async def maybe_prompt_send(ctx: ContextTypes.DEFAULT_TYPE):
-    sql = """
-        SELECT ProcessedFileId,
-               COUNT(*) total,
-               SUM(CASE WHEN Approved=1 THEN 1 END) ok,
-               SUM(CASE WHEN Approved IS NULL THEN 1 ELSE 0 END) pend,
-               MIN(CAST(Prompted AS INT)) prm
-        FROM dbo.PendingQuizzes
-        GROUP BY ProcessedFileId
-        HAVING SUM(CASE WHEN Approved IS NULL THEN 1 ELSE 0 END)=0
+async def maybe_prompt_send(ctx: ContextTypes.DEFAULT_TYPE, pf_ids: Sequence[int],
+                            attempt: int = 0):
+    """Предлагает разослать файлы из ``pf_ids``, модерация которых завершена.
+
+    Если сообщение не ушло, отметка снимается и попытка повторяется задачей
+    JobQueue; после PROMPT_RETRY_ATTEMPTS файл подберёт следующий /sync.
     """
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(sql)
-        for pf, total, ok, _pend, prm in cur.fetchall():
-            if ok == 0 or prm:
-                continue
-            fname = file_title(pf)
-            kb = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("➡️ Разослать", callback_data=f"send:{pf}")]]
-            )
+    for pf in pf_ids:
+        claimed = await db_run(claim_prompt, pf)
+        if claimed is None:
+            continue
+        ok, total = claimed
+        fname = await title_of(pf)
+        kb = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("➡️ Разослать", callback_data=f"send:{pf}")]]
+        )
+        try:
             await ctx.bot.send_message(
                 ADMIN_CHAT_ID,
                 f"Все вопросы файла «{fname}» одобрены ({ok}/{total}). "
                 "Разослать ученикам?",
                 reply_markup=kb,
             )
-            cur.execute(
-                "UPDATE dbo.PendingQuizzes SET Prompted=1 WHERE ProcessedFileId=?", pf
+        except TelegramError as e:
+            await db_execute(
+                "UPDATE dbo.PendingQuizzes SET Prompted=0 WHERE ProcessedFileId=?", pf
             )
-            c.commit()
+            if attempt < PROMPT_RETRY_ATTEMPTS:
+                delay = PROMPT_RETRY_SECONDS * 2 ** attempt
+                logger.warning("Send prompt for file %s failed (%s), retry in %.0f s",
+                               pf, e, delay)
+                ctx.job_queue.run_once(retry_prompt, delay, data=(pf, attempt + 1))
+            else:
+                logger.error("Send prompt for file %s failed (%s), left for /sync", pf, e)
+
+
+async def retry_prompt(ctx: ContextTypes.DEFAULT_TYPE):
+    pf, attempt = ctx.job.data
+    await maybe_prompt_send(ctx, [pf], attempt)
+
+
+def broadcaster(ctx: ContextTypes.DEFAULT_TYPE) -> Broadcaster:
+    bd = ctx.application.bot_data
+    if "broadcaster" not in bd:
+        # общий лимит бота держит HTTP-слой (send_limiter в build_application)
+        # для всех отправок сразу; здесь — лимиты чатов и повторы
+        bd["broadcaster"] = Broadcaster(
+            ctx.bot,
+            global_rate=0 if "send_limiter" in bd else BROADCAST_RATE,
+            concurrency=setting("BROADCAST_CONCURRENCY", 20, int),
+            max_attempts=setting("BROADCAST_ATTEMPTS", 4, int),
+        )
+    return bd["broadcaster"]
 
 
+@timed_handler("cb_send_student")
 async def cb_send_student(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     pf_id = int(q.data.split(":")[1])
-    fname = file_title(pf_id)
+    fname = await title_of(pf_id)
 
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "SELECT Id FROM dbo.PendingQuizzes "
-            "WHERE ProcessedFileId=? AND Approved=1",
-            pf_id,
-        )
-        pq_ids = [r[0] for r in cur.fetchall()]
-        total_questions = len(pq_ids)
+    total_questions, students = await db_run(create_deliveries, pf_id)
 
-        students = active_students()
-        deliveries = [(pid, sid) for pid in pq_ids for sid in students]
-        cur.executemany(
-            "INSERT INTO dbo.QuizDeliveries (PendingQuizId,StudentId) VALUES (?,?)",
-            deliveries,
-        )
-        c.commit()
+    await q.edit_message_reply_markup(None)
+    await q.edit_message_text(f"Рассылка анонса «{fname}»: 0/{len(students)}…")
+    # рассылка может идти минуты — не держим обработку апдейтов
+    ctx.application.create_task(
+        announce_test(ctx, q, pf_id, fname, total_questions, students)
+    )
 
-    for sid in students:
-        await ctx.bot.send_message(
-            sid,
-            f"🔥 Новый тест «{fname}» на {total_questions} вопрос(а/ов). "
-            f"У вас будет {total_questions} минут.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🚀 Я готов!", callback_data=f"start:{pf_id}")]]
-            ),
+
+async def announce_test(ctx, q, pf_id: int, fname: str, total_questions: int,
+                        students: List[int]):
+    async def progress(rep: BroadcastReport):
+        await q.edit_message_text(
+            f"Рассылка анонса «{fname}»: {rep.sent + rep.failed}/{rep.total}…"
         )
 
-    await q.edit_message_reply_markup(None)
+    report = await broadcaster(ctx).broadcast(
+        students,
+        f"🔥 Новый тест «{fname}» на {total_questions} вопрос(а/ов). "
+        f"У вас будет {total_questions} минут.",
+        reply_markup=InlineKeyboardMarkup(
+            [[InlineKeyboardButton("🚀 Я готов!", callback_data=f"start:{pf_id}")]]
+        ),
+        on_delivered=lambda ids: db_run(mark_announced, pf_id, ids),
+        on_progress=progress,
+    )
+    if report.failures:
+        logger.warning("Announce %s failed for %s chats, e.g. %s",
+                       pf_id, len(report.failures), report.failure_sample())
+
     await q.edit_message_text("Анонсы отправлены учащимся.")
+    await ctx.bot.send_message(
+        ADMIN_CHAT_ID, f"📣 Анонс «{fname}»: {report.summary()}."
+    )
 
 
+async def dispatch_polls(ctx: ContextTypes.DEFAULT_TYPE, student: int,
+                         polls: List[Tuple[int, str, list, int]],
+                         on_sent: Callable[[int, str], None]) -> List[int]:
+    """Отправляет опросы по порядку вопросов; возвращает неотправленные PendingQuizId.
+
+    Следующий опрос уходит только после ответа Telegram на предыдущий, так
+    что порядок в чате совпадает с порядком вопросов при любых повторах
+    внутри ``bc.call``. Параллельно с отправкой идёт только работа с БД:
+    PollId пишутся пачками по POLL_SAVE_BATCH в фоне. ``on_sent(pid, poll_id)``
+    вызывается сразу после отправки — ответ на опрос принимается, не дожидаясь
+    записи. Опрос, который не удалось отправить и после повторов, пропускается.
+    """
+    bc = broadcaster(ctx)
+    saves, pending, failed = [], [], []
+    for pid, qtext, opts, correct_idx in polls:
+        try:
+            msg = await bc.call(
+                student,
+                ctx.bot.send_poll,
+                qtext,
+                opts,
+                type="quiz",
+                correct_option_id=correct_idx,
+                is_anonymous=False,
+                chat_limit=False,
+            )
+        except TelegramError:
+            logger.exception("Poll for question %s to %s failed", pid, student)
+            failed.append(pid)
+            continue
+        on_sent(pid, msg.poll.id)
+        pending.append((pid, msg.poll.id))
+        if len(pending) >= POLL_SAVE_BATCH:
+            saves.append(asyncio.ensure_future(db_run(save_poll_ids, student, pending)))
+            pending = []
+    if pending:
+        saves.append(asyncio.ensure_future(db_run(save_poll_ids, student, pending)))
+    await asyncio.gather(*saves)
+    return failed
+
+
+@timed_handler("cb_start_test")
 async def cb_start_test(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     pf_id = int(q.data.split(":")[1])
     student = q.from_user.id
-    fname = file_title(pf_id)
+    fname = await title_of(pf_id)
 
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "SELECT COUNT(*) FROM dbo.PendingQuizzes "
-            "WHERE ProcessedFileId=? AND Approved=1",
-            pf_id,
-        )
-        total = cur.fetchone()[0]
-        create_session(pf_id, student, total)
-        cur.execute(
-            "UPDATE dbo.QuizSessions SET StartedAt=SYSUTCDATETIME() "
-            "WHERE ProcessedFileId=? AND StudentId=?", pf_id, student
-        )
-        cur.execute(
-            "UPDATE dbo.QuizDeliveries SET Started=1 "
-            "WHERE StudentId=? AND PendingQuizId IN "
-            "(SELECT Id FROM dbo.PendingQuizzes WHERE ProcessedFileId=?)",
-            student, pf_id
-        )
-        c.commit()
+    polls = await db_run(start_session, pf_id, student)
+    total = len(polls)
 
     await q.edit_message_reply_markup(None)
     await q.edit_message_text(
         f"Начинаем тест «{fname}»! У вас {total} минут."
     )
 
-    # отправляем Poll-ы
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "SELECT Id,Question,Options,Answer FROM dbo.PendingQuizzes "
-            "WHERE ProcessedFileId=? AND Approved=1",
-            pf_id,
-        )
-        pending = cur.fetchall()
-
-        for pid, qtext, opts_json, ans in pending:
-            opts = json.loads(opts_json)
-            try:
-                correct_idx = opts.index(ans)
-            except ValueError:
-                logger.error(
-                    "File #%s, question id %s: answer not found in options", pf_id, pid
-                )
-                continue
+    # отправляем Poll-ы по одному; соединение с БД не держим во время I/O
+    records = {
+        pid: PollRecord(pid, student, pf_id, tuple(opts), opts[idx])
+        for pid, _qtext, opts, idx in polls
+    }
+    failed = await dispatch_polls(
+        ctx, student, polls, lambda pid, poll_id: poll_index.put(poll_id, records[pid])
+    )
+    if failed:
+        # неотправленные вопросы не входят в Total — иначе тест не завершить
+        await notify_finished(ctx, await db_run(exclude_questions, pf_id, student, len(failed)))
+
+
+async def sweep_sessions(ctx: ContextTypes.DEFAULT_TYPE):
+    """Закрывает просроченные сессии и рассылает уведомления."""
+    while True:
+        rows = await db_run(expire_overdue, SESSION_SWEEP_BATCH)
+        by_file: Dict[int, list] = {}
+        for pf, st, total, correct, name in rows:
+            by_file.setdefault(pf, []).append((st, total, correct, name))
+        for pf, expired in by_file.items():
+            ctx.application.create_task(notify_timed_out(ctx, pf, expired))
+        if len(rows) < SESSION_SWEEP_BATCH:
+            return
 
-            poll = await ctx.bot.send_poll(
-                student,
-                qtext,
-                opts,
-                type="quiz",
-                correct_option_id=correct_idx,
-                is_anonymous=False,
-            )
-            cur.execute(
-                "UPDATE dbo.QuizDeliveries SET PollId=? "
-                "WHERE PendingQuizId=? AND StudentId=?",
-                poll.poll.id, pid, student
-            )
-        c.commit()
 
-    timeout_sec = total * 60
-    ctx.job_queue.run_once(
-        timeout_session,
-        timeout_sec,
-        data={"pf_id": pf_id, "student": student},
-        name=f"to_{pf_id}_{student}",
-    )
+async def fold_stats(ctx: ContextTypes.DEFAULT_TYPE):
+    """Сворачивает FileStats и QuizStatsDaily из построчных данных."""
+    files, days = await db_run(fold_rollups)
+    if files or days:
+        logger.debug("Rollups folded: %s files, %s days", files, days)
 
 
-async def timeout_session(ctx: ContextTypes.DEFAULT_TYPE):
-    pf_id = ctx.job.data["pf_id"]
-    student = ctx.job.data["student"]
-    fname = file_title(pf_id)
+async def notify_timed_out(ctx: ContextTypes.DEFAULT_TYPE, pf_id: int, expired: list):
+    fname = await title_of(pf_id)
+    bc = broadcaster(ctx)
+    report = await bc.broadcast(
+        [st for st, *_ in expired],
+        f"⏰ Время вышло! Тест «{fname}» не завершён.",
+    )
+    if report.failed:
+        logger.warning("Timeout notices for file #%s: %s", pf_id, report.summary())
 
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "SELECT Total,Correct,FinishedAt FROM dbo.QuizSessions "
-            "WHERE ProcessedFileId=? AND StudentId=?", pf_id, student
-        )
-        total, correct, fin = cur.fetchone()
-        if fin:
-            return
-        cur.execute(
-            "UPDATE dbo.QuizSessions "
-            "SET FinishedAt=SYSUTCDATETIME(), TimedOut=1 "
-            "WHERE ProcessedFileId=? AND StudentId=?", pf_id, student
+    # администратору — сводка по файлу вместо сообщения на каждого ученика
+    lines = [f"{name}: {correct}/{total}" for _st, total, correct, name in expired]
+    for part in chunked(lines, 50):
+        await bc.send(
+            ADMIN_CHAT_ID,
+            f"Не успели пройти тест «{fname}» ({len(expired)}):\n" + "\n".join(part),
         )
-        c.commit()
 
+
+async def notify_finished(ctx: ContextTypes.DEFAULT_TYPE, res: Optional[Finished]):
+    if res is None:
+        return
+    pf_id, student, total, now_correct = res
+    fname = await title_of(pf_id)
     await ctx.bot.send_message(
-        student, f"⏰ Время вышло! Тест «{fname}» не завершён."
+        student,
+        f"✅ Вы завершили тест «{fname}»! Результат: {now_correct}/{total}.",
     )
     await ctx.bot.send_message(
         ADMIN_CHAT_ID,
-        f"Ученик {student_name(student)} не успел пройти тест «{fname}». "
-        f"Результат {correct}/{total}.",
+        f"Ученик {await db_run(student_name, student)}: {now_correct}/{total} "
+        f"по тесту «{fname}».",
     )
 
 
+async def notify_when_written(ctx: ContextTypes.DEFAULT_TYPE, fut: asyncio.Future):
+    try:
+        res = await fut
+    except Exception:  # noqa: BLE001 — уже залогировано в WriteBehind
+        return
+    await notify_finished(ctx, res)
+
+
+@timed_handler("handle_poll")
 async def handle_poll(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ans = update.poll_answer
     sel = ans.option_ids[0] if ans.option_ids else -1
 
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(
-            "SELECT qd.PendingQuizId, qd.StudentId, pq.Options, pq.Answer, pq.ProcessedFileId "
-            "FROM dbo.QuizDeliveries qd "
-            "JOIN dbo.PendingQuizzes pq ON pq.Id=qd.PendingQuizId "
-            "WHERE qd.PollId=?", ans.poll_id
-        )
-        row = cur.fetchone()
-        if not row:
+    rec = poll_index.get(ans.poll_id)
+    if rec is None:
+        rec = await db_run(lookup_poll, ans.poll_id)
+        if rec is None:
             return
+        poll_index.put(ans.poll_id, rec)
+
+    row = answer_row(rec, sel)
+    writer: Optional[WriteBehind] = ctx.application.bot_data.get("answer_writer")
+    if writer is None:
+        # ANSWER_WRITE_MODE=sync: своя транзакция на каждый ответ
+        res = (await db_run(record_answers, [row]))[0]
+        await notify_finished(ctx, res)
+        return
 
-        pid, student, opts_json, right, pf_id = row
-        opts = json.loads(opts_json)
-        chosen = opts[sel] if 0 <= sel < len(opts) else "(none)"
-        is_correct = int(chosen == right)
+    fut = await writer.submit(row)
+    if ANSWER_WRITE_MODE == "group":
+        # ждём коммита пачки: ответ надёжно записан, когда хендлер вернулся
+        await notify_finished(ctx, await fut)
+    else:
+        # async: хендлер не ждёт записи, итог сообщим после сброса пачки
+        ctx.application.create_task(notify_when_written(ctx, fut))
 
-        cur.execute(
-            "INSERT INTO dbo.QuizResults "
-            "(PendingQuizId,StudentId,ChosenOption,IsCorrect) "
-            "VALUES (?,?,?,?)",
-            pid, student, chosen, is_correct
-        )
-        cur.execute(
-            "UPDATE dbo.QuizSessions SET Correct=Correct+? "
-            "WHERE ProcessedFileId=? AND StudentId=?", is_correct, pf_id, student
-        )
 
-        cur.execute(
-            "SELECT Total,Correct FROM dbo.QuizSessions "
-            "WHERE ProcessedFileId=? AND StudentId=?", pf_id, student
-        )
-        total, now_correct = cur.fetchone()
+async def on_startup(app: Application):
+    """post_init: фоновые службы процесса бота.
 
-        cur.execute(
-            "SELECT COUNT(*) FROM dbo.QuizResults "
-            "WHERE StudentId=? "
-            "  AND PendingQuizId IN "
-            "      (SELECT Id FROM dbo.PendingQuizzes WHERE ProcessedFileId=?)",
-            student, pf_id
-        )
-        answered = cur.fetchone()[0]
+    Следит за задержкой event loop, поднимает сервер метрик и отладки
+    (common.debugserver) и, если ответы пишутся не синхронно, запускает
+    WriteBehind.
+    """
+    app.bot_data["loop_lag"] = asyncio.create_task(watch_loop_lag())
+    # у каждого воркера webhook свой порт: BOT_METRICS_PORT + индекс
+    app.bot_data["debug_server"] = await start_debug_server(app.bot_data.get("index", 0))
+    if ANSWER_WRITE_MODE == "sync":
+        return
+    writer = WriteBehind(
+        lambda rows: db_run(record_answers, rows),
+        max_rows=setting("ANSWER_BATCH_ROWS", 200, int),
+        max_delay=setting("ANSWER_FLUSH_MS", 20, float) / 1000,
+        max_queue=setting("ANSWER_QUEUE_SIZE", 10000, int),
+    )
+    writer.start()
+    app.bot_data["answer_writer"] = writer
 
-        fname = file_title(pf_id)
 
-        if answered == total:
-            cur.execute(
-                "UPDATE dbo.QuizSessions "
-                "SET FinishedAt=SYSUTCDATETIME() "
-                "WHERE ProcessedFileId=? AND StudentId=?", pf_id, student
-            )
-            c.commit()
-            await ctx.bot.send_message(
-                student,
-                f"✅ Вы завершили тест «{fname}»! Результат: {now_correct}/{total}.",
-            )
-            await ctx.bot.send_message(
-                ADMIN_CHAT_ID,
-                f"Ученик {student_name(student)}: {now_correct}/{total} "
-                f"по тесту «{fname}».",
-            )
-        else:
-            c.commit()
+async def on_shutdown(app: Application):
+    """post_stop: останавливает службы из ``on_startup``, дописывает ответы."""
+    lag = app.bot_data.pop("loop_lag", None)
+    if lag is not None:
+        lag.cancel()
+    server = app.bot_data.pop("debug_server", None)
+    if server is not None:
+        await server.cleanup()
+    writer = app.bot_data.pop("answer_writer", None)
+    if writer is not None:
+        await writer.stop()
+        logger.info("Answer writer flushed: %s", writer.stats())
 
 
-def run_bot():
-    ensure_schema()
-    req = HTTPXRequest(
-        connect_timeout=20, read_timeout=40, write_timeout=20, pool_timeout=20
+async def prune_pool(ctx: ContextTypes.DEFAULT_TYPE):
+    # закрываем соединения, простаивающие дольше DB_POOL_IDLE_TIMEOUT
+    await db_run(pool.prune)
+
+
+def build_application(jobs: bool = True, processes: int = 1, index: int = 0,
+                      rate_state=None) -> Application:
+    """Собирает Application со всеми хендлерами.
+
+    ``jobs=False`` — без периодических задач (синхронизация, обход сессий,
+    свёртка сводок): в режиме webhook их выполняет только один из воркеров.
+    ``index`` — номер этого процесса (сдвиг порта метрик).
+
+    Лимит отправки BROADCAST_RATE общий на бота: ``rate_state`` — общая
+    память SharedTokenBucket от webhook.serve, все воркеры берут токены из
+    одного bucket'а. Воркер, запущенный сам по себе, общей памяти не имеет —
+    ему достаётся доля BROADCAST_RATE / ``processes``.
+    """
+    if rate_state is not None:
+        limiter = SharedTokenBucket(rate_state, BROADCAST_RATE)
+    else:
+        limiter = TokenBucket(BROADCAST_RATE / max(1, processes))
+    req = MeteredRequest(
+        connection_pool_size=setting("TG_POOL_SIZE", 32, int),
+        connect_timeout=20, read_timeout=40, write_timeout=20, pool_timeout=20,
+        limiter=limiter,
+    )
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(req)
+        # параллельно до UPDATE_CONCURRENCY обновлений, по порядку в пределах
+        # пользователя: долгий cb_start_test не задерживает чужие ответы
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_stop(on_shutdown)
     )
-    app = Application.builder().token(BOT_TOKEN).request(req).build()
+    # свой сервер Bot API (local bot-api server или нагрузочный стенд)
+    base_url = setting("TG_BASE_URL")
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    app.bot_data["index"] = index
+    app.bot_data["send_limiter"] = limiter
 
     app.add_handler(CommandHandler("sync", cmd_sync, block=False))
     app.add_handler(CallbackQueryHandler(cb_approve, pattern="^[ar]:"))
+    app.add_handler(CallbackQueryHandler(cb_digest_toggle, pattern="^dt:"))
+    app.add_handler(CallbackQueryHandler(cb_digest_apply, pattern="^d[pA]$"))
     app.add_handler(CallbackQueryHandler(cb_send_student, pattern="^send:"))
     app.add_handler(CallbackQueryHandler(cb_start_test, pattern="^start:"))
     app.add_handler(PollAnswerHandler(handle_poll))
 
-    app.job_queue.run_repeating(
-        lambda ctx: ctx.application.create_task(cmd_sync(None, ctx)),
-        interval=21600,
-        first=21600,
-    )
+    app.job_queue.run_repeating(prune_pool, interval=60, first=60)
+    if jobs:
+        app.job_queue.run_repeating(
+            lambda ctx: ctx.application.create_task(cmd_sync(None, ctx)),
+            interval=21600,
+            first=21600,
+        )
+        app.job_queue.run_repeating(
+            sweep_sessions, interval=SESSION_SWEEP_SECONDS, first=5
+        )
+        app.job_queue.run_repeating(
+            fold_stats, interval=ROLLUP_FOLD_SECONDS, first=ROLLUP_FOLD_SECONDS
+        )
+    return app
+
+
+def prepare(index: int = 0, workers: int = 1) -> None:
+    """Общая подготовка процесса бота: схема БД и прогрев индекса опросов."""
+    ensure_schema()
+    logger.info("Poll index: %s live polls loaded",
+                load_live_polls(poll_index.capacity, index, workers))
+
 
+def run_bot():
+    prepare()
+    app = build_application()
     logger.info("Bot started")
     app.run_polling()
-
@@ -0,0 +1,49 @@
+import json, time
+
+from telegram.request import HTTPXRequest
+
+from common.metrics import TG_ERRORS, TG_RETRY_AFTER, TG_SECONDS
+
+# методы, которые расходуют общий лимит бота на отправку (~30 сообщ./с)
+LIMITED_METHODS = ("send", "copyMessage", "forwardMessage")
+
+
+def _retry_after(payload: bytes) -> float:
+    try:
+        return float(json.loads(payload)["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, который считает время, ошибки и 429 по методу Bot API.
+
+    ``limiter`` (``TokenBucket``/``SharedTokenBucket``) — общий лимит бота:
+    каждый ``send*``/copy/forward ждёт токен, кто бы его ни отправлял —
+    рассылка, опросы, уведомления. Ответ 429 приостанавливает limiter на
+    ``retry_after``.
+    """
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1]
+        if self.limiter is not None and api.startswith(LIMITED_METHODS):
+            await self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            TG_ERRORS.inc(api, type(e).__name__)
+            raise
+        finally:
+            TG_SECONDS.observe(time.perf_counter() - start, api)
+        if code == 429:
+            TG_RETRY_AFTER.inc(api)
+            if self.limiter is not None:
+                self.limiter.pause(_retry_after(payload))
+        elif code >= 400:
+            TG_ERRORS.inc(api, str(code))
+        return code, payload
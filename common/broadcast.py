@@ -0,0 +1,286 @@
+import asyncio, logging, random, time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(value) -> float:
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class TokenBucket:
+    """Асинхронный token bucket: ``rate`` токенов в секунду, запас ``capacity``."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._stamp) * self.rate
+                )
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов (Telegram прислал RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        return time.monotonic() - self._stamp > self.capacity / self.rate
+
+
+class SharedTokenBucket:
+    """Token bucket с состоянием в общей памяти: один лимит на несколько процессов.
+
+    Состояние (токены, отметка времени, пауза до) — ``multiprocessing.Array``,
+    его создаёт родитель (``new_state``) и передаёт процессам-воркерам. Под
+    межпроцессным замком — только арифметика, ожидание — ``asyncio.sleep``
+    вне его. ``time.monotonic`` в пределах машины общий для всех процессов.
+    """
+
+    def __init__(self, state, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._state = state
+        self._lock = asyncio.Lock()     # внутри процесса ждём по очереди
+
+    @staticmethod
+    def new_state(ctx):
+        """Общее состояние для ``ctx`` (контекст multiprocessing) — в родителе."""
+        return ctx.Array("d", [0.0, time.monotonic(), 0.0])
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                with self._state.get_lock():
+                    tokens, stamp, paused_until = self._state[:]
+                    now = time.monotonic()
+                    if now < paused_until:
+                        wait = paused_until - now
+                    else:
+                        tokens = min(self.capacity, tokens + (now - stamp) * self.rate)
+                        if tokens >= 1:
+                            self._state[0], self._state[1] = tokens - 1, now
+                            return
+                        self._state[0], self._state[1] = tokens, now
+                        wait = (1 - tokens) / self.rate
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов во всех процессах (RetryAfter)."""
+        with self._state.get_lock():
+            self._state[2] = max(self._state[2], time.monotonic() + seconds)
+            self._state[0] = 0.0
+
+
+@dataclass
+class BroadcastReport:
+    total: int
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    flood_waits: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+    failures: Dict[int, str] = field(default_factory=dict)
+    unrecorded: int = 0       # доставлены, но on_delivered так и не прошёл
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        text = (
+            f"доставлено {self.sent}/{self.total}, ошибок {self.failed}, "
+            f"за {self.elapsed:.1f} с ({self.rate:.1f} сообщ./с)"
+        )
+        if self.unrecorded:
+            text += f", не отмечено в БД {self.unrecorded}"
+        return text
+
+    def failure_sample(self, limit: int = 5) -> Dict[int, str]:
+        """Первые ``limit`` отказов — для лога, без списка на весь класс."""
+        return dict(list(self.failures.items())[:limit])
+
+
+class Broadcaster:
+    """Отправка сообщений в пределах лимитов Telegram.
+
+    Общий лимит бота (~30 сообщ./с) и лимит на чат (1/с для личных,
+    20/мин для групп) — token bucket'ы. ``RetryAfter`` приостанавливает
+    общий bucket на указанное время, сетевые ошибки повторяются с
+    экспоненциальной задержкой, ``Forbidden``/``BadRequest`` — окончательный
+    отказ для получателя.
+
+    ``global_rate=0`` — без общего bucket'а: его держит HTTP-слой бота
+    (``common.botapi.MeteredRequest(limiter=...)``) для всех отправок сразу.
+    """
+
+    def __init__(self, bot, global_rate: float = 25.0, private_rate: float = 1.0,
+                 group_rate: float = 20 / 60, concurrency: int = 20,
+                 max_attempts: int = 4, backoff: float = 0.5):
+        self.bot = bot
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._global = TokenBucket(global_rate) if global_rate else None
+        self._chats: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # выкидываем полные (давно не использованные) bucket'ы
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle}
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, capacity=1)
+        return bucket
+
+    async def call(self, chat_id: int, method: Callable[..., Awaitable], *args,
+                   report: Optional[BroadcastReport] = None,
+                   chat_limit: bool = True, **kwargs):
+        """Вызывает метод Bot API для чата с учётом лимитов и повторов.
+
+        ``chat_limit=False`` — только общий лимит (короткая пачка в один чат).
+        """
+        attempt = 0
+        while True:
+            if chat_limit:
+                await self._chat_bucket(chat_id).acquire()
+            if self._global:
+                await self._global.acquire()
+            try:
+                return await method(chat_id, *args, **kwargs)
+            except RetryAfter as e:
+                wait = _seconds(e.retry_after)
+                logger.warning("Flood control: pause %.1fs", wait)
+                if self._global:
+                    self._global.pause(wait)
+                else:
+                    await asyncio.sleep(wait)
+                if report:
+                    report.flood_waits += 1
+            except (Forbidden, BadRequest):
+                raise
+            except NetworkError:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                if report:
+                    report.retries += 1
+                delay = self.backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * (1 + random.random() / 4))
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        return await self.call(chat_id, self.bot.send_message, text, **kwargs)
+
+    async def broadcast(
+        self,
+        chat_ids: Iterable[int],
+        text: str,
+        *,
+        on_delivered: Optional[Callable[[List[int]], Awaitable]] = None,
+        on_progress: Optional[Callable[[BroadcastReport], Awaitable]] = None,
+        batch: int = 200,
+        progress_every: float = 5.0,
+        callback_attempts: int = 3,
+        **kwargs,
+    ) -> BroadcastReport:
+        """Рассылает ``text`` всем чатам.
+
+        ``on_delivered`` получает пачки успешно доставленных chat_id (не
+        больше ``batch``), ``on_progress`` вызывается раз в ``progress_every`` с.
+        Ошибка ``on_delivered`` рассылку не прерывает: пачка повторяется до
+        ``callback_attempts`` раз, затем учитывается в ``report.unrecorded``.
+        """
+        ids = list(dict.fromkeys(chat_ids))
+        report = BroadcastReport(total=len(ids))
+        queue: asyncio.Queue = asyncio.Queue()
+        for cid in ids:
+            queue.put_nowait(cid)
+        delivered: List[int] = []
+        flush_lock = asyncio.Lock()
+
+        async def flush(force: bool = False):
+            async with flush_lock:
+                while delivered and (force or len(delivered) >= batch):
+                    chunk = delivered[:batch]
+                    del delivered[:batch]
+                    if on_delivered:
+                        await record(chunk)
+
+        async def record(chunk: List[int]):
+            for attempt in range(1, callback_attempts + 1):
+                try:
+                    await on_delivered(chunk)
+                    return
+                except Exception:      # ошибка БД не должна прерывать доставку
+                    logger.exception("Broadcast on_delivered failed (attempt %s/%s, %s chats)",
+                                     attempt, callback_attempts, len(chunk))
+                    if attempt < callback_attempts:
+                        await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            report.unrecorded += len(chunk)
+
+        async def worker():
+            while True:
+                try:
+                    cid = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self.call(cid, self.bot.send_message, text,
+                                    report=report, **kwargs)
+                except Exception as e:  # noqa: BLE001 — фиксируем и идём дальше
+                    report.failed += 1
+                    report.failures[cid] = f"{type(e).__name__}: {e}"
+                    continue
+                report.sent += 1
+                delivered.append(cid)
+                if len(delivered) >= batch:
+                    await flush()
+
+        async def ticker():
+            while True:
+                await asyncio.sleep(progress_every)
+                try:
+                    await on_progress(report)
+                except Exception:  # noqa: BLE001
+                    logger.exception("Broadcast progress callback failed")
+
+        tick = asyncio.create_task(ticker()) if on_progress else None
+        try:
+            await asyncio.gather(
+                *(worker() for _ in range(min(self.concurrency, len(ids)) or 1))
+            )
+            await flush(force=True)
+        finally:
+            if tick:
+                tick.cancel()
+            report.finished = time.monotonic()
+        return report
@@ -0,0 +1,18 @@
+import os
+
+try:
+    import telegram_config as _cfg
+except ImportError:
+    _cfg = None
+
+
+def setting(name: str, default=None, cast=None):
+    """Значение настройки: сначала telegram_config.py, затем переменная окружения."""
+    value = getattr(_cfg, name, None)
+    if value is None:
+        value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    if cast is bool and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return cast(value) if cast else value
@@ -1,15 +1,613 @@
+import asyncio, contextvars, functools, re, threading, time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Hashable, Optional
 
-import os, pyodbc
+import pyodbc
 
-try:
-    from telegram_config import AI_BOTS_CONN as CFG_CONN
-except ImportError:
-    CFG_CONN = None
+from common.config import setting
+from common.metrics import DB_ERRORS, DB_SECONDS, GaugeFunc, statement_label
 
-AI_BOTS_CONN = CFG_CONN or os.getenv("AI_BOTS_CONN")
+AI_BOTS_CONN = setting("AI_BOTS_CONN")
 if not AI_BOTS_CONN:
     raise RuntimeError("AI_BOTS_CONN must be defined in telegram_config.py or env var")
 
+
+class PoolTimeout(RuntimeError):
+    """Свободного соединения не дождались за отведённое время."""
+
+
+class _Slot:
+    __slots__ = ("conn", "created", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.last_used = time.monotonic()
+
+
+# ─────────── профилировщик запросов ───────────
+_STR_RE = re.compile(r"N?'(?:[^']|'')*'")
+_NUM_RE = re.compile(r"(?<![\w@.])\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS_RE = re.compile(r"\(\?…\)(?:\s*,\s*\(\?…\))+")
+_WS_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql: str) -> str:
+    """Текст запроса без литералов: ``IN (?,?,?)`` и ``VALUES (…),(…)`` свёрнуты."""
+    text = _WS_RE.sub(" ", sql).strip()
+    text = _STR_RE.sub("?", text)
+    text = _NUM_RE.sub("?", text)
+    text = _LIST_RE.sub("(?…)", text)
+    return _ROWS_RE.sub("(?…), …", text)
+
+
+class _Scope:
+    __slots__ = ("name", "update_id", "queries", "seconds")
+
+    def __init__(self, name: str, update_id: Optional[Hashable]):
+        self.name = name
+        self.update_id = update_id
+        self.queries = []
+        self.seconds = 0.0
+
+
+class QueryProfiler:
+    """Журнал SQL-запросов с привязкой к обновлению/хендлеру (``DB_PROFILE``).
+
+    Каждый execute/executemany записывается в кольцевой буфер: нормализованный
+    текст, время, число строк и текущий scope (см. ``scope()``). Запросы
+    дольше ``slow_ms`` и scope, сделавшие больше ``budget`` запросов,
+    откладываются отдельно. Scope переживает ``db_run`` — DbExecutor
+    переносит contextvars в поток БД.
+    """
+
+    def __init__(self, enabled: bool, slow_ms: float = 200.0, budget: int = 5,
+                 keep: int = 5000):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.budget = budget
+        self._current = contextvars.ContextVar("db_profile_scope", default=None)
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep)    # [текст, с, строки, scope, update_id]
+        self._slow = deque(maxlen=100)
+        self._over = deque(maxlen=100)
+        self._scopes = {}                    # имя → [обновлений, запросов, max, сверх бюджета]
+
+    @contextmanager
+    def scope(self, name: str, update_id: Optional[Hashable] = None):
+        """Запросы внутри ``with`` относятся к ``name`` / ``update_id``."""
+        if not self.enabled:
+            yield None
+            return
+        s = _Scope(name, update_id)
+        token = self._current.set(s)
+        try:
+            yield s
+        finally:
+            self._current.reset(token)
+            self._finish(s)
+
+    def record(self, sql: str, seconds: float, rows: int) -> list:
+        s = self._current.get()
+        rec = [normalize_sql(sql), seconds, max(rows, 0),
+               s.name if s else "-", s.update_id if s else None]
+        with self._lock:
+            self._recent.append(rec)
+            if seconds * 1000 >= self.slow_ms:
+                self._slow.append(rec)
+            if s is not None:
+                s.queries.append(rec[0])
+                s.seconds += seconds
+        return rec
+
+    def _finish(self, s: _Scope) -> None:
+        n = len(s.queries)
+        with self._lock:
+            agg = self._scopes.get(s.name)
+            if agg is None:
+                agg = self._scopes[s.name] = [0, 0, 0, 0]
+            agg[0] += 1
+            agg[1] += n
+            agg[2] = max(agg[2], n)
+            if n > self.budget:
+                agg[3] += 1
+                self._over.append({
+                    "handler": s.name, "update_id": s.update_id, "queries": n,
+                    "ms": round(s.seconds * 1000, 3),
+                    "statements": Counter(s.queries).most_common(5),
+                })
+
+    def reset(self) -> None:
+        with self._lock:
+            self._recent.clear()
+            self._slow.clear()
+            self._over.clear()
+            self._scopes.clear()
+
+    def report(self, top: int = 20) -> dict:
+        with self._lock:
+            recent = list(self._recent)
+            slow = [list(r) for r in self._slow]
+            over = list(self._over)
+            scopes = {k: list(v) for k, v in self._scopes.items()}
+        by_text = {}
+        for text, sec, rows, name, _uid in recent:
+            a = by_text.get(text)
+            if a is None:
+                a = by_text[text] = [0, 0.0, 0.0, 0, set()]
+            a[0] += 1
+            a[1] += sec
+            a[2] = max(a[2], sec)
+            a[3] += rows
+            a[4].add(name)
+        offenders = sorted(by_text.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        return {
+            "enabled": self.enabled,
+            "slow_ms": self.slow_ms,
+            "budget": self.budget,
+            "window": len(recent),
+            "top": [
+                {"sql": text, "calls": n, "total_ms": round(total * 1000, 3),
+                 "avg_ms": round(total * 1000 / n, 3), "max_ms": round(mx * 1000, 3),
+                 "rows": rows, "handlers": sorted(names)}
+                for text, (n, total, mx, rows, names) in offenders
+            ],
+            "slow": [
+                {"sql": text, "ms": round(sec * 1000, 3), "rows": rows,
+                 "handler": name, "update_id": uid}
+                for text, sec, rows, name, uid in reversed(slow)
+            ],
+            "over_budget": list(reversed(over)),
+            "handlers": [
+                {"handler": name, "updates": n, "queries": q,
+                 "avg": round(q / n, 2) if n else 0.0, "max": mx, "over_budget": ob}
+                for name, (n, q, mx, ob) in sorted(scopes.items(),
+                                                   key=lambda kv: -kv[1][1])
+            ],
+        }
+
+
+profiler = QueryProfiler(
+    setting("DB_PROFILE", False, bool),
+    slow_ms=setting("DB_SLOW_MS", 200.0, float),
+    budget=setting("DB_QUERY_BUDGET", 5, int),
+    keep=setting("DB_PROFILE_KEEP", 5000, int),
+)
+
+
+class MeteredCursor:
+    """Курсор pyodbc, который считает время и ошибки execute/executemany.
+
+    При включённом профилировщике запрос попадает и в ``profiler``; строки,
+    прочитанные fetch*, дописываются к записи последнего запроса.
+    """
+
+    __slots__ = ("_cur", "_rec")
+
+    def __init__(self, cur):
+        object.__setattr__(self, "_cur", cur)
+        object.__setattr__(self, "_rec", None)
+
+    def _timed(self, fn, sql, *args):
+        label = statement_label(sql)
+        start = time.perf_counter()
+        try:
+            fn(sql, *args)
+        except pyodbc.Error:
+            DB_ERRORS.inc(label)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_SECONDS.observe(elapsed, label)
+            if profiler.enabled:
+                object.__setattr__(self, "_rec", profiler.record(
+                    sql, elapsed, getattr(self._cur, "rowcount", -1)))
+        return self
+
+    def _fetched(self, rows):
+        if self._rec is not None and rows:
+            self._rec[2] += len(rows) if isinstance(rows, list) else 1
+        return rows
+
+    def execute(self, sql, *params):
+        return self._timed(self._cur.execute, sql, *params)
+
+    def executemany(self, sql, seq):
+        self._timed(self._cur.executemany, sql, seq)
+
+    def fetchone(self):
+        return self._fetched(self._cur.fetchone())
+
+    def fetchall(self):
+        return self._fetched(self._cur.fetchall())
+
+    def fetchmany(self, *size):
+        return self._fetched(self._cur.fetchmany(*size))
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __setattr__(self, name, value):      # fast_executemany и т.п.
+        setattr(self._cur, name, value)
+
+    def __iter__(self):
+        for row in self._cur:
+            yield self._fetched(row)
+
+    def __enter__(self):
+        self._cur.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._cur.__exit__(*exc)
+
+
+class MeteredConnection:
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self) -> MeteredCursor:
+        return MeteredCursor(self._conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+DB_METRICS = setting("DB_METRICS", True, bool)
+
+
+class ConnectionPool:
+    """Потокобезопасный пул ODBC-соединений.
+
+    * не больше ``max_size`` открытых соединений, остальные ждут до ``timeout`` с;
+    * соединение, простоявшее дольше ``ping_after`` с, проверяется ``SELECT 1``;
+    * простаивающие дольше ``idle_timeout`` закрываются;
+    * живущие дольше ``max_lifetime`` пересоздаются.
+    """
+
+    def __init__(self, connect, max_size=10, timeout=30.0,
+                 idle_timeout=300.0, max_lifetime=1800.0, ping_after=30.0):
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()          # справа — самые «горячие» соединения
+        self._size = 0                # открытые + резерв под открываемые
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._closed = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # ─────────── checkout / checkin ───────────
+    def acquire(self) -> _Slot:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            slot = self._reserve(deadline)
+            if slot is None:
+                try:
+                    slot = _Slot(self.connect())
+                except BaseException:
+                    self._unreserve()
+                    raise
+                with self._cond:
+                    self._created += 1
+                break
+            if self._healthy(slot):
+                break
+            self._discard(slot)
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return slot
+
+    def release(self, slot: _Slot, discard: bool = False) -> None:
+        now = time.monotonic()
+        expired = now - slot.created >= self.max_lifetime
+        with self._cond:
+            self._in_use -= 1
+            if not (discard or expired):
+                slot.last_used = now
+                self._idle.append(slot)
+                self._cond.notify()
+                stale = self._pop_stale(now)
+            else:
+                stale = []
+        for s in stale:
+            self._discard(s)
+        if discard or expired:
+            self._discard(slot)
+
+    @contextmanager
+    def connection(self):
+        """Как ``with pyodbc.connect(...)``: commit при успехе, rollback при ошибке."""
+        slot = self.acquire()
+        broken = False
+        try:
+            yield (MeteredConnection(slot.conn) if DB_METRICS or profiler.enabled
+                   else slot.conn)
+        except BaseException as exc:
+            broken = isinstance(exc, (pyodbc.OperationalError, pyodbc.InterfaceError))
+            try:
+                slot.conn.rollback()
+            except pyodbc.Error:
+                broken = True
+            raise
+        else:
+            try:
+                slot.conn.commit()
+            except pyodbc.Error:
+                broken = True
+                raise
+        finally:
+            self.release(slot, discard=broken)
+
+    # ─────────── обслуживание ───────────
+    def prune(self) -> None:
+        """Закрывает простаивающие соединения (можно звать по таймеру)."""
+        with self._cond:
+            stale = self._pop_stale(time.monotonic())
+        for s in stale:
+            self._discard(s)
+
+    def close(self) -> None:
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for s in idle:
+            self._discard(s)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "open": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "created": self._created,
+                "closed": self._closed,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": round(self._wait_total * 1000 / self._checkouts, 3)
+                if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    # ─────────── internals ───────────
+    def _reserve(self, deadline: float):
+        """Берёт свободное соединение или резервирует место под новое (None)."""
+        with self._cond:
+            while True:
+                stale = self._pop_stale(time.monotonic())
+                if stale:
+                    # закрытие — сетевой вызов, не держим под ним блокировку
+                    self._cond.release()
+                    try:
+                        for s in stale:
+                            self._discard(s)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"no free DB connection within {self.timeout}s "
+                        f"(pool size {self.max_size})"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+    def _unreserve(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _pop_stale(self, now: float) -> list:
+        stale = []
+        while self._idle and now - self._idle[0].last_used >= self.idle_timeout:
+            stale.append(self._idle.popleft())
+        return stale
+
+    def _healthy(self, slot: _Slot) -> bool:
+        now = time.monotonic()
+        if now - slot.created >= self.max_lifetime:
+            return False
+        if now - slot.last_used < self.ping_after:
+            return True
+        try:
+            cur = slot.conn.cursor()
+            try:
+                cur.execute("SELECT 1").fetchone()
+            finally:
+                cur.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _discard(self, slot: _Slot) -> None:
+        try:
+            slot.conn.close()
+        except pyodbc.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._closed += 1
+            self._cond.notify()
+
+
+pool = ConnectionPool(
+    lambda: pyodbc.connect(AI_BOTS_CONN, autocommit=False),
+    max_size=setting("DB_POOL_SIZE", 10, int),
+    timeout=setting("DB_POOL_TIMEOUT", 30.0, float),
+    idle_timeout=setting("DB_POOL_IDLE_TIMEOUT", 300.0, float),
+    max_lifetime=setting("DB_POOL_MAX_LIFETIME", 1800.0, float),
+    ping_after=setting("DB_POOL_PING_AFTER", 30.0, float),
+)
+
+
+def placeholders(n: int) -> str:
+    return ",".join("?" * n)
+
+
+def chunked(seq, size: int):
+    """Режет последовательность на куски (лимит SQL Server — 2100 параметров)."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
 def db_conn():
-    return pyodbc.connect(AI_BOTS_CONN, autocommit=False)
+    """Соединение из общего пула; возвращается в пул при выходе из ``with``."""
+    return pool.connection()
+
+
+def pool_stats() -> dict:
+    return pool.stats()
+
+
+# ─────────── async-слой: блокирующий pyodbc вне event loop ───────────
+class DbExecutor:
+    """Выполняет синхронную работу с БД в ограниченном пуле потоков.
+
+    Одновременно работает не больше ``max_workers`` задач, остальные стоят
+    в очереди; глубина очереди и время ожидания видны в ``stats()``.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        submitted = time.monotonic()
+        ctx = contextvars.copy_context()
+
+        def call():
+            started = time.monotonic()
+            waited = started - submitted
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            ok = False
+            try:
+                result = ctx.run(fn, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._failed += not ok
+                    self._run_total += time.monotonic() - started
+
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        fut = self._executor.submit(call)
+        fut.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(fut)
+
+    def _on_done(self, fut) -> None:
+        # задачу отменили до старта — call() не выполнится, поправим счётчик
+        if fut.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self._completed
+            return {
+                "max_workers": self.max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "max_queued": self._max_queued,
+                "completed": done,
+                "failed": self._failed,
+                "wait_avg_ms": round(self._wait_total * 1000 / done, 3) if done else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "run_avg_ms": round(self._run_total * 1000 / done, 3) if done else 0.0,
+            }
+
+
+# потоков не больше, чем соединений в пуле — иначе они ждали бы пул
+executor = DbExecutor(setting("DB_WORKERS", pool.max_size, int))
+
+
+def _query(sql: str, params: tuple, fetch: str):
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(sql, *params)
+        if fetch == "all":
+            return cur.fetchall()
+        if fetch == "one":
+            return cur.fetchone()
+        return cur.rowcount
+
+
+async def db_run(fn, *args, **kwargs):
+    """``await db_run(f, ...)`` — вызвать синхронную функцию f в пуле потоков БД."""
+    return await executor.run(fn, *args, **kwargs)
+
+
+async def db_fetchall(sql: str, *params):
+    return await executor.run(_query, sql, params, "all")
+
+
+async def db_fetchone(sql: str, *params):
+    return await executor.run(_query, sql, params, "one")
+
+
+async def db_execute(sql: str, *params) -> int:
+    """Выполняет DML и коммитит; возвращает rowcount."""
+    return await executor.run(_query, sql, params, "none")
+
+
+def executor_stats() -> dict:
+    return executor.stats()
+
 
+GaugeFunc("db_pool_connections", "Соединения пула по состоянию.",
+          lambda: {(k,): v for k, v in pool.stats().items()
+                   if k in ("open", "in_use", "idle", "waiting")},
+          ["state"])
+GaugeFunc("db_executor_tasks", "Задачи пула потоков БД по состоянию.",
+          lambda: {(k,): v for k, v in executor.stats().items()
+                   if k in ("queued", "running")},
+          ["state"])
@@ -0,0 +1,82 @@
+"""Метрики и отладка процесса бота по HTTP.
+
+Панель работает в отдельных процессах gunicorn, а реестр метрик, журнал
+SQL, индекс опросов, пул потоков БД и очередь обновлений у каждого
+процесса свои. Поэтому процесс бота (и каждый воркер webhook) поднимает
+небольшой aiohttp-сервер в своём event loop:
+
+    GET  /metrics        метрики процесса, формат Prometheus
+    GET  /debug/stats    пул БД, пул потоков, индекс опросов, очередь обновлений
+    GET  /debug/queries  журнал SQL (?top=N), JSON
+    POST /debug/queries  сброс журнала
+
+Порт — BOT_METRICS_PORT, у воркеров webhook — BOT_METRICS_PORT + индекс
+(каждый воркер — отдельная цель для Prometheus); 0 — не поднимать.
+Панель читает /debug/* по адресам из BOT_DEBUG_URLS (``web_app``).
+"""
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+from common.config import setting
+from common.db import executor_stats, pool_stats, profiler
+from common.metrics import CONTENT_TYPE, render
+from common.pollindex import poll_index
+from common.updates import update_processor
+
+logger = logging.getLogger(__name__)
+
+BOT_METRICS_HOST = setting("BOT_METRICS_HOST", "127.0.0.1")
+BOT_METRICS_PORT = setting("BOT_METRICS_PORT", 9100, int)
+
+
+def process_stats() -> dict:
+    return {
+        "pool": pool_stats(),
+        "executor": executor_stats(),
+        "poll_index": poll_index.stats(),
+        "updates": update_processor.stats(),
+    }
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def _stats(request: web.Request) -> web.Response:
+    return web.json_response(process_stats())
+
+
+async def _queries(request: web.Request) -> web.Response:
+    if request.method == "POST":
+        profiler.reset()
+        return web.Response(status=204)
+    try:
+        top = max(1, min(int(request.query.get("top", 20)), 200))
+    except ValueError:
+        return web.Response(status=400)
+    return web.json_response(profiler.report(top=top))
+
+
+async def start_debug_server(offset: int = 0) -> Optional[web.AppRunner]:
+    """Поднимает сервер на BOT_METRICS_PORT + ``offset``; None, если выключен."""
+    if not BOT_METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    app.router.add_get("/debug/stats", _stats)
+    app.router.add_get("/debug/queries", _queries)
+    app.router.add_post("/debug/queries", _queries)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = BOT_METRICS_PORT + offset
+    try:
+        await web.TCPSite(runner, BOT_METRICS_HOST, port).start()
+    except OSError as e:
+        # занятый порт не должен мешать боту работать
+        logger.warning("Debug server on %s:%s not started: %s", BOT_METRICS_HOST, port, e)
+        await runner.cleanup()
+        return None
+    logger.info("Metrics and debug endpoints on %s:%s", BOT_METRICS_HOST, port)
+    return runner
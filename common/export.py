@@ -0,0 +1,56 @@
+import csv, io, json, zlib
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Iterable, Iterator
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _plain(v):
+    if isinstance(v, (datetime, date, time)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (bytes, bytearray)):
+        return v.hex()
+    return v
+
+
+def stream_rows(cur, fmt: str, batch: int = 1000) -> Iterator[bytes]:
+    """Отдаёт результат курсора кусками по ``batch`` строк (fetchmany)."""
+    cols = [c[0] for c in cur.description]
+    if fmt == 'csv':
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        buf.write('\ufeff')          # BOM — чтобы Excel понял UTF-8
+        w.writerow(cols)
+        yield buf.getvalue().encode('utf-8')
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            buf.seek(0)
+            buf.truncate()
+            w.writerows([_plain(v) for v in r] for r in rows)
+            yield buf.getvalue().encode('utf-8')
+    else:
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            yield ''.join(
+                json.dumps(dict(zip(cols, map(_plain, r))), ensure_ascii=False) + '\n'
+                for r in rows
+            ).encode('utf-8')
+
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)   # 31 — формат gzip
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
@@ -0,0 +1,185 @@
+import codecs, json
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple
+
+import pyodbc
+
+from common.db import chunked
+
+_WS = " \t\r\n"
+ANSWER_MAX = 200        # PendingQuizzes.Answer NVARCHAR(200)
+
+
+class MalformedJson(ValueError):
+    def __init__(self, pos: int, msg: str):
+        super().__init__(f"{msg} (char {pos})")
+        self.pos = pos
+        self.msg = msg
+
+
+def iter_json_array(chunks: Iterable[str], max_item: int = 1 << 20) -> Iterator[Tuple[int, Any]]:
+    """Разбирает JSON-массив по кускам текста, отдавая (индекс, элемент).
+
+    В памяти — только текущий кусок и недочитанный элемент (не больше
+    ``max_item`` символов). Элементы до синтаксической ошибки успевают
+    выйти наружу, сама ошибка — ``MalformedJson``.
+    """
+    decoder = json.JSONDecoder()
+    it = iter(chunks)
+    buf, pos, base, eof = "", 0, 0, False
+
+    def fill() -> bool:
+        nonlocal buf, pos, base, eof
+        for chunk in it:
+            if chunk:
+                buf, base, pos = buf[pos:] + chunk, base + pos, 0
+                return True
+        eof = True
+        return False
+
+    def skip_ws() -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WS:
+                pos += 1
+            if pos < len(buf) or not fill():
+                return
+
+    skip_ws()
+    if pos >= len(buf) or buf[pos] != "[":
+        raise MalformedJson(base + pos, "expected '['")
+    pos += 1
+    skip_ws()
+    if pos < len(buf) and buf[pos] == "]":
+        return
+
+    index = 0
+    while True:
+        skip_ws()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if len(buf) - pos <= max_item and fill():
+                    continue          # элемент ещё не дочитан
+                raise MalformedJson(base + e.pos, e.msg) from None
+            # число/литерал на границе куска может продолжаться в следующем
+            if not eof and not isinstance(item, (dict, list, str)):
+                rest = buf[end:].lstrip(_WS)
+                if (not rest or rest[0] not in ",]") and fill():
+                    continue
+            break
+        pos = end
+        yield index, item
+        index += 1
+
+        skip_ws()
+        if pos >= len(buf):
+            raise MalformedJson(base + pos, "unexpected end of data")
+        ch = buf[pos]
+        pos += 1
+        if ch == "]":
+            return
+        if ch != ",":
+            raise MalformedJson(base + pos - 1, "expected ',' or ']'")
+
+
+def quiz_json_chunks(cur, pf_id: int, chunk_chars: int = 32768) -> Iterator[str]:
+    """Читает ProcessedFiles.QuizJson кусками через SUBSTRING, не целиком.
+
+    Берём байты UTF-16 и декодируем инкрементально — суррогатная пара на
+    границе куска не ломается.
+    """
+    cur.execute("SELECT DATALENGTH(QuizJson) FROM dbo.ProcessedFiles WHERE Id=?", pf_id)
+    rows = cur.fetchall()
+    size = rows[0][0] if rows and rows[0][0] else 0
+    decoder = codecs.getincrementaldecoder("utf-16-le")("replace")
+    step = chunk_chars * 2
+    for start in range(1, size + 1, step):
+        cur.execute(
+            "SELECT SUBSTRING(CAST(QuizJson AS VARBINARY(MAX)), ?, ?) "
+            "FROM dbo.ProcessedFiles WHERE Id=?",
+            start, step, pf_id,
+        )
+        # fetchall дочитывает результат: соединение свободно для INSERT
+        yield decoder.decode(cur.fetchall()[0][0])
+    yield decoder.decode(b"", final=True)
+
+
+def quiz_row(q) -> Tuple[Optional[Tuple[str, str, str]], Optional[str]]:
+    """Готовит вопрос к вставке; (Question, Options JSON, Answer) либо причина отказа.
+
+    Проверяется только то, без чего строка не ляжет в PendingQuizzes: объект
+    с полями question/options/answer, строки и список строк, ответ не длиннее
+    столбца Answer. Ошибка одного элемента — причина в отчёте по файлу, а не
+    сбой вставки всей пачки.
+    """
+    if not isinstance(q, dict):
+        return None, "не объект"
+    missing = [k for k in ("question", "options", "answer") if k not in q]
+    if missing:
+        return None, "нет поля " + ", ".join(missing)
+    question, options, answer = q["question"], q["options"], q["answer"]
+    if not isinstance(question, str):
+        return None, "question — не строка"
+    if not isinstance(options, list) or not all(isinstance(o, str) for o in options):
+        return None, "options — не список строк"
+    if not isinstance(answer, str):
+        return None, "answer — не строка"
+    if len(answer) > ANSWER_MAX:
+        return None, f"answer длиннее {ANSWER_MAX} символов"
+    return (question, json.dumps(options, ensure_ascii=False), answer), None
+
+
+# ─────────── загрузка в PendingQuizzes ───────────
+INSERT_PENDING_SQL = (
+    "INSERT INTO dbo.PendingQuizzes "
+    "(ProcessedFileId,Question,Options,Answer) VALUES (?,?,?,?)"
+)
+BULK_MODES = ("fast", "values", "row")
+# предел связывания NVARCHAR(n): длиннее — только как NVARCHAR(MAX)
+BOUND_CHARS = 4000
+
+
+def load_pending(cur, rows: Sequence[Tuple[int, str, str, str]], mode: str = "fast") -> None:
+    """Вставляет строки PendingQuizzes выбранным способом.
+
+    * ``fast``   — ``fast_executemany``: все строки уходят одним массивом параметров;
+      редкие строки с вопросом/вариантами длиннее BOUND_CHARS — через ``values``;
+    * ``values`` — многострочный INSERT ... VALUES по 500 строк;
+    * ``row``    — обычный ``executemany``, раунд-трип на строку (как раньше).
+    """
+    if not rows:
+        return
+    if mode == "fast":
+        # NVARCHAR(MAX) fast_executemany передаёт построчно (data-at-execution),
+        # поэтому массивом идут только строки, влезающие в NVARCHAR(4000)
+        short = [r for r in rows if len(r[1]) <= BOUND_CHARS and len(r[2]) <= BOUND_CHARS]
+        if len(short) < len(rows):
+            load_pending(cur, [r for r in rows
+                               if len(r[1]) > BOUND_CHARS or len(r[2]) > BOUND_CHARS], "values")
+        if not short:
+            return
+        cur.fast_executemany = True
+        cur.setinputsizes([
+            (pyodbc.SQL_INTEGER, 0, 0),
+            (pyodbc.SQL_WVARCHAR, BOUND_CHARS, 0),
+            (pyodbc.SQL_WVARCHAR, BOUND_CHARS, 0),
+            (pyodbc.SQL_WVARCHAR, ANSWER_MAX, 0),
+        ])
+        try:
+            cur.executemany(INSERT_PENDING_SQL, short)
+        finally:
+            cur.setinputsizes(None)     # размеры не должны достаться другим запросам
+    elif mode == "values":
+        for part in chunked(rows, 500):     # 4 параметра × 500 < 2100
+            cur.execute(
+                "INSERT INTO dbo.PendingQuizzes "
+                "(ProcessedFileId,Question,Options,Answer) VALUES "
+                + ",".join(["(?,?,?,?)"] * len(part)),
+                *(x for r in part for x in r),
+            )
+    elif mode == "row":
+        cur.fast_executemany = False
+        cur.executemany(INSERT_PENDING_SQL, rows)
+    else:
+        raise ValueError(f"unknown bulk import mode {mode!r}; expected one of {BULK_MODES}")
@@ -0,0 +1,220 @@
+import asyncio, bisect, functools, logging, math, re, threading, time
+from typing import Callable, Dict, Iterable, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# границы по умолчанию: от 1 мс до 30 с
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def header(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for lv, v in items:
+            yield f"{self.name}{_labels(self.labels, lv)} {_fmt(v)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # по label-набору: [счётчики по корзинам (последняя — +Inf), сумма]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labelvalues)
+            if s is None:
+                s = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][i] += 1
+            s[1] += value
+
+    def time(self, *labelvalues: str) -> "_Timer":
+        return _Timer(self, labelvalues)
+
+    def collect(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted((lv, (list(c), total)) for lv, (c, total) in self._series.items())
+        for lv, (counts, total) in items:
+            acc = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                acc += n
+                le = f'le="{_fmt(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labels, lv, le)} {acc}"
+            yield f"{self.name}_sum{_labels(self.labels, lv)} {_fmt(total)}"
+            yield f"{self.name}_count{_labels(self.labels, lv)} {acc}"
+
+
+class _Timer:
+    __slots__ = ("_hist", "_labels", "_start")
+
+    def __init__(self, hist: Histogram, labels: Tuple[str, ...]):
+        self._hist, self._labels = hist, labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._hist.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+class GaugeFunc(_Metric):
+    """Gauge, значения которого читаются в момент выдачи метрик.
+
+    ``fn`` возвращает число либо {кортеж значений меток: число}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn: Callable, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._fn = fn
+
+    def collect(self) -> Iterable[str]:
+        try:
+            value = self._fn()
+        except Exception:  # noqa: BLE001 — метрики не должны ронять /metrics
+            logger.exception("Gauge %s failed", self.name)
+            return
+        if isinstance(value, dict):
+            for lv, v in sorted(value.items()):
+                yield f"{self.name}{_labels(self.labels, lv)} {_fmt(v)}"
+        elif value is not None:
+            yield f"{self.name} {_fmt(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus 0.0.4."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.header())
+            lines.extend(m.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ─────────── метрики приложения ───────────
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время работы хендлера Telegram-обновления.", ["handler"])
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в хендлерах.", ["handler"])
+DB_SECONDS = Histogram(
+    "db_statement_seconds", "Время execute/executemany по типу запроса.", ["statement"])
+DB_ERRORS = Counter(
+    "db_statement_errors_total", "Ошибки выполнения запросов.", ["statement"])
+TG_SECONDS = Histogram(
+    "telegram_api_seconds", "Время вызова Bot API по методу.", ["method"])
+TG_ERRORS = Counter(
+    "telegram_api_errors_total", "Неуспешные вызовы Bot API.", ["method", "reason"])
+TG_RETRY_AFTER = Counter(
+    "telegram_api_retry_after_total", "Ответы 429 (RetryAfter) от Bot API.", ["method"])
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Опоздание event loop относительно таймера.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+def timed_handler(name: str):
+    """Декоратор async-хендлера: гистограмма времени и счётчик ошибок."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+        return wrapper
+    return wrap
+
+
+_VERB_RE = re.compile(r"\b(SELECT|INSERT|UPDATE|DELETE|MERGE|EXEC)\b", re.I)
+_TABLE_RE = re.compile(r"\bdbo\.(\w+)", re.I)
+
+
+@functools.lru_cache(maxsize=2048)
+def statement_label(sql: str) -> str:
+    """«verb Table» первого DML в батче — метка с малой кардинальностью."""
+    body = re.sub(r"^\s*(SET NOCOUNT ON;|DECLARE [^;]*;|\s)*", "", sql, flags=re.I)
+    verb = _VERB_RE.search(body)
+    table = _TABLE_RE.search(body)
+    return " ".join(filter(None, (verb and verb.group(1).lower(),
+                                  table and table.group(1)))) or "other"
+
+
+async def watch_loop_lag(interval: float = 0.5) -> None:
+    """Меряет, насколько event loop опаздывает разбудить sleep(interval)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
@@ -1,7 +1,17 @@
+import logging
+from typing import List, Tuple
+
 from common.db import db_conn
+from common.rollups import BACKFILL_SQL
 
-def ensure_schema():
-    ddl = """
+logger = logging.getLogger(__name__)
+
+# ─────────── миграции схемы ───────────
+# (версия, описание, T-SQL). Каждая миграция — отдельный батч и идемпотентна:
+# базы, созданные прежним ensure_schema(), уже содержат часть объектов.
+# Новые изменения схемы — только новой записью в конце списка.
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, "базовые таблицы", """
     ------------------------------------------------------------------
     -- PendingQuizzes
     ------------------------------------------------------------------
@@ -86,8 +96,234 @@ def ensure_schema():
         CREATE UNIQUE INDEX UX_Sessions
             ON dbo.QuizSessions(ProcessedFileId, StudentId);
     END;
+    """),
+    (2, "учёт ответов: Answered, индексы доставок и повторных ответов", """
+    -- счётчик отвеченных вопросов; для старых сессий считаем по QuizResults
+    IF COL_LENGTH('dbo.QuizSessions','Answered') IS NULL
+    BEGIN
+        ALTER TABLE dbo.QuizSessions ADD Answered INT NOT NULL DEFAULT 0;
+        EXEC('UPDATE s SET Answered = (
+                  SELECT COUNT(*) FROM dbo.QuizResults r
+                  JOIN dbo.PendingQuizzes pq ON pq.Id = r.PendingQuizId
+                  WHERE r.StudentId = s.StudentId
+                    AND pq.ProcessedFileId = s.ProcessedFileId)
+              FROM dbo.QuizSessions s');
+    END;
+    -- поиск доставок ученика (Started / Announced / PollId)
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizDeliveries_Student')
+        CREATE INDEX IX_QuizDeliveries_Student
+            ON dbo.QuizDeliveries (StudentId, PendingQuizId);
+    -- проверка повторного ответа (StudentId, PendingQuizId)
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizResults_Student_Quiz')
+        CREATE INDEX IX_QuizResults_Student_Quiz
+            ON dbo.QuizResults (StudentId, PendingQuizId);
+    """),
+    (3, "индексы для /results: keyset по (AnsweredAt, Id) и фильтры", """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizResults_AnsweredAt')
+        CREATE INDEX IX_QuizResults_AnsweredAt
+            ON dbo.QuizResults (AnsweredAt DESC, Id DESC)
+            INCLUDE (PendingQuizId, StudentId, ChosenOption, IsCorrect);
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizResults_Student_AnsweredAt')
+        CREATE INDEX IX_QuizResults_Student_AnsweredAt
+            ON dbo.QuizResults (StudentId, AnsweredAt DESC, Id DESC)
+            INCLUDE (PendingQuizId, ChosenOption, IsCorrect);
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_Students_TelegramId')
+        CREATE INDEX IX_Students_TelegramId
+            ON dbo.Students (TelegramId) INCLUDE (DisplayName);
+    """),
+    (4, "QuizStatsDaily — агрегаты ответов по дням для дашборда", """
+    IF NOT EXISTS (SELECT 1 FROM sys.tables WHERE name='QuizStatsDaily')
+    BEGIN
+        CREATE TABLE dbo.QuizStatsDaily (
+            Day     DATE NOT NULL PRIMARY KEY,
+            Answers INT  NOT NULL DEFAULT 0,
+            Correct INT  NOT NULL DEFAULT 0
+        );
+        INSERT INTO dbo.QuizStatsDaily (Day, Answers, Correct)
+        SELECT CAST(AnsweredAt AS DATE), COUNT(*), SUM(CAST(IsCorrect AS INT))
+        FROM dbo.QuizResults
+        GROUP BY CAST(AnsweredAt AS DATE);
+    END;
+    """),
+    (5, "состояние модерации файла по индексу (ProcessedFileId, Approved)", """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_PendingQuizzes_File_Approved')
+        CREATE INDEX IX_PendingQuizzes_File_Approved
+            ON dbo.PendingQuizzes (ProcessedFileId, Approved) INCLUDE (Prompted);
+    """),
+    (6, "срок сессии QuizSessions.DeadlineAt и индексы открытых сессий", """
+    IF COL_LENGTH('dbo.QuizSessions','DeadlineAt') IS NULL
+    BEGIN
+        ALTER TABLE dbo.QuizSessions ADD DeadlineAt DATETIME2 NULL;
+        EXEC('UPDATE dbo.QuizSessions
+              SET DeadlineAt = DATEADD(minute, Total, StartedAt)
+              WHERE FinishedAt IS NULL AND StartedAt IS NOT NULL');
+    END;
+    -- обход просроченных сессий (sweep_sessions)
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizSessions_Open_Deadline')
+        EXEC('CREATE INDEX IX_QuizSessions_Open_Deadline
+                  ON dbo.QuizSessions (DeadlineAt)
+                  WHERE FinishedAt IS NULL');
+    -- прогрев индекса опросов при старте (load_live_polls)
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizSessions_Open_Started')
+        CREATE INDEX IX_QuizSessions_Open_Started
+            ON dbo.QuizSessions (StartedAt) INCLUDE (ProcessedFileId, StudentId)
+            WHERE FinishedAt IS NULL;
+    """),
+    (7, "уникальный Students.TelegramId: чистка дубликатов", """
+    -- из дублей оставляем активную строку с именем, при равенстве — новую
+    ;WITH d AS (
+        SELECT ROW_NUMBER() OVER (
+                   PARTITION BY TelegramId
+                   ORDER BY Active DESC,
+                            CASE WHEN DisplayName IS NULL THEN 1 ELSE 0 END,
+                            Id DESC) AS rn
+        FROM dbo.Students
+    )
+    DELETE FROM d WHERE rn > 1;
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='UX_Students_TelegramId')
+        CREATE UNIQUE INDEX UX_Students_TelegramId
+            ON dbo.Students (TelegramId) INCLUDE (DisplayName, Active);
+    IF EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_Students_TelegramId')
+        DROP INDEX IX_Students_TelegramId ON dbo.Students;
+    """),
+    (8, "сводные таблицы аналитики: StudentFileStats, StudentStats, FileStats", """
+    IF OBJECT_ID('dbo.StudentFileStats', 'U') IS NULL
+        CREATE TABLE dbo.StudentFileStats (
+            StudentId       BIGINT    NOT NULL,
+            ProcessedFileId INT       NOT NULL,
+            Attempts        INT       NOT NULL DEFAULT 0,
+            Answers         INT       NOT NULL DEFAULT 0,
+            Correct         INT       NOT NULL DEFAULT 0,
+            Finished        INT       NOT NULL DEFAULT 0,
+            TimedOut        INT       NOT NULL DEFAULT 0,
+            FinishSeconds   BIGINT    NOT NULL DEFAULT 0,
+            LastActivityAt  DATETIME2 NULL,
+            CONSTRAINT PK_StudentFileStats PRIMARY KEY (StudentId, ProcessedFileId)
+        );
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_StudentFileStats_File')
+        CREATE INDEX IX_StudentFileStats_File
+            ON dbo.StudentFileStats (ProcessedFileId) INCLUDE (Answers, Correct);
+    IF OBJECT_ID('dbo.StudentStats', 'U') IS NULL
+        CREATE TABLE dbo.StudentStats (
+            StudentId       BIGINT    NOT NULL PRIMARY KEY,
+            Files           INT       NOT NULL DEFAULT 0,
+            Attempts        INT       NOT NULL DEFAULT 0,
+            Answers         INT       NOT NULL DEFAULT 0,
+            Correct         INT       NOT NULL DEFAULT 0,
+            Finished        INT       NOT NULL DEFAULT 0,
+            TimedOut        INT       NOT NULL DEFAULT 0,
+            FinishSeconds   BIGINT    NOT NULL DEFAULT 0,
+            LastActivityAt  DATETIME2 NULL
+        );
+    IF OBJECT_ID('dbo.FileStats', 'U') IS NULL
+        CREATE TABLE dbo.FileStats (
+            ProcessedFileId INT       NOT NULL PRIMARY KEY,
+            Students        INT       NOT NULL DEFAULT 0,
+            Attempts        INT       NOT NULL DEFAULT 0,
+            Answers         INT       NOT NULL DEFAULT 0,
+            Correct         INT       NOT NULL DEFAULT 0,
+            Finished        INT       NOT NULL DEFAULT 0,
+            TimedOut        INT       NOT NULL DEFAULT 0,
+            FinishSeconds   BIGINT    NOT NULL DEFAULT 0,
+            LastActivityAt  DATETIME2 NULL
+        );
+    -- пересчёт сводок по диапазонам учеников (rebuild_rollups)
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_QuizSessions_Student')
+        CREATE INDEX IX_QuizSessions_Student
+            ON dbo.QuizSessions (StudentId)
+            INCLUDE (ProcessedFileId, StartedAt, FinishedAt, TimedOut);
+    """),
+    (9, "заполнение сводных таблиц из истории", BACKFILL_SQL),
+    (10, "QuizSessions.Attempts — число стартов сессии", """
+    IF COL_LENGTH('dbo.QuizSessions','Attempts') IS NULL
+    BEGIN
+        ALTER TABLE dbo.QuizSessions ADD Attempts INT NOT NULL DEFAULT 0;
+        -- с миграции 9 сводка считала каждый старт; раньше известен один
+        EXEC('UPDATE s SET Attempts = CASE WHEN ISNULL(x.Attempts, 0) > 0
+                                           THEN x.Attempts ELSE 1 END
+              FROM dbo.QuizSessions s
+              LEFT JOIN dbo.StudentFileStats x
+                ON x.StudentId = s.StudentId AND x.ProcessedFileId = s.ProcessedFileId
+              WHERE s.StartedAt IS NOT NULL');
+        EXEC('CREATE INDEX IX_QuizSessions_Student
+                  ON dbo.QuizSessions (StudentId)
+                  INCLUDE (ProcessedFileId, StartedAt, FinishedAt, TimedOut, Attempts)
+                  WITH (DROP_EXISTING = ON)');
+    END;
+    """),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_VERSION_SQL = """
+SET NOCOUNT ON;
+IF OBJECT_ID('dbo.SchemaVersion', 'U') IS NULL
+    SELECT 0;
+ELSE
+    SELECT ISNULL(MAX(Version), 0) FROM dbo.SchemaVersion;
+"""
+
+_CREATE_VERSION_TABLE = """
+IF OBJECT_ID('dbo.SchemaVersion', 'U') IS NULL
+    CREATE TABLE dbo.SchemaVersion (
+        Version   INT           NOT NULL PRIMARY KEY,
+        Name      NVARCHAR(200) NOT NULL,
+        AppliedAt DATETIME2     NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+"""
+
+_schema_ready = False
+
+
+def schema_version(cur) -> int:
+    cur.execute(_VERSION_SQL)
+    return cur.fetchone()[0]
+
+
+def ensure_schema():
+    """Доводит схему до ``SCHEMA_VERSION``.
+
+    Если схема актуальна — один SELECT версии; повторный вызов в том же
+    процессе не обращается к БД вовсе. Миграции накатываются под
+    ``sp_getapplock``: бот и веб, стартующие одновременно, не выполнят
+    одну миграцию дважды. Каждая миграция коммитится вместе с записью в
+    SchemaVersion.
     """
+    global _schema_ready
+    if _schema_ready:
+        return
     with db_conn() as c, c.cursor() as cur:
-        cur.execute(ddl)
-        c.commit()
-
+        if schema_version(cur) >= SCHEMA_VERSION:
+            _schema_ready = True
+            return
+        cur.execute(
+            "DECLARE @rc INT; "
+            "EXEC @rc = sp_getapplock @Resource='schema-migrations', "
+            "     @LockMode='Exclusive', @LockOwner='Session', @LockTimeout=120000; "
+            "IF @rc < 0 THROW 50001, 'schema migration lock not acquired', 1;"
+        )
+        try:
+            cur.execute(_CREATE_VERSION_TABLE)
+            c.commit()
+            current = schema_version(cur)
+            for version, name, sql in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info("Schema migration %s: %s", version, name)
+                cur.execute(sql)
+                # ошибка поздней инструкции батча всплывает только при
+                # переходе к её результату — дочитываем все до записи версии
+                while cur.nextset():
+                    pass
+                cur.execute(
+                    "INSERT INTO dbo.SchemaVersion (Version, Name) VALUES (?, ?)",
+                    version, name,
+                )
+                c.commit()
+        finally:
+            c.rollback()        # незакоммиченная миграция не уходит в пул
+            cur.execute(
+                "EXEC sp_releaseapplock @Resource='schema-migrations', "
+                "     @LockOwner='Session';"
+            )
+    _schema_ready = True
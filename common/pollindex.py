@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from common.config import setting
+from common.metrics import GaugeFunc
+
+
+class PollRecord(NamedTuple):
+    """Всё, что нужно для приёма ответа на опрос, без запроса к БД."""
+    pending_quiz_id: int
+    student: int
+    pf_id: int
+    options: Tuple[str, ...]
+    answer: str
+
+
+class PollIndex:
+    """LRU-индекс poll_id → PollRecord с ограниченным размером."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._items: "OrderedDict[str, PollRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, poll_id: str) -> Optional[PollRecord]:
+        with self._lock:
+            rec = self._items.get(poll_id)
+            if rec is None:
+                self._misses += 1
+                return None
+            self._items.move_to_end(poll_id)
+            self._hits += 1
+            return rec
+
+    def put(self, poll_id: str, rec: PollRecord) -> None:
+        with self._lock:
+            self._items[poll_id] = rec
+            self._items.move_to_end(poll_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self._evictions += 1
+
+    def update(self, items: Iterable[Tuple[str, PollRecord]]) -> None:
+        for poll_id, rec in items:
+            self.put(poll_id, rec)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._items),
+                "capacity": self.capacity,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else None,
+            }
+
+
+poll_index = PollIndex(setting("POLL_INDEX_SIZE", 200_000, int))
+GaugeFunc("poll_index_size", "Опросов в индексе poll_id.", lambda: len(poll_index))
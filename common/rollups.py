@@ -0,0 +1,298 @@
+"""Сводные таблицы аналитики: ученик, файл, ученик × файл.
+
+Счётчики учеников (StudentFileStats, StudentStats) пополняются в тех же
+транзакциях, где пишутся события: старт сессии (``bot_app.start_session``),
+пачка ответов (``bot_app.RECORD_ANSWERS_SQL``) и тайм-аут
+(``bot_app.EXPIRE_OVERDUE_SQL``). Вызывающий батч объявляет ``@d``
+(``ROLLUP_DELTA_SQL``), кладёт туда приращения по парам (ученик, файл) и
+добавляет ``APPLY_ROLLUP_SQL``.
+
+Строка файла в FileStats и строка дня в QuizStatsDaily общие для всех, кто
+отвечает: приращение под HOLDLOCK в транзакции ответа выстраивало бы все
+ответы класса в очередь. Их раз в ROLLUP_FOLD_SECONDS сворачивает
+``fold_rollups()`` (задача бота) — из StudentFileStats и из свежих дней
+QuizResults, с отставанием не больше периода.
+
+Первое заполнение из истории — миграция 9 (``BACKFILL_SQL``).
+``rebuild_rollups()`` пересчитывает всё из QuizResults/QuizSessions
+пачками по ученикам — при подозрении на расхождение:
+
+    python -m common.rollups [--batch 500]
+"""
+import argparse, logging, time
+from typing import Dict, Optional, Tuple
+
+from common.db import db_conn
+
+logger = logging.getLogger(__name__)
+
+# Attempts — старты сессии (копия QuizSessions.Attempts: живой путь и пересчёт
+# считают одно и то же); Finished — сессии, пройденные до конца (не по
+# тайм-ауту); FinishSeconds — сумма их длительностей (StartedAt → FinishedAt)
+COUNTERS = ("Attempts", "Answers", "Correct", "Finished", "TimedOut", "FinishSeconds")
+
+ROLLUP_DELTA_SQL = """
+DECLARE @d TABLE (StudentId BIGINT NOT NULL, ProcessedFileId INT NOT NULL,
+                  Attempts INT NOT NULL DEFAULT 0, Answers INT NOT NULL DEFAULT 0,
+                  Correct INT NOT NULL DEFAULT 0, Finished INT NOT NULL DEFAULT 0,
+                  TimedOut INT NOT NULL DEFAULT 0, FinishSeconds INT NOT NULL DEFAULT 0,
+                  PRIMARY KEY (StudentId, ProcessedFileId));
+"""
+
+
+def _merge(table: str, key: str, source: str, count_col: str) -> str:
+    """MERGE приращений в сводную таблицу; ``count_col`` += новые пары."""
+    cols = COUNTERS + (count_col,)
+    return f"""
+MERGE dbo.{table} WITH (HOLDLOCK) AS t
+USING ({source}) AS d
+ON t.{key} = d.{key}
+WHEN MATCHED THEN
+    UPDATE SET {", ".join(f"{c} = t.{c} + d.{c}" for c in cols)},
+               LastActivityAt = SYSUTCDATETIME()
+WHEN NOT MATCHED THEN
+    INSERT ({key}, {", ".join(cols)}, LastActivityAt)
+    VALUES (d.{key}, {", ".join(f"d.{c}" for c in cols)}, SYSUTCDATETIME());
+"""
+
+
+def _grouped(key: str, new_col: str) -> str:
+    sums = ", ".join(f"SUM(d.{c}) AS {c}" for c in COUNTERS)
+    return (f"SELECT d.{key}, {sums}, SUM(CAST(p.IsNew AS INT)) AS {new_col} "
+            f"FROM @d d JOIN @pairs p ON p.StudentId = d.StudentId "
+            f"AND p.ProcessedFileId = d.ProcessedFileId GROUP BY d.{key}")
+
+
+# порядок блокировок везде один: StudentFileStats → StudentStats
+APPLY_ROLLUP_SQL = f"""
+DECLARE @pairs TABLE (StudentId BIGINT, ProcessedFileId INT, IsNew BIT);
+MERGE dbo.StudentFileStats WITH (HOLDLOCK) AS t
+USING @d AS d
+ON t.StudentId = d.StudentId AND t.ProcessedFileId = d.ProcessedFileId
+WHEN MATCHED THEN
+    UPDATE SET {", ".join(f"{c} = t.{c} + d.{c}" for c in COUNTERS)},
+               LastActivityAt = SYSUTCDATETIME()
+WHEN NOT MATCHED THEN
+    INSERT (StudentId, ProcessedFileId, {", ".join(COUNTERS)}, LastActivityAt)
+    VALUES (d.StudentId, d.ProcessedFileId, {", ".join(f"d.{c}" for c in COUNTERS)},
+            SYSUTCDATETIME())
+OUTPUT inserted.StudentId, inserted.ProcessedFileId,
+       CASE WHEN $action = 'INSERT' THEN 1 ELSE 0 END
+INTO @pairs;
+{_merge("StudentStats", "StudentId", _grouped("StudentId", "Files"), "Files")}
+"""
+
+
+# ─────────── свёртка общих строк ───────────
+# FileStats — целиком из StudentFileStats; QuizStatsDaily — дни, начиная с
+# последнего свёрнутого (и не позже вчерашнего: ответы, записанные около
+# полуночи, могут закоммититься после свёртки), по IX_QuizResults_AnsweredAt
+_FILE_SUMS = (f"SELECT ProcessedFileId, {', '.join(f'SUM({c}) AS {c}' for c in COUNTERS)}, "
+              f"COUNT(*) AS Students, MAX(LastActivityAt) AS LastActivityAt "
+              f"FROM dbo.StudentFileStats GROUP BY ProcessedFileId")
+_FILE_COLS = COUNTERS + ("Students", "LastActivityAt")
+
+FOLD_SQL = f"""
+SET NOCOUNT ON;
+SET DEADLOCK_PRIORITY LOW;
+DECLARE @files INT, @days INT;
+MERGE dbo.FileStats WITH (HOLDLOCK) AS t
+USING ({_FILE_SUMS}) AS d
+ON t.ProcessedFileId = d.ProcessedFileId
+WHEN MATCHED AND (t.Answers <> d.Answers OR t.Attempts <> d.Attempts
+                  OR t.Finished <> d.Finished OR t.TimedOut <> d.TimedOut
+                  OR t.Students <> d.Students) THEN
+    UPDATE SET {", ".join(f"{c} = d.{c}" for c in _FILE_COLS)}
+WHEN NOT MATCHED THEN
+    INSERT (ProcessedFileId, {", ".join(_FILE_COLS)})
+    VALUES (d.ProcessedFileId, {", ".join(f"d.{c}" for c in _FILE_COLS)})
+WHEN NOT MATCHED BY SOURCE THEN DELETE;
+SET @files = @@ROWCOUNT;
+
+DECLARE @from DATE = ISNULL((SELECT MAX(Day) FROM dbo.QuizStatsDaily), '19000101');
+DECLARE @yesterday DATE = DATEADD(day, -1, CAST(SYSUTCDATETIME() AS DATE));
+IF @from > @yesterday SET @from = @yesterday;
+MERGE dbo.QuizStatsDaily WITH (HOLDLOCK) AS t
+USING (SELECT CAST(AnsweredAt AS DATE) AS Day, COUNT(*) AS Answers,
+              SUM(CAST(IsCorrect AS INT)) AS Correct
+       FROM dbo.QuizResults
+       WHERE AnsweredAt >= @from
+       GROUP BY CAST(AnsweredAt AS DATE)) AS d
+ON t.Day = d.Day
+WHEN MATCHED AND (t.Answers <> d.Answers OR t.Correct <> d.Correct) THEN
+    UPDATE SET Answers = d.Answers, Correct = d.Correct
+WHEN NOT MATCHED THEN
+    INSERT (Day, Answers, Correct) VALUES (d.Day, d.Answers, d.Correct);
+SET @days = @@ROWCOUNT;
+SELECT @files, @days;
+"""
+
+
+def fold_rollups() -> Tuple[int, int]:
+    """Сворачивает FileStats и QuizStatsDaily; (изменено файлов, дней).
+
+    Пишет только эта задача (и пересчёт), поэтому HOLDLOCK здесь никого из
+    отвечающих не держит: их транзакции FileStats и QuizStatsDaily не трогают.
+    """
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(FOLD_SQL)
+        files, days = cur.fetchone()
+        c.commit()
+    return files, days
+
+
+# ─────────── пересчёт ───────────
+_NEXT_RANGE_SQL = """
+SELECT MAX(StudentId) FROM (
+    SELECT TOP (?) StudentId FROM (
+        SELECT DISTINCT StudentId FROM dbo.QuizSessions WHERE StudentId > ?
+        UNION
+        SELECT DISTINCT StudentId FROM dbo.QuizResults WHERE StudentId > ?
+    ) u ORDER BY StudentId
+) b;
+"""
+
+# тела пересчёта: ученики в (@lo, @hi] и FileStats целиком;
+# ``attempts`` — выражение над QuizSessions: столбец Attempts появился
+# только в миграции 10, а миграция 9 идёт раньше
+def _students_body(attempts: str) -> str:
+    return f"""
+DELETE FROM dbo.StudentFileStats WHERE StudentId > @lo AND StudentId <= @hi;
+INSERT INTO dbo.StudentFileStats
+    (StudentId, ProcessedFileId, {", ".join(COUNTERS)}, LastActivityAt)
+SELECT COALESCE(a.StudentId, s.StudentId), COALESCE(a.ProcessedFileId, s.ProcessedFileId),
+       ISNULL(s.Attempts, 0),
+       ISNULL(a.Answers, 0), ISNULL(a.Correct, 0),
+       CASE WHEN s.FinishedAt IS NOT NULL AND s.TimedOut = 0 THEN 1 ELSE 0 END,
+       CASE WHEN s.TimedOut = 1 THEN 1 ELSE 0 END,
+       CASE WHEN s.FinishedAt IS NOT NULL AND s.TimedOut = 0
+            THEN ISNULL(DATEDIFF(second, s.StartedAt, s.FinishedAt), 0) ELSE 0 END,
+       (SELECT MAX(v) FROM (VALUES (a.LastAt), (s.StartedAt), (s.FinishedAt)) x(v))
+FROM (SELECT r.StudentId, pq.ProcessedFileId, COUNT(*) AS Answers,
+             SUM(CAST(r.IsCorrect AS INT)) AS Correct, MAX(r.AnsweredAt) AS LastAt
+      FROM dbo.QuizResults r
+      JOIN dbo.PendingQuizzes pq ON pq.Id = r.PendingQuizId
+      WHERE r.StudentId > @lo AND r.StudentId <= @hi
+      GROUP BY r.StudentId, pq.ProcessedFileId) a
+FULL JOIN (SELECT StudentId, ProcessedFileId, {attempts} AS Attempts,
+                  StartedAt, FinishedAt, TimedOut
+           FROM dbo.QuizSessions
+           WHERE StudentId > @lo AND StudentId <= @hi AND StartedAt IS NOT NULL) s
+  ON s.StudentId = a.StudentId AND s.ProcessedFileId = a.ProcessedFileId;
+
+DELETE FROM dbo.StudentStats WHERE StudentId > @lo AND StudentId <= @hi;
+INSERT INTO dbo.StudentStats (StudentId, {", ".join(COUNTERS)}, Files, LastActivityAt)
+SELECT StudentId, {", ".join(f"SUM({c})" for c in COUNTERS)}, COUNT(*), MAX(LastActivityAt)
+FROM dbo.StudentFileStats
+WHERE StudentId > @lo AND StudentId <= @hi
+GROUP BY StudentId;
+"""
+
+
+_STUDENTS_BODY = _students_body("Attempts")
+
+_FILES_BODY = f"""
+DELETE FROM dbo.FileStats;
+INSERT INTO dbo.FileStats (ProcessedFileId, {", ".join(COUNTERS)}, Students, LastActivityAt)
+SELECT ProcessedFileId, {", ".join(f"SUM({c})" for c in COUNTERS)}, COUNT(*), MAX(LastActivityAt)
+FROM dbo.StudentFileStats
+GROUP BY ProcessedFileId;
+"""
+
+# при взаимоблокировке с живой записью ответов жертвой будет пересчёт
+REBUILD_STUDENTS_SQL = f"""
+SET NOCOUNT ON;
+SET DEADLOCK_PRIORITY LOW;
+DECLARE @lo BIGINT = ?, @hi BIGINT = ?;
+{_STUDENTS_BODY}
+SELECT @@ROWCOUNT;
+"""
+
+REBUILD_FILES_SQL = f"""
+SET NOCOUNT ON;
+SET DEADLOCK_PRIORITY LOW;
+{_FILES_BODY}
+SELECT @@ROWCOUNT;
+"""
+
+# миграция 9: одна транзакция на всю историю, под блокировкой миграций —
+# живые приращения, пришедшие после миграции 8, заменяются пересчётом.
+# Счётчика стартов тогда ещё нет — у начатой сессии попытка одна; миграция
+# 10 переносит в QuizSessions.Attempts то, что сводка насчитала с тех пор
+BACKFILL_SQL = f"""
+SET NOCOUNT ON;
+DECLARE @lo BIGINT = -9223372036854775808, @hi BIGINT = 9223372036854775807;
+{_students_body("1")}
+{_FILES_BODY}
+"""
+
+_LOCK_SQL = """
+DECLARE @rc INT;
+EXEC @rc = sp_getapplock @Resource='rollups-rebuild', @LockMode='Exclusive',
+                         @LockOwner='Session', @LockTimeout=0;
+SELECT @rc;
+"""
+
+
+def rebuild_rollups(batch: int = 500) -> Optional[Dict[str, int]]:
+    """Пересчитывает сводные таблицы из истории.
+
+    Ученики идут диапазонами по ``batch`` штук, каждый диапазон — своя
+    транзакция: блокировки короткие, живые приращения по другим ученикам
+    не ждут. FileStats собирается из StudentFileStats в конце. Лучше
+    запускать вне занятий: приращения, пришедшие во время пересчёта своего
+    диапазона, сериализуются с ним, но ждут его блокировок.
+
+    Одновременно идёт один пересчёт (``sp_getapplock``); если другой уже
+    запущен — возвращает None.
+    """
+    started = time.monotonic()
+    students = files = batches = 0
+    lo = -2 ** 63
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(_LOCK_SQL)
+        if cur.fetchone()[0] < 0:
+            logger.info("Rollups rebuild is already running, skipped")
+            return None
+        try:
+            while True:
+                cur.execute(_NEXT_RANGE_SQL, batch, lo, lo)
+                hi = cur.fetchone()[0]
+                if hi is None:
+                    break
+                cur.execute(REBUILD_STUDENTS_SQL, lo, hi)
+                students += cur.fetchone()[0]
+                c.commit()
+                batches += 1
+                lo = hi
+            # ученики без единой строки истории (удалённые ответы) — вне диапазонов
+            cur.execute("DELETE FROM dbo.StudentFileStats WHERE StudentId > ?", lo)
+            cur.execute("DELETE FROM dbo.StudentStats WHERE StudentId > ?", lo)
+            cur.execute(REBUILD_FILES_SQL)
+            files = cur.fetchone()[0]
+            c.commit()
+        finally:
+            c.rollback()
+            cur.execute("SET DEADLOCK_PRIORITY NORMAL; "
+                        "EXEC sp_releaseapplock @Resource='rollups-rebuild', @LockOwner='Session';")
+    report = {"students": students, "files": files, "batches": batches,
+              "seconds": round(time.monotonic() - started, 2)}
+    logger.info("Rollups rebuilt: %s", report)
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Пересчёт сводных таблиц аналитики")
+    ap.add_argument("--batch", type=int, default=500, help="учеников на транзакцию")
+    args = ap.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    from common.models import ensure_schema
+    ensure_schema()
+    rebuild_rollups(args.batch)     # итог пишет в лог сам
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import codecs, csv
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pyodbc
+
+from common.db import chunked, placeholders
+
+NAME_MAX = 100          # Students.DisplayName NVARCHAR(100)
+_TRUE = {"1", "true", "yes", "y", "да", "+"}
+_FALSE = {"0", "false", "no", "n", "нет", "-"}
+
+RosterRow = Tuple[int, int, Optional[str], Optional[bool]]   # строка файла, TelegramId, имя, Active
+
+
+def _active(value: str) -> Optional[bool]:
+    v = value.strip().lower()
+    if not v:
+        return None
+    if v in _TRUE:
+        return True
+    if v in _FALSE:
+        return False
+    raise ValueError(f"Active: непонятное значение {value!r}")
+
+
+def parse_roster(stream: IO[bytes], errors: List[str],
+                 max_errors: int = 50) -> Iterator[RosterRow]:
+    """Читает CSV «TelegramId, DisplayName[, Active]» потоком, строка за строкой.
+
+    Разделитель — запятая, точка с запятой или табуляция (по первой строке);
+    строка заголовка пропускается. Ошибочные строки не прерывают разбор —
+    описание попадает в ``errors`` (не больше ``max_errors``).
+    """
+    text = codecs.getreader("utf-8-sig")(stream, errors="replace")
+    first = text.readline()
+    try:
+        dialect = csv.Sniffer().sniff(first, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+
+    def lines():
+        yield first
+        yield from text
+
+    for lineno, row in enumerate(csv.reader(lines(), dialect), 1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        try:
+            tg_id = int(row[0].strip())
+        except ValueError:
+            if lineno == 1:               # заголовок
+                continue
+            if len(errors) < max_errors:
+                errors.append(f"строка {lineno}: TelegramId {row[0]!r} — не число")
+            continue
+        name = row[1].strip() if len(row) > 1 else ""
+        try:
+            active = _active(row[2]) if len(row) > 2 else None
+        except ValueError as e:
+            if len(errors) < max_errors:
+                errors.append(f"строка {lineno}: {e}")
+            continue
+        if len(name) > NAME_MAX:
+            if len(errors) < max_errors:
+                errors.append(f"строка {lineno}: имя длиннее {NAME_MAX} символов, обрезано")
+            name = name[:NAME_MAX]
+        yield lineno, tg_id, name or None, active
+
+
+# ─────────── загрузка: #Roster → MERGE в Students ───────────
+_CREATE_STAGE = """
+IF OBJECT_ID('tempdb..#Roster') IS NOT NULL DROP TABLE #Roster;
+CREATE TABLE #Roster (
+    Line        INT           NOT NULL,
+    TelegramId  BIGINT        NOT NULL,
+    DisplayName NVARCHAR(100) NULL,
+    Active      BIT           NULL
+);
+"""
+
+_STAGE_SQL = "INSERT INTO #Roster (Line, TelegramId, DisplayName, Active) VALUES (?,?,?,?)"
+
+# повтор TelegramId в файле — берём последнюю строку; пустое имя/Active
+# оставляют текущее значение, новые ученики по умолчанию активны
+MERGE_ROSTER_SQL = """
+SET NOCOUNT ON;
+DECLARE @out TABLE (Action NVARCHAR(10));
+MERGE dbo.Students WITH (HOLDLOCK) AS t
+USING (
+    SELECT TelegramId, DisplayName, Active
+    FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY TelegramId ORDER BY Line DESC) AS rn
+          FROM #Roster) r
+    WHERE rn = 1
+) AS s
+ON t.TelegramId = s.TelegramId
+WHEN MATCHED AND EXISTS (SELECT ISNULL(s.DisplayName, t.DisplayName), ISNULL(s.Active, t.Active)
+                        EXCEPT SELECT t.DisplayName, t.Active) THEN
+    UPDATE SET DisplayName = ISNULL(s.DisplayName, t.DisplayName),
+               Active      = ISNULL(s.Active, t.Active)
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT (TelegramId, DisplayName, Active)
+    VALUES (s.TelegramId, s.DisplayName, ISNULL(s.Active, 1))
+OUTPUT $action INTO @out;
+SELECT (SELECT COUNT(*) FROM @out WHERE Action = 'INSERT'),
+       (SELECT COUNT(*) FROM @out WHERE Action = 'UPDATE');
+"""
+
+
+def import_roster(cur, rows: Iterable[RosterRow], batch: int = 1000) -> Dict[str, int]:
+    """Заливает строки во временную #Roster пачками и делает один MERGE.
+
+    В памяти — не больше ``batch`` строк; вставка — ``fast_executemany``.
+    Возвращает {"rows", "inserted", "updated", "unchanged"}; коммит — за
+    вызывающим.
+    """
+    cur.execute(_CREATE_STAGE)
+    cur.fast_executemany = True
+    cur.setinputsizes([
+        (pyodbc.SQL_INTEGER, 0, 0),
+        (pyodbc.SQL_BIGINT, 0, 0),
+        (pyodbc.SQL_WVARCHAR, NAME_MAX, 0),
+        (pyodbc.SQL_BIT, 0, 0),
+    ])
+    total, buf = 0, []
+    for row in rows:
+        buf.append(row)
+        if len(buf) >= batch:
+            cur.executemany(_STAGE_SQL, buf)
+            total += len(buf)
+            buf.clear()
+    if buf:
+        cur.executemany(_STAGE_SQL, buf)
+        total += len(buf)
+    cur.execute(MERGE_ROSTER_SQL)
+    inserted, updated = cur.fetchone()
+    cur.execute("DROP TABLE #Roster")   # соединение вернётся в пул
+    # уникальных TelegramId могло быть меньше строк — «без изменений» по ним
+    return {"rows": total, "inserted": inserted, "updated": updated,
+            "unchanged": max(0, total - inserted - updated)}
+
+
+UPSERT_STUDENT_SQL = """
+MERGE dbo.Students WITH (HOLDLOCK) AS t
+USING (SELECT CAST(? AS BIGINT) AS TelegramId, CAST(? AS NVARCHAR(100)) AS DisplayName) AS s
+ON t.TelegramId = s.TelegramId
+WHEN MATCHED THEN
+    UPDATE SET DisplayName = ISNULL(s.DisplayName, t.DisplayName), Active = 1
+WHEN NOT MATCHED THEN
+    INSERT (TelegramId, DisplayName) VALUES (s.TelegramId, s.DisplayName);
+"""
+
+
+def upsert_student(cur, tg_id: int, name: Optional[str]) -> None:
+    """Добавляет ученика или, если он уже есть, обновляет имя и активирует."""
+    cur.execute(UPSERT_STUDENT_SQL, tg_id, (name or "").strip()[:NAME_MAX] or None)
+
+
+def set_active(cur, ids: Sequence[int], active: bool) -> int:
+    """Включает/выключает учеников по Students.Id; возвращает число изменённых."""
+    changed = 0
+    for part in chunked(list(ids), 1000):
+        cur.execute(
+            f"UPDATE dbo.Students SET Active=? WHERE Active<>? AND Id IN ({placeholders(len(part))})",
+            int(active), int(active), *part,
+        )
+        changed += max(cur.rowcount, 0)
+    return changed
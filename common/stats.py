@@ -0,0 +1,55 @@
+import threading, time
+from typing import Optional
+
+from common.config import setting
+from common.db import db_conn
+
+DASH_TTL = setting("DASH_CACHE_TTL", 10.0, float)
+
+# Ответы и точность — из дневных агрегатов QuizStatsDaily, которые бот
+# сворачивает из QuizResults раз в ROLLUP_FOLD_SECONDS (см.
+# common.rollups.fold_rollups): цифры отстают от ответов на этот период.
+DASH_SQL = """
+SET NOCOUNT ON;
+SELECT (SELECT COUNT(*) FROM dbo.Students),
+       (SELECT COUNT(*) FROM dbo.PendingQuizzes),
+       ISNULL(SUM(CAST(Answers AS BIGINT)), 0),
+       ISNULL(SUM(CAST(Correct AS BIGINT)), 0)
+FROM dbo.QuizStatsDaily;
+SELECT TOP (?) Day, Answers, Correct FROM dbo.QuizStatsDaily ORDER BY Day DESC;
+"""
+
+_lock = threading.Lock()
+_cached: Optional[dict] = None
+_cached_at = 0.0
+
+
+def _load(days: int) -> dict:
+    with db_conn() as c, c.cursor() as cur:
+        cur.execute(DASH_SQL, days)
+        students, questions, answers, correct = cur.fetchone()
+        cur.nextset()
+        daily = [
+            {"day": d, "answers": a, "correct": ok,
+             "accuracy": round(ok * 100 / a, 1) if a else None}
+            for d, a, ok in cur.fetchall()
+        ]
+    return {
+        "students": students,
+        "questions": questions,
+        "answers": answers,
+        "correct": correct,
+        "accuracy": round(correct * 100 / answers, 1) if answers else None,
+        "daily": daily,
+    }
+
+
+def dashboard_stats(days: int = 14) -> dict:
+    """Сводка для дашборда; кэшируется на DASH_CACHE_TTL секунд."""
+    global _cached, _cached_at
+    with _lock:
+        if _cached is not None and time.monotonic() - _cached_at < DASH_TTL:
+            return _cached
+        _cached = _load(days)
+        _cached_at = time.monotonic()
+        return _cached
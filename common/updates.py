@@ -0,0 +1,175 @@
+import asyncio, threading, time
+from typing import Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from common.config import setting
+from common.db import profiler
+from common.metrics import GaugeFunc
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    """Ключ упорядочивания: пользователь, иначе чат; None — без порядка."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+def update_label(update: object) -> str:
+    """Метка для метрик: команда, префикс callback_data или тип обновления."""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query and update.callback_query.data:
+        return "callback:" + update.callback_query.data.split(":", 1)[0]
+    msg = update.effective_message
+    if msg and msg.text and msg.text.startswith("/"):
+        return msg.text.split()[0].split("@", 1)[0]
+    if update.poll_answer:
+        return "poll_answer"
+    for kind in Update.ALL_TYPES:
+        if getattr(update, kind, None) is not None:
+            return kind
+    return "update"
+
+
+class _Key:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class _Metric:
+    __slots__ = ("in_flight", "max_in_flight", "done", "failed",
+                 "wait_total", "wait_max", "run_total")
+
+    def __init__(self):
+        self.in_flight = self.max_in_flight = self.done = self.failed = 0
+        self.wait_total = self.wait_max = self.run_total = 0.0
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с порядком внутри пользователя.
+
+    Одновременно выполняется не больше ``max_concurrent_updates``
+    обновлений; обновления с одним ключом (``update_key``) идут строго по
+    очереди в порядке поступления. Слот занимается только после того, как
+    подошла очередь ключа, — ждущие своей очереди не держат слоты.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._keys: Dict[Hashable, _Key] = {}
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()     # stats() зовут и из других потоков
+        self._waiting = 0
+        self._running = 0
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = update_key(update)
+        entry = None
+        if key is not None:
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = self._keys[key] = _Key()
+            entry.users += 1
+        metric = self._metric(update_label(update))
+        queued = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            if entry is not None:
+                await entry.lock.acquire()
+            try:
+                async with self._slots:
+                    started = time.monotonic()
+                    with self._lock:
+                        self._waiting -= 1
+                        self._running += 1
+                        metric.in_flight += 1
+                        metric.max_in_flight = max(metric.max_in_flight, metric.in_flight)
+                        metric.wait_total += started - queued
+                        metric.wait_max = max(metric.wait_max, started - queued)
+                    queued = None
+                    ok = False
+                    try:
+                        await self.do_process_update(update, coroutine)
+                        ok = True
+                    finally:
+                        with self._lock:
+                            self._running -= 1
+                            metric.in_flight -= 1
+                            metric.done += 1
+                            metric.failed += not ok
+                            metric.run_total += time.monotonic() - started
+            finally:
+                if entry is not None:
+                    entry.lock.release()
+        finally:
+            if queued is not None:        # отменили, пока ждали очереди
+                with self._lock:
+                    self._waiting -= 1
+            if entry is not None:
+                entry.users -= 1
+                if not entry.users:
+                    del self._keys[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if not profiler.enabled:
+            await coroutine
+            return
+        update_id = update.update_id if isinstance(update, Update) else None
+        with profiler.scope(update_label(update), update_id):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _metric(self, label: str) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(label)
+            if metric is None:
+                if len(self._metrics) >= 100:    # произвольные /команды
+                    label = "other"
+                metric = self._metrics.setdefault(label, _Metric())
+            return metric
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent_updates,
+                "running": self._running,
+                "waiting": self._waiting,
+                "keys": len(self._keys),
+                "handlers": {
+                    label: {
+                        "in_flight": m.in_flight,
+                        "max_in_flight": m.max_in_flight,
+                        "done": m.done,
+                        "failed": m.failed,
+                        "wait_avg_ms": round(m.wait_total * 1000 / m.done, 3)
+                        if m.done else 0.0,
+                        "wait_max_ms": round(m.wait_max * 1000, 3),
+                        "run_avg_ms": round(m.run_total * 1000 / m.done, 3)
+                        if m.done else 0.0,
+                    }
+                    for label, m in sorted(self._metrics.items())
+                },
+            }
+
+
+update_processor = KeyedUpdateProcessor(setting("UPDATE_CONCURRENCY", 64, int))
+GaugeFunc("bot_updates", "Обновления в обработке и в очереди.",
+          lambda: {("running",): update_processor.stats()["running"],
+                   ("waiting",): update_processor.stats()["waiting"]},
+          ["state"])
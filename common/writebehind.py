@@ -0,0 +1,117 @@
+import asyncio, logging, time
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehind:
+    """Очередь отложенной записи с микро-пачками.
+
+    ``submit()`` ставит элемент в очередь и возвращает future с результатом
+    его записи. Пачка уходит в ``flush(items) -> results`` (результаты по
+    одному на элемент), когда набралось ``max_rows`` элементов или прошло
+    ``max_delay`` с от первого. Полная очередь (``max_queue``) тормозит
+    ``submit()`` — это backpressure. ``stop()`` дописывает всё, что осталось.
+    """
+
+    def __init__(self, flush: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_rows: int = 200, max_delay: float = 0.02,
+                 max_queue: int = 10000, attempts: int = 3):
+        self._flush_fn = flush
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.attempts = attempts
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._batches = 0
+        self._rows = 0
+        self._failed = 0
+        self._flush_time = 0.0
+        self._backpressure = 0
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item) -> asyncio.Future:
+        if self._closing:
+            raise RuntimeError("write-behind queue is stopped")
+        fut = asyncio.get_running_loop().create_future()
+        if self._queue.full():
+            self._backpressure += 1
+        await self._queue.put((item, fut))
+        if self._queue.qsize() >= self.max_rows:
+            self._full.set()
+        return fut
+
+    async def stop(self) -> None:
+        if self._task is None or self._closing:
+            return
+        self._closing = True
+        await self._queue.put((_STOP, None))
+        self._full.set()
+        await self._task
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.max_rows - 1 and batch[0][0] is not _STOP:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            while len(batch) < self.max_rows and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            stop = any(item is _STOP for item, _ in batch)
+            batch = [(item, fut) for item, fut in batch if item is not _STOP]
+            if batch:
+                await self._write(batch)
+            if stop:
+                # после сигнала остановки могли успеть положить ещё элементы
+                rest = []
+                while not self._queue.empty():
+                    rest.append(self._queue.get_nowait())
+                for i in range(0, len(rest), self.max_rows):
+                    await self._write(rest[i:i + self.max_rows])
+                return
+
+    async def _write(self, batch) -> None:
+        items = [item for item, _ in batch]
+        started = time.monotonic()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                results = await self._flush_fn(items)
+                break
+            except Exception as e:  # noqa: BLE001
+                if attempt == self.attempts:
+                    logger.exception("Write-behind flush of %s rows failed", len(items))
+                    self._failed += len(items)
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    return
+                await asyncio.sleep(0.2 * 2 ** (attempt - 1))
+        self._batches += 1
+        self._rows += len(items)
+        self._flush_time += time.monotonic() - started
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "max_queue": self._queue.maxsize,
+            "batches": self._batches,
+            "rows": self._rows,
+            "failed_rows": self._failed,
+            "backpressure_waits": self._backpressure,
+            "avg_batch": round(self._rows / self._batches, 2) if self._batches else 0.0,
+            "avg_flush_ms": round(self._flush_time * 1000 / self._batches, 3)
+            if self._batches else 0.0,
+        }
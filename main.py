@@ -1,15 +1,103 @@
+"""Запуск бота и веб-панели.
 
-from threading import Thread
-from bot_app import run_bot
-from web_app import create_app
+    python main.py [all]    # панель отдельными процессами + бот (long polling)
+    python main.py bot      # только бот
+    python main.py web      # только панель: gunicorn, WEB_WORKERS процессов
+    python main.py webhook  # бот через webhook: роутер и воркеры (webhook.py)
 
+Тяжёлые модули импортируются внутри режимов: процесс бота не загружает
+Flask, процессы панели — python-telegram-bot. Поэтому метрики и отладка
+у них раздельные: панель — /metrics и /debug/* на WEB_BIND, бот — на
+BOT_METRICS_PORT (common.debugserver); /debug/* панели подтягивают данные
+бота оттуда.
+"""
+import argparse, logging, os, signal, subprocess, sys
 
-def run_web():
-    app=create_app()
-    app.run(host='0.0.0.0', port=8000, threaded=True)
+from common.config import setting
 
+logger = logging.getLogger("main")
 
-if __name__=='__main__':
-    Thread(target=run_web, daemon=True).start()
+WEB_BIND = setting("WEB_BIND", "0.0.0.0:8000")
+WEB_WORKERS = setting("WEB_WORKERS", min(4, (os.cpu_count() or 1) + 1), int)
+WEB_THREADS = setting("WEB_THREADS", 4, int)
+WEB_TIMEOUT = setting("WEB_TIMEOUT", 60, int)
+WEB_GRACEFUL_TIMEOUT = setting("WEB_GRACEFUL_TIMEOUT", 30, int)
+# воркер перезапускается после стольких запросов (± jitter) — против утечек
+WEB_MAX_REQUESTS = setting("WEB_MAX_REQUESTS", 1000, int)
+WEB_MAX_REQUESTS_JITTER = setting("WEB_MAX_REQUESTS_JITTER", 100, int)
+
+
+def run_bot() -> None:
+    from bot_app import run_bot
     run_bot()
 
+
+def run_webhook() -> None:
+    from webhook import main as webhook_main
+    webhook_main(["serve"])
+
+
+def run_web() -> None:
+    # пул БД у каждого воркера свой: соединений нужно не больше, чем потоков
+    os.environ.setdefault("DB_POOL_SIZE", str(WEB_THREADS))
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:          # gunicorn только под Unix
+        logger.warning("gunicorn is not available, falling back to the Flask dev server")
+        from web_app import create_app
+        host, _, port = WEB_BIND.rpartition(":")
+        create_app().run(host=host or "0.0.0.0", port=int(port), threaded=True)
+        return
+
+    class WebServer(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": WEB_BIND,
+                "workers": WEB_WORKERS,
+                "worker_class": "gthread",
+                "threads": WEB_THREADS,
+                "timeout": WEB_TIMEOUT,
+                "graceful_timeout": WEB_GRACEFUL_TIMEOUT,
+                "max_requests": WEB_MAX_REQUESTS,
+                "max_requests_jitter": WEB_MAX_REQUESTS_JITTER,
+                "proc_name": "quizbot-web",
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # импорт в воркере, после fork: у каждого свои соединения с БД
+            from web_app import create_app
+            return create_app()
+
+    WebServer().run()
+
+
+def run_all() -> None:
+    web = subprocess.Popen([sys.executable, os.path.abspath(__file__), "web"])
+    try:
+        run_bot()
+    finally:
+        if web.poll() is None:
+            web.send_signal(signal.SIGTERM)      # gunicorn: мягкая остановка
+            try:
+                web.wait(WEB_GRACEFUL_TIMEOUT + 5)
+            except subprocess.TimeoutExpired:
+                web.kill()
+
+
+MODES = {"all": run_all, "bot": run_bot, "web": run_web, "webhook": run_webhook}
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="QuizBot: бот и веб-панель")
+    ap.add_argument("mode", nargs="?", default="all", choices=MODES)
+    args = ap.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    MODES[args.mode]()
+
+
+if __name__ == '__main__':
+    main()
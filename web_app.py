@@ -1,8 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import (
+    Flask, Response, abort, jsonify, render_template, request, redirect, url_for,
+)
 from jinja2 import DictLoader
-import json
-from common.db import db_conn
+from datetime import date, datetime, timedelta
+import json, logging, re, threading
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+from common.config import setting
+from common.db import db_conn, executor_stats, pool_stats, profiler
+from common.export import FORMATS, gzip_stream, stream_rows
+from common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render as render_metrics
 from common.models import ensure_schema
+from common.roster import import_roster, parse_roster, set_active, upsert_student
+from common.rollups import rebuild_rollups
+from common.stats import dashboard_stats
 
 # ---------- шаблоны ---------------------------------------------------------
 BASE = """{% macro nav() %}
@@ -12,6 +23,7 @@ BASE = """{% macro nav() %}
   <div class='navbar-nav'>
    <a class='nav-link' href='/students'>Students</a>
    <a class='nav-link' href='/results'>Results</a>
+   <a class='nav-link' href='/analytics/files'>Analytics</a>
   </div>
  </div>
 </nav>
@@ -37,29 +49,85 @@ DASH = """{% extends 'base.html' %}{% block body %}
    </div>
   </div>
  {% endfor %}
-</div>{% endblock %}"""
+</div>
+{% if daily %}
+<h5 class='mt-5'>Last {{ daily|length }} days</h5>
+<table class='table table-sm w-auto'>
+ <thead><tr><th>Day</th><th>Answers</th><th>Accuracy</th></tr></thead><tbody>
+ {% for d in daily %}
+  <tr><td>{{ d.day }}</td><td>{{ d.answers }}</td>
+      <td>{{ '%s%%'|format(d.accuracy) if d.accuracy is not none else '—' }}</td></tr>
+ {% endfor %}
+ </tbody></table>
+{% endif %}{% endblock %}"""
 
 STUD = """{% extends 'base.html' %}{% block body %}
 <h1 class='mb-4'>Students</h1>
-<form class='row gx-2 gy-2' method='post'>
- <div class='col-auto'><input name='tgid' class='form-control' placeholder='Telegram ID' required></div>
- <div class='col-auto'><input name='name' class='form-control' placeholder='Display name'></div>
- <div class='col-auto'><button class='btn btn-primary'>Add</button></div>
-</form><hr>
+<div class='row gy-3'>
+ <form class='col-md-6 row gx-2 gy-2' method='post'>
+  <div class='col-auto'><input name='tgid' class='form-control' placeholder='Telegram ID' required></div>
+  <div class='col-auto'><input name='name' class='form-control' placeholder='Display name'></div>
+  <div class='col-auto'><button class='btn btn-primary'>Add</button></div>
+ </form>
+ <form class='col-md-6 row gx-2 gy-2' method='post' action='{{ url_for('students_import') }}' enctype='multipart/form-data'>
+  <div class='col-auto'><input type='file' name='roster' accept='.csv,text/csv' class='form-control' required></div>
+  <div class='col-auto'><button class='btn btn-outline-primary'>Import CSV</button></div>
+  <div class='form-text'>TelegramId, DisplayName[, Active] — one student per line, header optional.</div>
+ </form>
+</div>
+{% if report %}
+<div class='alert alert-{{ 'warning' if report.errors else 'success' }} mt-3'>
+ Imported {{ report.rows }} rows: {{ report.inserted }} added, {{ report.updated }} updated, {{ report.unchanged }} unchanged.
+ {% if report.errors %}<ul class='mb-0'>{% for e in report.errors %}<li>{{ e }}</li>{% endfor %}</ul>{% endif %}
+</div>
+{% endif %}<hr>
+<form class='row gx-2 gy-2 mb-3' method='get'>
+ <div class='col-auto'><input name='q' value='{{ f.q or '' }}' class='form-control' placeholder='Telegram ID or name'></div>
+ <div class='col-auto'><select name='active' class='form-select'>
+  <option value=''>All</option>
+  <option value='1' {{ 'selected' if f.active == 1 }}>Active</option>
+  <option value='0' {{ 'selected' if f.active == 0 }}>Inactive</option>
+ </select></div>
+ <div class='col-auto'><button class='btn btn-primary'>Filter</button></div>
+</form>
+<form method='post' action='{{ url_for('students_bulk', after=cursor, **f) }}'>
+<div class='mb-2'>
+ <button name='action' value='activate' class='btn btn-outline-success btn-sm'>Activate selected</button>
+ <button name='action' value='deactivate' class='btn btn-outline-danger btn-sm'>Deactivate selected</button>
+</div>
 <table class='table table-striped'>
- <thead><tr><th>#</th><th>Telegram</th><th>Name</th><th>Active</th></tr></thead><tbody>
+ <thead><tr><th><input type='checkbox' class='form-check-input' onclick="document.querySelectorAll('input[name=ids]').forEach(c => c.checked = this.checked)"></th>
+  <th>#</th><th>Telegram</th><th>Name</th><th>Active</th></tr></thead><tbody>
  {% for s in students %}
   <tr>
+    <td><input type='checkbox' class='form-check-input' name='ids' value='{{ s.Id }}'></td>
     <td>{{ s.Id }}</td>
     <td>{{ s.TelegramId }}</td>
     <td>{{ s.DisplayName or '' }}</td>
     <td>{{ '✔' if s.Active else '✖' }}</td>
   </tr>
  {% endfor %}
- </tbody></table>{% endblock %}"""
+ </tbody></table>
+</form>
+<nav class='mb-4'>
+ {% if cursor %}<a class='btn btn-outline-secondary btn-sm' href='{{ url_for('students', **f) }}'>« First</a>{% endif %}
+ {% if next_cursor %}<a class='btn btn-outline-primary btn-sm' href='{{ url_for('students', after=next_cursor, **f) }}'>Next »</a>{% endif %}
+</nav>{% endblock %}"""
 
 RES = """{% extends 'base.html' %}{% block body %}
-<h1 class='mb-4'>Results</h1>
+<h1 class='mb-4'>Results
+ <small class='fs-6 ms-3'>
+  export: <a href='{{ url_for('export', kind='results', fmt='csv', **f) }}'>CSV</a> ·
+  <a href='{{ url_for('export', kind='results', fmt='ndjson', **f) }}'>NDJSON</a>
+ </small></h1>
+<form class='row gx-2 gy-2 mb-3' method='get'>
+ <div class='col-auto'><input name='student' value='{{ f.student or '' }}' class='form-control' placeholder='Telegram ID'></div>
+ <div class='col-auto'><input name='file' value='{{ f.file or '' }}' class='form-control' placeholder='ProcessedFileId'></div>
+ <div class='col-auto'><input name='from' type='date' value='{{ f.from or '' }}' class='form-control'></div>
+ <div class='col-auto'><input name='to' type='date' value='{{ f.to or '' }}' class='form-control'></div>
+ <div class='col-auto'><button class='btn btn-primary'>Filter</button></div>
+ <div class='col-auto'><a class='btn btn-link' href='{{ url_for('results') }}'>Reset</a></div>
+</form>
 <table class='table table-bordered table-sm'>
 <thead><tr><th>Student</th><th>QuizId</th><th>Chosen</th><th>Correct</th><th>When</th></tr></thead><tbody>
 {% for r in rows %}
@@ -71,24 +139,233 @@ RES = """{% extends 'base.html' %}{% block body %}
   <td>{{ r.AnsweredAt }}</td>
  </tr>
 {% endfor %}
-</tbody></table>{% endblock %}"""
+</tbody></table>
+<nav class='mb-4'>
+ {% if cursor %}<a class='btn btn-outline-secondary btn-sm' href='{{ url_for('results', **f) }}'>« First</a>{% endif %}
+ {% if next_cursor %}<a class='btn btn-outline-primary btn-sm' href='{{ url_for('results', before=next_cursor, **f) }}'>Next »</a>{% endif %}
+</nav>{% endblock %}"""
+
+QRY = """{% extends 'base.html' %}{% block body %}
+<h1 class='mb-3'>SQL profile
+ <small class='fs-6 ms-3'><a href='{{ url_for('debug_queries', format='json', source=source) }}'>JSON</a></small></h1>
+<ul class='nav nav-pills mb-3'>
+ {% for key, label in sources %}
+  <li class='nav-item'><a class='nav-link {{ 'active' if key == source }}' href='{{ url_for('debug_queries', source=key) }}'>{{ label }}</a></li>
+ {% endfor %}
+</ul>
+{% if p.error %}
+<div class='alert alert-danger'>Bot process unavailable: {{ p.error }}</div>
+{% elif not p.enabled %}
+<div class='alert alert-secondary'>Profiler is off — set <code>DB_PROFILE=1</code> and restart.</div>
+{% else %}
+<form method='post' class='mb-3'>
+ <span class='text-muted me-3'>last {{ p.window }} statements · slow ≥ {{ p.slow_ms }} ms · budget {{ p.budget }} per update</span>
+ <button class='btn btn-outline-danger btn-sm'>Reset</button>
+</form>
+<h5>Per handler</h5>
+<table class='table table-sm w-auto'>
+ <thead><tr><th>Handler</th><th>Updates</th><th>Queries</th><th>Avg</th><th>Max</th><th>Over budget</th></tr></thead><tbody>
+ {% for h in p.handlers %}
+  <tr class='{{ 'table-warning' if h.over_budget }}'><td>{{ h.handler }}</td><td>{{ h.updates }}</td><td>{{ h.queries }}</td>
+      <td>{{ h.avg }}</td><td>{{ h.max }}</td><td>{{ h.over_budget }}</td></tr>
+ {% endfor %}
+ </tbody></table>
+<h5 class='mt-4'>Top statements by total time</h5>
+<table class='table table-sm'>
+ <thead><tr><th>Statement</th><th>Calls</th><th>Total ms</th><th>Avg ms</th><th>Max ms</th><th>Rows</th><th>Handlers</th></tr></thead><tbody>
+ {% for q in p.top %}
+  <tr><td><code class='small'>{{ q.sql|truncate(300) }}</code></td><td>{{ q.calls }}</td><td>{{ q.total_ms }}</td>
+      <td>{{ q.avg_ms }}</td><td>{{ q.max_ms }}</td><td>{{ q.rows }}</td><td>{{ q.handlers|join(', ') }}</td></tr>
+ {% endfor %}
+ </tbody></table>
+<h5 class='mt-4'>Updates over budget</h5>
+<table class='table table-sm'>
+ <thead><tr><th>Handler</th><th>Update</th><th>Queries</th><th>ms</th><th>Most repeated</th></tr></thead><tbody>
+ {% for u in p.over_budget %}
+  <tr><td>{{ u.handler }}</td><td>{{ u.update_id or '' }}</td><td>{{ u.queries }}</td><td>{{ u.ms }}</td>
+      <td>{% for sql, n in u.statements %}<div><span class='badge text-bg-secondary'>×{{ n }}</span> <code class='small'>{{ sql|truncate(120) }}</code></div>{% endfor %}</td></tr>
+ {% endfor %}
+ </tbody></table>
+<h5 class='mt-4'>Slow statements</h5>
+<table class='table table-sm'>
+ <thead><tr><th>ms</th><th>Rows</th><th>Handler</th><th>Update</th><th>Statement</th></tr></thead><tbody>
+ {% for q in p.slow %}
+  <tr><td>{{ q.ms }}</td><td>{{ q.rows }}</td><td>{{ q.handler }}</td><td>{{ q.update_id or '' }}</td>
+      <td><code class='small'>{{ q.sql|truncate(300) }}</code></td></tr>
+ {% endfor %}
+ </tbody></table>
+{% endif %}{% endblock %}"""
+ANA_MACROS = """{% macro duration(s) %}{{ '%d:%02d'|format(s // 60, s % 60) if s is not none else '—' }}{% endmacro %}
+{% macro pct(v) %}{{ '%s%%'|format(v) if v is not none else '—' }}{% endmacro %}
+{% macro tabs(active) %}
+<ul class='nav nav-tabs mb-3'>
+ <li class='nav-item'><a class='nav-link {{ 'active' if active == 'files' }}' href='{{ url_for('analytics_files') }}'>Files</a></li>
+ <li class='nav-item'><a class='nav-link {{ 'active' if active == 'students' }}' href='{{ url_for('analytics_students') }}'>Students</a></li>
+ <li class='nav-item ms-auto'><form method='post' action='{{ url_for('analytics_rebuild') }}'>
+  <button class='btn btn-outline-secondary btn-sm' title='Recount rollups from the full history'>Rebuild</button></form></li>
+</ul>
+{% if rebuild is defined %}<div class='alert alert-{{ 'info' if rebuild else 'warning' }}'>
+ {{ 'Rollup rebuild started in the background — reload the page in a few minutes.' if rebuild
+    else 'A rollup rebuild is already running in this worker.' }}</div>{% endif %}
+{% endmacro %}"""
+
+ANA_FILES = """{% extends 'base.html' %}{% from 'ana_macros.html' import duration, pct, tabs with context %}{% block body %}
+<h1 class='mb-4'>Analytics</h1>
+{{ tabs('files') }}
+<div class='mb-2 small'>sort:
+ <a href='{{ url_for('analytics_files', sort='accuracy') }}'>lowest accuracy</a> ·
+ <a href='{{ url_for('analytics_files', sort='recent') }}'>recent</a> ·
+ <a href='{{ url_for('analytics_files', sort='file') }}'>newest file</a></div>
+<table class='table table-sm table-striped'>
+ <thead><tr><th>File</th><th>Students</th><th>Attempts</th><th>Answers</th><th>Accuracy</th>
+  <th>Finished</th><th>Timed out</th><th>Avg time</th><th>Last activity</th></tr></thead><tbody>
+ {% for r in rows %}
+  <tr><td><a href='{{ url_for('analytics_file', pf_id=r.ProcessedFileId) }}'>{{ r.FileName or r.ProcessedFileId }}</a></td>
+   <td>{{ r.Students }}</td><td>{{ r.Attempts }}</td><td>{{ r.Answers }}</td><td>{{ pct(r.Accuracy) }}</td>
+   <td>{{ r.Finished }}</td><td>{{ r.TimedOut }}</td><td>{{ duration(r.AvgSeconds) }}</td><td>{{ r.LastActivityAt or '' }}</td></tr>
+ {% endfor %}
+ </tbody></table>{% endblock %}"""
+
+ANA_STUDENTS = """{% extends 'base.html' %}{% from 'ana_macros.html' import duration, pct, tabs with context %}{% block body %}
+<h1 class='mb-4'>Analytics</h1>
+{{ tabs('students') }}
+<table class='table table-sm table-striped'>
+ <thead><tr><th>Telegram</th><th>Name</th><th>Files</th><th>Attempts</th><th>Answers</th><th>Accuracy</th>
+  <th>Finished</th><th>Timed out</th><th>Avg time</th><th>Last activity</th></tr></thead><tbody>
+ {% for r in rows %}
+  <tr><td><a href='{{ url_for('analytics_student', student=r.StudentId) }}'>{{ r.StudentId }}</a></td>
+   <td>{{ r.DisplayName or '' }}</td><td>{{ r.Files }}</td><td>{{ r.Attempts }}</td><td>{{ r.Answers }}</td>
+   <td>{{ pct(r.Accuracy) }}</td><td>{{ r.Finished }}</td><td>{{ r.TimedOut }}</td>
+   <td>{{ duration(r.AvgSeconds) }}</td><td>{{ r.LastActivityAt or '' }}</td></tr>
+ {% endfor %}
+ </tbody></table>
+<nav class='mb-4'>
+ {% if cursor is not none %}<a class='btn btn-outline-secondary btn-sm' href='{{ url_for('analytics_students') }}'>« First</a>{% endif %}
+ {% if next_cursor is not none %}<a class='btn btn-outline-primary btn-sm' href='{{ url_for('analytics_students', after=next_cursor) }}'>Next »</a>{% endif %}
+</nav>{% endblock %}"""
+
+ANA_DETAIL = """{% extends 'base.html' %}{% from 'ana_macros.html' import duration, pct %}{% block body %}
+<h1 class='mb-1'>{{ title }}</h1>
+<p class='text-muted mb-4'><a href='{{ back }}'>« Analytics</a></p>
+{% if total %}
+<div class='row g-3 mb-4'>
+ {% for label, value in [('Answers', total.Answers), ('Accuracy', pct(total.Accuracy)), ('Finished', total.Finished),
+                         ('Timed out', total.TimedOut), ('Avg time', duration(total.AvgSeconds))] %}
+  <div class='col-6 col-md-2'><div class='card shadow-sm'><div class='card-body'>
+   <h6 class='card-title'>{{ label }}</h6><h4>{{ value }}</h4></div></div></div>
+ {% endfor %}
+</div>
+{% endif %}
+<table class='table table-sm table-striped'>
+ <thead><tr><th>{{ 'File' if by == 'file' else 'Student' }}</th><th>Attempts</th><th>Answers</th><th>Accuracy</th>
+  <th>Finished</th><th>Timed out</th><th>Avg time</th><th>Last activity</th></tr></thead><tbody>
+ {% for r in rows %}
+  <tr><td>{% if by == 'file' %}<a href='{{ url_for('analytics_file', pf_id=r.ProcessedFileId) }}'>{{ r.FileName or r.ProcessedFileId }}</a>
+          {% else %}<a href='{{ url_for('analytics_student', student=r.StudentId) }}'>{{ r.DisplayName or r.StudentId }}</a>{% endif %}</td>
+   <td>{{ r.Attempts }}</td><td>{{ r.Answers }}</td><td>{{ pct(r.Accuracy) }}</td><td>{{ r.Finished }}</td>
+   <td>{{ r.TimedOut }}</td><td>{{ duration(r.AvgSeconds) }}</td><td>{{ r.LastActivityAt or '' }}</td></tr>
+ {% endfor %}
+ </tbody></table>{% endblock %}"""
 # ---------------------------------------------------------------------------
 
+logger = logging.getLogger(__name__)
+
 def dictrows(cur):
     cols = [c[0] for c in cur.description]
     return [dict(zip(cols, r)) for r in cur.fetchall()]
 
-def scalar(sql: str):
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute(sql)
-        return cur.fetchone()[0] or 0
+PAGE_SIZE = 100
+
+# аналитика читает только сводные таблицы (common.rollups), не историю
+_RATES = ('CAST(x.Correct * 100.0 / NULLIF(x.Answers, 0) AS DECIMAL(5,1)) AS Accuracy, '
+          'x.FinishSeconds / NULLIF(x.Finished, 0) AS AvgSeconds')
+_FILE_SORTS = {
+    'accuracy': 'CASE WHEN x.Answers = 0 THEN 1 ELSE 0 END, Accuracy, x.ProcessedFileId',
+    'recent': 'x.LastActivityAt DESC',
+    'file': 'x.ProcessedFileId DESC',
+}
+# /debug/* процессов бота (common.debugserver): у панели свои процессы,
+# метрики и журнал SQL бота видны только через них. Через запятую —
+# воркеры webhook (BOT_METRICS_PORT + индекс).
+BOT_DEBUG_URLS = [u.strip().rstrip('/') for u in
+                  setting('BOT_DEBUG_URLS', 'http://127.0.0.1:9100').split(',') if u.strip()]
+BOT_DEBUG_TIMEOUT = setting('BOT_DEBUG_TIMEOUT', 2.0, float)
+_CURSOR_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d{1,7})?)_(\d+)$')
+
+def bot_debug(url, path, method='GET'):
+    """JSON от отладочного сервера бота; при недоступности — {'error': ...}."""
+    try:
+        with urlopen(Request(url + path, method=method), timeout=BOT_DEBUG_TIMEOUT) as resp:
+            body = resp.read()
+        return json.loads(body) if body else {}
+    except (URLError, OSError, ValueError) as e:
+        return {'error': str(getattr(e, 'reason', e))}
+
+def results_filter(args):
+    """Фильтры /results из query string → (нормализованные значения, WHERE, параметры)."""
+    f = {
+        'student': args.get('student', type=int),
+        'file': args.get('file', type=int),
+        'from': args.get('from', type=date.fromisoformat),
+        'to': args.get('to', type=date.fromisoformat),
+    }
+    where, params = [], []
+    if f['student'] is not None:
+        where.append('qr.StudentId = ?')
+        params.append(f['student'])
+    if f['file'] is not None:
+        where.append('qr.PendingQuizId IN '
+                     '(SELECT Id FROM dbo.PendingQuizzes WHERE ProcessedFileId = ?)')
+        params.append(f['file'])
+    if f['from']:
+        where.append('qr.AnsweredAt >= ?')
+        params.append(datetime.combine(f['from'], datetime.min.time()))
+    if f['to']:
+        where.append('qr.AnsweredAt < ?')
+        params.append(datetime.combine(f['to'] + timedelta(days=1), datetime.min.time()))
+    f = {k: (v.isoformat() if isinstance(v, date) else v)
+         for k, v in f.items() if v is not None}
+    return f, where, params
 
-def accuracy():
-    """Возвращает accuracy (0‒100) либо None, если результатов ещё нет."""
-    with db_conn() as c, c.cursor() as cur:
-        cur.execute("SELECT IsCorrect FROM dbo.QuizResults")
-        vals = [r[0] for r in cur.fetchall()]
-    return round(sum(vals) * 100 / len(vals), 1) if vals else None
+_rebuild_lock = threading.Lock()
+
+def start_rebuild():
+    """Запускает rebuild_rollups() в фоновом потоке; False — уже идёт.
+
+    Пересчёт большой истории идёт минуты — дольше таймаута воркера, поэтому
+    не в запросе. Между воркерами и с CLI его сериализует sp_getapplock.
+    """
+    if not _rebuild_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            rebuild_rollups()
+        except Exception:
+            logger.exception('Rollups rebuild failed')
+        finally:
+            _rebuild_lock.release()
+
+    threading.Thread(target=run, name='rollups-rebuild', daemon=True).start()
+    return True
+
+def students_filter(args):
+    """Фильтры /students: Telegram ID (точно) или начало имени, активность."""
+    f = {'q': args.get('q', '').strip() or None, 'active': args.get('active', type=int)}
+    where, params = [], []
+    if f['q']:
+        if f['q'].isdigit():
+            where.append('TelegramId = ?')
+            params.append(int(f['q']))
+        else:
+            where.append("DisplayName LIKE ? ESCAPE '\\'")
+            params.append(re.sub(r'([\\%_\[])', r'\\\1', f['q']) + '%')
+    if f['active'] in (0, 1):
+        where.append('Active = ?')
+        params.append(f['active'])
+    else:
+        f['active'] = None
+    return {k: v for k, v in f.items() if v is not None}, where, params
 
 # ---------- создание приложения -------------------------------------------
 def create_app():
@@ -98,27 +375,33 @@ def create_app():
         'base.html': BASE,
         'dash.html': DASH,
         'stud.html': STUD,
-        'res.html': RES
+        'res.html': RES,
+        'qry.html': QRY,
+        'ana_macros.html': ANA_MACROS,
+        'ana_files.html': ANA_FILES,
+        'ana_students.html': ANA_STUDENTS,
+        'ana_detail.html': ANA_DETAIL,
     })
 
     # --- Dashboard ---------------------------------------------------------
     @app.route('/')
     def dash():
-        acc = accuracy()
+        st = dashboard_stats()
+        acc = st['accuracy']
         cards = [
             {
                 'title': 'Students',
-                'value': scalar('SELECT COUNT(*) FROM dbo.Students'),
+                'value': st['students'],
                 'color': 'primary'
             },
             {
                 'title': 'Questions',
-                'value': scalar('SELECT COUNT(*) FROM dbo.PendingQuizzes'),
+                'value': st['questions'],
                 'color': 'success'
             },
             {
                 'title': 'Answers',
-                'value': scalar('SELECT COUNT(*) FROM dbo.QuizResults'),
+                'value': st['answers'],
                 'color': 'info'
             },
             {
@@ -127,46 +410,282 @@ def create_app():
                 'color': 'warning'
             }
         ]
-        return render_template('dash.html', cards=cards)
+        return render_template('dash.html', cards=cards, daily=st['daily'])
 
     # --- Students ----------------------------------------------------------
     @app.route('/students', methods=['GET', 'POST'])
     def students():
         if request.method == 'POST':
             with db_conn() as c, c.cursor() as cur:
-                cur.execute(
-                    'INSERT INTO dbo.Students (TelegramId, DisplayName) VALUES (?, ?)',
-                    int(request.form['tgid']),
-                    request.form.get('name')
-                )
+                upsert_student(cur, int(request.form['tgid']), request.form.get('name'))
                 c.commit()
             return redirect(url_for('students'))
+        return render_students()
 
+    def render_students(report=None):
+        # keyset-пагинация по Id: курсор — последний Id предыдущей страницы
+        f, where, params = students_filter(request.args)
+        cursor = request.args.get('after', type=int)
+        if cursor is not None:
+            where.append('Id > ?')
+            params.append(cursor)
+        sql = (f"SELECT TOP ({PAGE_SIZE + 1}) Id, TelegramId, DisplayName, Active "
+               f"FROM dbo.Students {'WHERE ' + ' AND '.join(where) if where else ''} "
+               f"ORDER BY Id")
         with db_conn() as c, c.cursor() as cur:
-            cur.execute(
-                'SELECT Id, TelegramId, DisplayName, Active FROM dbo.Students ORDER BY Id'
-            )
+            cur.execute(sql, *params)
             st = dictrows(cur)
-        return render_template('stud.html', students=st)
+        next_cursor = st[PAGE_SIZE - 1]['Id'] if len(st) > PAGE_SIZE else None
+        return render_template('stud.html', students=st[:PAGE_SIZE], f=f,
+                               cursor=cursor, next_cursor=next_cursor, report=report)
+
+    @app.route('/students/import', methods=['POST'])
+    def students_import():
+        upload = request.files.get('roster')
+        if not upload:
+            abort(400)
+        errors = []
+        with db_conn() as c, c.cursor() as cur:
+            report = import_roster(cur, parse_roster(upload.stream, errors))
+            c.commit()
+        report['errors'] = errors
+        return render_students(report)
+
+    @app.route('/students/bulk', methods=['POST'])
+    def students_bulk():
+        action = request.form.get('action')
+        if action not in ('activate', 'deactivate'):
+            abort(400)
+        ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+        if ids:
+            with db_conn() as c, c.cursor() as cur:
+                set_active(cur, ids, action == 'activate')
+                c.commit()
+        return redirect(url_for('students', **request.args))
 
     # --- Results -----------------------------------------------------------
     @app.route('/results')
     def results():
-        sql = """
-            SELECT qr.PendingQuizId,
+        # keyset-пагинация по (AnsweredAt, Id): курсор — последняя строка
+        # предыдущей страницы, время передаём строкой с точностью datetime2
+        f, where, params = results_filter(request.args)
+        cursor = request.args.get('before', '')
+        m = _CURSOR_RE.match(cursor)
+        if m:
+            where.append('(qr.AnsweredAt < CONVERT(DATETIME2, ?, 126) OR '
+                         '(qr.AnsweredAt = CONVERT(DATETIME2, ?, 126) AND qr.Id < ?))')
+            params += [m.group(1), m.group(1), int(m.group(2))]
+        sql = f"""
+            SELECT TOP (?) qr.Id,
+                qr.PendingQuizId,
                 qr.ChosenOption,
                 qr.IsCorrect,
                 qr.AnsweredAt,
+                CONVERT(VARCHAR(27), qr.AnsweredAt, 126) AS CursorTs,
                 COALESCE(st.DisplayName,'') AS DisplayName,
                 qr.StudentId               AS TelegramId
             FROM dbo.QuizResults qr
             LEFT JOIN dbo.Students st ON st.TelegramId = qr.StudentId
-            ORDER BY qr.AnsweredAt DESC
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY qr.AnsweredAt DESC, qr.Id DESC
         """
         with db_conn() as c, c.cursor() as cur:
-            cur.execute(sql)
+            cur.execute(sql, PAGE_SIZE + 1, *params)
+            rows = dictrows(cur)
+        next_cursor = None
+        if len(rows) > PAGE_SIZE:
+            rows = rows[:PAGE_SIZE]
+            next_cursor = f"{rows[-1]['CursorTs']}_{rows[-1]['Id']}"
+        return render_template('res.html', rows=rows, f=f,
+                               cursor=m is not None, next_cursor=next_cursor)
+
+    # --- Аналитика (сводные таблицы) ---------------------------------------
+    @app.route('/analytics/files')
+    def analytics_files():
+        return render_files()
+
+    def render_files(**extra):
+        order = _FILE_SORTS.get(request.args.get('sort'), _FILE_SORTS['accuracy'])
+        with db_conn() as c, c.cursor() as cur:
+            cur.execute(f"""
+                SELECT TOP (500) x.ProcessedFileId, pf.FileName, x.Students, x.Attempts,
+                       x.Answers, x.Correct, x.Finished, x.TimedOut, x.LastActivityAt, {_RATES}
+                FROM dbo.FileStats x
+                LEFT JOIN dbo.ProcessedFiles pf ON pf.Id = x.ProcessedFileId
+                ORDER BY {order}
+            """)
+            rows = dictrows(cur)
+        return render_template('ana_files.html', rows=rows, title='Analytics', **extra)
+
+    @app.route('/analytics/students')
+    def analytics_students():
+        cursor = request.args.get('after', type=int)
+        with db_conn() as c, c.cursor() as cur:
+            cur.execute(f"""
+                SELECT TOP ({PAGE_SIZE + 1}) x.StudentId, st.DisplayName, x.Files, x.Attempts,
+                       x.Answers, x.Correct, x.Finished, x.TimedOut, x.LastActivityAt, {_RATES}
+                FROM dbo.StudentStats x
+                LEFT JOIN dbo.Students st ON st.TelegramId = x.StudentId
+                WHERE x.StudentId > ?
+                ORDER BY x.StudentId
+            """, cursor if cursor is not None else -2 ** 63)
+            rows = dictrows(cur)
+        next_cursor = rows[PAGE_SIZE - 1]['StudentId'] if len(rows) > PAGE_SIZE else None
+        return render_template('ana_students.html', rows=rows[:PAGE_SIZE], title='Analytics',
+                               cursor=cursor, next_cursor=next_cursor)
+
+    @app.route('/analytics/students/<int:student>')
+    def analytics_student(student):
+        with db_conn() as c, c.cursor() as cur:
+            cur.execute(f"""
+                SELECT x.Answers, x.Finished, x.TimedOut, {_RATES}, st.DisplayName
+                FROM dbo.StudentStats x
+                LEFT JOIN dbo.Students st ON st.TelegramId = x.StudentId
+                WHERE x.StudentId = ?
+            """, student)
+            total = dictrows(cur)
+            cur.execute(f"""
+                SELECT x.ProcessedFileId, pf.FileName, x.Attempts, x.Answers, x.Finished,
+                       x.TimedOut, x.LastActivityAt, {_RATES}
+                FROM dbo.StudentFileStats x
+                LEFT JOIN dbo.ProcessedFiles pf ON pf.Id = x.ProcessedFileId
+                WHERE x.StudentId = ?
+                ORDER BY x.LastActivityAt DESC
+            """, student)
+            rows = dictrows(cur)
+        if not total:
+            abort(404)
+        return render_template('ana_detail.html', total=total[0], rows=rows, by='file',
+                               title=total[0]['DisplayName'] or str(student),
+                               back=url_for('analytics_students'))
+
+    @app.route('/analytics/files/<int:pf_id>')
+    def analytics_file(pf_id):
+        with db_conn() as c, c.cursor() as cur:
+            cur.execute(f"""
+                SELECT x.Answers, x.Finished, x.TimedOut, {_RATES}, pf.FileName
+                FROM dbo.FileStats x
+                LEFT JOIN dbo.ProcessedFiles pf ON pf.Id = x.ProcessedFileId
+                WHERE x.ProcessedFileId = ?
+            """, pf_id)
+            total = dictrows(cur)
+            cur.execute(f"""
+                SELECT x.StudentId, st.DisplayName, x.Attempts, x.Answers, x.Finished,
+                       x.TimedOut, x.LastActivityAt, {_RATES}
+                FROM dbo.StudentFileStats x
+                LEFT JOIN dbo.Students st ON st.TelegramId = x.StudentId
+                WHERE x.ProcessedFileId = ?
+                ORDER BY CASE WHEN x.Answers = 0 THEN 1 ELSE 0 END, Accuracy DESC
+            """, pf_id)
             rows = dictrows(cur)
-        return render_template('res.html', rows=rows)
+        if not total:
+            abort(404)
+        return render_template('ana_detail.html', total=total[0], rows=rows, by='student',
+                               title=total[0]['FileName'] or f'File {pf_id}',
+                               back=url_for('analytics_files'))
+
+    @app.route('/analytics/rebuild', methods=['POST'])
+    def analytics_rebuild():
+        # 202: пересчёт принят и идёт в фоне (start_rebuild)
+        return render_files(rebuild=start_rebuild()), 202
+
+    # --- Экспорт (потоковый) -----------------------------------------------
+    @app.route('/export/<kind>.<fmt>')
+    def export(kind, fmt):
+        if fmt not in FORMATS:
+            abort(404)
+        if kind == 'results':
+            _f, where, params = results_filter(request.args)
+            sql = f"""
+                SELECT qr.Id, qr.PendingQuizId, pq.ProcessedFileId, qr.StudentId,
+                       st.DisplayName, qr.ChosenOption, qr.IsCorrect, qr.AnsweredAt
+                FROM dbo.QuizResults qr
+                JOIN dbo.PendingQuizzes pq ON pq.Id = qr.PendingQuizId
+                LEFT JOIN dbo.Students st ON st.TelegramId = qr.StudentId
+                {'WHERE ' + ' AND '.join(where) if where else ''}
+                ORDER BY qr.AnsweredAt, qr.Id
+            """
+        elif kind == 'sessions':
+            params = []
+            sql = """
+                SELECT s.Id, s.ProcessedFileId, s.StudentId, st.DisplayName,
+                       s.Total, s.Answered, s.Correct, s.StartedAt, s.FinishedAt,
+                       s.TimedOut
+                FROM dbo.QuizSessions s
+                LEFT JOIN dbo.Students st ON st.TelegramId = s.StudentId
+            """
+            if request.args.get('file', type=int) is not None:
+                sql += ' WHERE s.ProcessedFileId = ?'
+                params.append(request.args.get('file', type=int))
+            sql += ' ORDER BY s.Id'
+        elif kind == 'files':
+            params = []
+            sql = """
+                SELECT x.ProcessedFileId, pf.FileName,
+                       x.Students      AS Sessions,
+                       x.Finished      AS Completed,
+                       x.TimedOut,
+                       x.Answers,
+                       x.Correct,
+                       CAST(x.Correct * 100.0
+                            / NULLIF(x.Answers, 0) AS DECIMAL(5,1)) AS AccuracyPct
+                FROM dbo.FileStats x
+                LEFT JOIN dbo.ProcessedFiles pf ON pf.Id = x.ProcessedFileId
+                ORDER BY x.ProcessedFileId
+            """
+        else:
+            abort(404)
+
+        def generate():
+            with db_conn() as c, c.cursor() as cur:
+                cur.execute(sql, *params)
+                yield from stream_rows(cur, fmt)
+
+        body, name = generate(), f'{kind}.{fmt}'
+        mimetype = FORMATS[fmt]
+        if request.args.get('gzip', type=int):
+            body, name, mimetype = gzip_stream(body), name + '.gz', 'application/gzip'
+        return Response(body, mimetype=mimetype, headers={
+            'Content-Disposition': f'attachment; filename={name}',
+            'X-Accel-Buffering': 'no',
+        })
+
+    # --- Внутренняя статистика ---------------------------------------------
+    @app.route('/metrics')
+    def metrics():
+        # метрики этого воркера панели; бот отдаёт свои на BOT_METRICS_PORT
+        return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+    @app.route('/debug/stats')
+    def debug_stats():
+        return jsonify(
+            panel={'pool': pool_stats(), 'executor': executor_stats()},
+            bot=[dict(url=url, **bot_debug(url, '/debug/stats')) for url in BOT_DEBUG_URLS],
+        )
+
+    @app.route('/debug/queries', methods=['GET', 'POST'])
+    def debug_queries():
+        # source: panel — журнал этого воркера gunicorn, 0..N — процессы бота
+        sources = [('panel', 'Panel')] + [
+            (str(i), f'Bot {i}' if len(BOT_DEBUG_URLS) > 1 else 'Bot')
+            for i in range(len(BOT_DEBUG_URLS))]
+        source = request.args.get('source', 'panel')
+        if source not in dict(sources):
+            abort(404)
+        url = None if source == 'panel' else BOT_DEBUG_URLS[int(source)]
+        if request.method == 'POST':
+            if url:
+                bot_debug(url, '/debug/queries', method='POST')
+            else:
+                profiler.reset()
+            return redirect(url_for('debug_queries', source=source))
+        top = max(1, min(request.args.get('top', 20, type=int), 200))
+        report = (bot_debug(url, f'/debug/queries?top={top}') if url
+                  else profiler.report(top=top))
+        if request.args.get('format') == 'json':
+            return jsonify(report)
+        return render_template('qry.html', p=report, title='SQL profile',
+                               source=source, sources=sources)
 
     return app
 
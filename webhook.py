@@ -0,0 +1,256 @@
+# webhook.py — приём обновлений через webhook, несколько процессов-воркеров
+# -------------------------------------------------------------------------
+#   python webhook.py serve  [--workers N]       роутер + N воркеров
+#   python webhook.py router [--workers N]       только роутер
+#   python webhook.py worker --index I [--workers N]   один воркер из N
+#   python webhook.py replay updates.ndjson [--url ...] [--concurrency K]
+#
+# Роутер принимает POST от Telegram, проверяет секретный токен и по id
+# пользователя выбирает воркер (id % N): все обновления одного ученика
+# обрабатывает один процесс — порядок ответов в сессии и его индекс
+# опросов сохраняются. Воркер — обычный Application без Updater: он
+# кладёт обновления в update_queue. Периодические задачи — только у
+# воркера 0. Лимит отправки BROADCAST_RATE у воркеров общий — token bucket
+# в общей памяти (common.broadcast.SharedTokenBucket), его создаёт serve.
+# Метрики и /debug/* воркер I отдаёт на BOT_METRICS_PORT + I
+# (common.debugserver); панели их перечисляют в BOT_DEBUG_URLS.
+import argparse, asyncio, hmac, json, logging, multiprocessing, os, signal, time
+import weakref
+from typing import Iterator, Optional
+
+import aiohttp
+from aiohttp import web
+from telegram import Bot, Update
+
+from telegram_config import BOT_TOKEN
+from common.broadcast import SharedTokenBucket
+from common.config import setting
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+WEBHOOK_SECRET = setting("WEBHOOK_SECRET", "")
+WEBHOOK_URL = setting("WEBHOOK_URL")              # публичный адрес для setWebhook
+WEBHOOK_HOST = setting("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = setting("WEBHOOK_PORT", 8443, int)
+WEBHOOK_PATH = setting("WEBHOOK_PATH", "/webhook")
+WEBHOOK_WORKER_PORT = setting("WEBHOOK_WORKER_PORT", 8450, int)   # + индекс
+WEBHOOK_WORKERS = setting("WEBHOOK_WORKERS", os.cpu_count() or 1, int)
+WEBHOOK_MAX_CONNECTIONS = setting("WEBHOOK_MAX_CONNECTIONS", 40, int)
+
+
+def route_key(update: dict) -> int:
+    """Id пользователя (или чата), по которому выбирается воркер."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return 0
+
+
+def worker_url(index: int) -> str:
+    return f"http://127.0.0.1:{WEBHOOK_WORKER_PORT + index}/update"
+
+
+def _check_secret(request: web.Request) -> bool:
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET)
+
+
+async def _wait_for_signal() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+# ─────────── роутер ───────────
+async def serve_router(workers: int) -> None:
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+    # обновления одного пользователя пересылаем по одному, в порядке прихода
+    locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def webhook(request: web.Request) -> web.Response:
+        if not _check_secret(request):
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        key = route_key(update)
+        lock = locks.get(key)
+        if lock is None:
+            lock = locks[key] = asyncio.Lock()
+        async with lock:
+            try:
+                async with session.post(
+                    worker_url(key % workers),
+                    data=body,
+                    headers={SECRET_HEADER: WEBHOOK_SECRET,
+                             "Content-Type": "application/json"},
+                ) as resp:
+                    return web.Response(status=resp.status)
+            except aiohttp.ClientError:
+                # не 2xx — Telegram повторит доставку позже
+                logger.warning("Worker %s unavailable", key % workers)
+                return web.Response(status=503)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    if WEBHOOK_URL:
+        async with Bot(BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+    logger.info("Webhook router on %s:%s%s → %s workers",
+                WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, workers)
+    try:
+        await _wait_for_signal()
+    finally:
+        await runner.cleanup()
+        await session.close()
+
+
+# ─────────── воркер ───────────
+async def serve_worker(index: int, workers: int, rate_state=None) -> None:
+    from bot_app import build_application, prepare
+
+    # индекс опросов — только для своих учеников (id % workers == index)
+    await asyncio.get_running_loop().run_in_executor(None, prepare, index, workers)
+    app = build_application(jobs=index == 0, processes=workers, index=index,
+                            rate_state=rate_state)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+
+    async def receive(request: web.Request) -> web.Response:
+        if not _check_secret(request):
+            return web.Response(status=403)
+        await app.update_queue.put(Update.de_json(await request.json(), app.bot))
+        return web.Response()
+
+    site_app = web.Application()
+    site_app.router.add_post("/update", receive)
+    runner = web.AppRunner(site_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", WEBHOOK_WORKER_PORT + index).start()
+    logger.info("Webhook worker %s on port %s", index, WEBHOOK_WORKER_PORT + index)
+    try:
+        await _wait_for_signal()
+    finally:
+        await runner.cleanup()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+
+
+def _run_worker(index: int, workers: int, rate_state) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    asyncio.run(serve_worker(index, workers, rate_state))
+
+
+def serve(workers: int) -> None:
+    ctx = multiprocessing.get_context("spawn")
+    rate_state = SharedTokenBucket.new_state(ctx)
+    procs = [ctx.Process(target=_run_worker, args=(i, workers, rate_state), name=f"bot-worker-{i}")
+             for i in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        asyncio.run(serve_router(workers))
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
+
+
+# ─────────── replay: прогон записанных обновлений ───────────
+def read_updates(path: str) -> Iterator[dict]:
+    """Обновления из файла: JSON-массив или по одному JSON на строку."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        yield from json.loads(text)
+        return
+    for line in text.splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+
+async def replay(path: str, url: str, concurrency: int = 1) -> dict:
+    """Отправляет записанные обновления на webhook; статусы и скорость."""
+    statuses: dict = {}
+    sem = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        async def post(update: dict):
+            async with sem:
+                async with session.post(
+                    url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET}
+                ) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        await asyncio.gather(*(post(u) for u in read_updates(path)))
+    elapsed = time.monotonic() - started
+    total = sum(statuses.values())
+    return {
+        "updates": total,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "per_second": round(total / elapsed, 1) if elapsed else None,
+    }
+
+
+def main(argv: Optional[list] = None) -> None:
+    ap = argparse.ArgumentParser(description="Telegram webhook: роутер и воркеры")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name in ("serve", "router", "worker"):
+        p = sub.add_parser(name)
+        p.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    p.add_argument("--index", type=int, required=True)
+    p = sub.add_parser("replay")
+    p.add_argument("path")
+    p.add_argument("--url", default=f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    p.add_argument("--concurrency", type=int, default=1)
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if args.cmd == "replay":
+        print(json.dumps(asyncio.run(replay(args.path, args.url, args.concurrency))))
+        return
+    if not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET must be set for webhook mode")
+    if args.cmd == "serve":
+        serve(args.workers)
+    elif args.cmd == "router":
+        asyncio.run(serve_router(args.workers))
+    else:
+        asyncio.run(serve_worker(args.index, args.workers))
+
+
+if __name__ == "__main__":
+    main()